@@ -3,20 +3,32 @@
 """
 import os
 import io
+import csv
+import asyncio
 import hmac
+import html
 import hashlib
 import time
+import zlib
 import json
+import math
+import random
 import re
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, insort
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from urllib.parse import unquote
 
 from fastapi import FastAPI, Request, Response, UploadFile, File, Depends, HTTPException, status
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from starlette.concurrency import run_in_threadpool
 import httpx
 import jwt
 import secrets
@@ -36,6 +48,27 @@ ADMIN_SECRET = os.environ.get("ADMIN_SECRET", secrets.token_urlsafe(32))
 RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "730"))  # 默认保存2年
 ARCHIVE_BATCH = 200
 EXPORT_TTL_SECONDS = 600
+EXPORT_CHUNK_SIZE = 64 * 1024  # 导出文件流式返回的分块大小
+EXPORT_ROWS_PER_CHUNK = 500  # csv/ndjson 导出每次输出的行数
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "500"))  # Excel 导入每次批量 upsert 的行数
+IMPORT_DIFF_LIMIT = 200  # 导入结果里最多返回的改动明细条数
+# 导出格式 -> (文件扩展名, Content-Type)；csv/ndjson.gz 逐行流式生成，不加载 openpyxl，也不限制行数
+EXPORT_FORMATS = {
+    "xlsx": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("csv", "text/csv"),
+    "ndjson.gz": ("ndjson.gz", "application/gzip")
+}
+# 导出任务：同一 (导出范围, 筛选, 格式, 数据版本) 只生成一次，文件缓存在磁盘上供重复下载（同机多 worker 共享）
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wecom_accounting_exports"))
+EXPORT_CACHE_TTL = int(os.environ.get("EXPORT_CACHE_TTL", "1800"))  # 导出文件保留秒数
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_MB", "200")) * 1024 * 1024  # 超出后删除最早的文件
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "2"))
+EXPORT_WAIT_SECONDS = float(os.environ.get("EXPORT_WAIT_SECONDS", "20"))  # 导出请求最多等待秒数，超时返回任务状态
+EXPORT_JOBS = {}  # job_id -> 任务信息
+EXPORT_JOBS_LOCK = threading.Lock()
+EXPORT_EXECUTOR = {"value": None}
+EXPORT_EXECUTOR_LOCK = threading.Lock()
+EXPORT_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
 LOCAL_TZ = ZoneInfo("Asia/Shanghai")
 UTC_TZ = ZoneInfo("UTC")
 PENDING_DELETE_TTL = 300  # 秒
@@ -45,8 +78,6 @@ ADMIN_TOKEN_EXPIRY = 3600 * 24  # Token 24小时过期
 MAX_LOGIN_ATTEMPTS = 5  # 最大登录尝试次数
 LOGIN_LOCKOUT_TIME = 300  # 锁定时间（秒）
 
-# 登录失败记录（内存，按 IP）
-LOGIN_ATTEMPTS = {}
 
 security = HTTPBearer()
 
@@ -70,161 +101,537 @@ def verify_admin_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         raise HTTPException(status_code=403, detail="Invalid token")
 
 
-# 待确认删除（内存，按 openid）
-PENDING_DELETES = {}
-# 待分类选择（内存，按 openid）
-PENDING_CATEGORY_PICKS = {}
-# 消息去重缓存（内存，避免数据库查询）
-MSG_DEDUP_CACHE = {}
+# 会话状态（消息去重、待确认删除、待分类选择、登录失败次数）：默认存进程内存；
+# 多 worker 部署时设 STATE_BACKEND=sqlite，同一台机器上的进程共享 STATE_SQLITE_PATH
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_SQLITE_PATH = os.environ.get("STATE_SQLITE_PATH", "/tmp/wecom_accounting_state.db")
+STATE_STORE = {"value": None}
+STATE_STORE_LOCK = threading.Lock()
+STATE_DEDUP = "dedup"                    # 消息去重（按 msg_id）
+STATE_PENDING_DELETE = "pending_delete"  # 待确认删除（按 openid）
+STATE_CATEGORY_PICK = "category_pick"    # 待分类选择（按 openid）
+STATE_LOGIN = "login"                    # 登录失败记录（按 IP）
 MSG_DEDUP_MAX_SIZE = 1000  # 最多保留1000条消息ID
 MSG_DEDUP_TTL = 300  # 消息ID保留5分钟
+MSG_DEDUP_STATS = {"hits": 0, "misses": 0}
+
+# 公众号消息处理：微信 5 秒内收不到回复会重试，超过预算时先回 success，处理完再用客服消息推送
+WEBHOOK_REPLY_BUDGET = float(os.environ.get("WEBHOOK_REPLY_BUDGET", "4.0"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_EXECUTOR = {"value": None}
+WEBHOOK_EXECUTOR_LOCK = threading.Lock()
+WEBHOOK_STATS = {
+    "passive": 0,           # 预算内完成，被动回复
+    "deferred": 0,          # 超出预算，改为客服消息推送
+    "delivered": 0,         # 客服消息推送成功
+    "delivery_failed": 0,   # 客服消息推送失败（如超过 48 小时互动窗口）
+    "errors": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0
+}
+
+# 周报/月报推送：并发发送客服消息，令牌桶限速，临时错误退避重试
+REPORT_CONCURRENCY = int(os.environ.get("REPORT_CONCURRENCY", "8"))        # 同时在途的请求数
+REPORT_RATE_PER_SECOND = float(os.environ.get("REPORT_RATE_PER_SECOND", "20"))  # 每秒最多发送条数
+REPORT_RATE_BURST = int(os.environ.get("REPORT_RATE_BURST", "20"))         # 令牌桶容量（允许的突发条数）
+REPORT_MAX_RETRIES = int(os.environ.get("REPORT_MAX_RETRIES", "3"))        # 临时错误最多重试次数
+REPORT_RETRY_BASE_DELAY = 0.5  # 退避基准秒数，按 2 的幂增长并加随机抖动
+REPORT_SEND_TIMEOUT = 10.0
+WECHAT_RETRY_ERRCODES = {-1, 45011}             # 系统繁忙、接口分钟级频率限制：稍后重试
+WECHAT_TOKEN_ERRCODES = {40001, 40014, 42001}   # access_token 失效：刷新后重试
+WECHAT_ASYNC_HTTP = {"client": None}
 
 # ============ 分类（不再使用内置关键词，仅用用户配置的别名完全匹配）============
 # 原 CATEGORY_KEYWORDS 已移除，避免未设置的类目（如交通）自动归类；未出现过的备注一律由用户选择分类。
 
 # 关键词别名缓存（全局）
 CATEGORY_ALIAS_CACHE = {"value": {}, "expires_at": 0}
+# 别名写入队列（按关键词合并，后台批量 upsert）
+ALIAS_WRITE_QUEUE = {}
+ALIAS_WRITE_LOCK = threading.Lock()
+ALIAS_WRITE_TIMER = {"value": None}
+ALIAS_FLUSH_INTERVAL = float(os.environ.get("ALIAS_FLUSH_INTERVAL", "2"))  # 最多延迟秒数
+ALIAS_FLUSH_BATCH = int(os.environ.get("ALIAS_FLUSH_BATCH", "50"))  # 积压达到该数量立即写入
 # 分类列表缓存（全局）
-CATEGORY_LIST_CACHE = {"value": [], "expires_at": 0}
+CATEGORY_LIST_CACHE = {"value": [], "expires_at": 0, "index": None}
 CATEGORY_LIST_CACHE_TTL = 600  # 分类列表缓存10分钟
 # 记录缓存（用于管理后台统计）
-RECORDS_CACHE = {"value": [], "expires_at": 0, "count": 0}
-RECORDS_CACHE_TTL = 30  # 记录缓存30秒，编辑后统计尽快更新
+RECORDS_CACHE = {
+    "store": None,        # RecordStore 列式存储
+    "expires_at": 0,
+    "count": 0,
+    "max_id": 0,          # 已同步的最大 id（新增记录水位）
+    "updated_at": "",     # 已同步的最大 updated_at（修改记录水位，表中无该列时为空）
+    "full_sync_at": 0,    # 上次全量加载时间
+    "full_sync_required": False,
+    "generation": 0       # invalidate_records_cache 时加一；加载/同步期间变了说明有写入没合并进来
+}
+RECORDS_CACHE_TTL = 30  # 记录缓存30秒，过期后只增量拉取新增/修改的记录
+RECORDS_FULL_SYNC_INTERVAL = int(os.environ.get("RECORDS_FULL_SYNC_INTERVAL", "600"))  # 定期全量对账（发现其他进程的删除）
+RECORDS_DELTA_OVERLAP = 5  # 增量同步时 updated_at 水位回退秒数，避免长事务提交晚于水位而漏数据
+RECORDS_PAGE_SIZE = int(os.environ.get("RECORDS_PAGE_SIZE", "1000"))  # 分页加载每页条数（不超过 Supabase 的 max-rows）
+RECORDS_CACHE_LOCK = threading.Lock()
 
 # ============ 数据库操作（使用 REST API）============
+# 连接池配置：所有查询共用一个长连接客户端，避免每次请求重新 TCP+TLS 握手
+SUPABASE_TIMEOUT = 8.0
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.environ.get("SUPABASE_POOL_MAX_CONNECTIONS", "20"))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.environ.get("SUPABASE_POOL_MAX_KEEPALIVE", "10"))
+SUPABASE_POOL_KEEPALIVE_EXPIRY = float(os.environ.get("SUPABASE_POOL_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_HTTP2 = os.environ.get("SUPABASE_HTTP2", "0") == "1"  # 需安装 h2（pip install httpx[http2]）
+
+# 进程级共享 HTTP 客户端与统计
+SUPABASE_HTTP = {"client": None, "http2": False}
+SUPABASE_HTTP_LOCK = threading.Lock()
+SUPABASE_POOL_STATS = {"clients_created": 0, "requests": 0, "errors": 0, "total_ms": 0.0}
+SUPABASE_POOL_STATS_LOCK = threading.Lock()  # 同步请求在线程池中并发执行，累加统计需加锁
+
+
+def add_supabase_pool_stats(clients_created: int = 0, requests: int = 0, errors: int = 0, total_ms: float = 0.0):
+    """累加连接池统计"""
+    with SUPABASE_POOL_STATS_LOCK:
+        SUPABASE_POOL_STATS["clients_created"] += clients_created
+        SUPABASE_POOL_STATS["requests"] += requests
+        SUPABASE_POOL_STATS["errors"] += errors
+        SUPABASE_POOL_STATS["total_ms"] += total_ms
+
+
+def supabase_http2_available() -> bool:
+    """是否可以启用 HTTP/2（需要可选依赖 h2）"""
+    if not SUPABASE_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("未安装 h2，Supabase 连接回退为 HTTP/1.1")
+        return False
+
+
+def get_supabase_http_client() -> httpx.Client:
+    """获取进程级共享的 httpx.Client（keep-alive 连接池，首次调用时创建）"""
+    client = SUPABASE_HTTP["client"]
+    if client is not None and not client.is_closed:
+        return client
+    with SUPABASE_HTTP_LOCK:
+        client = SUPABASE_HTTP["client"]
+        if client is None or client.is_closed:
+            http2 = supabase_http2_available()
+            client = httpx.Client(
+                timeout=SUPABASE_TIMEOUT,
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=SUPABASE_POOL_KEEPALIVE_EXPIRY
+                )
+            )
+            SUPABASE_HTTP["client"] = client
+            SUPABASE_HTTP["http2"] = http2
+            add_supabase_pool_stats(clients_created=1)
+    return client
+
+
+def close_supabase_http_client():
+    """关闭共享客户端（进程退出时调用）"""
+    with SUPABASE_HTTP_LOCK:
+        client = SUPABASE_HTTP["client"]
+        SUPABASE_HTTP["client"] = None
+    if client is not None:
+        client.close()
+
+
+def supabase_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """通过共享连接池发送请求，并记录请求数/错误数/耗时"""
+    client = get_supabase_http_client()
+    started = time.perf_counter()
+    failed = 0
+    try:
+        response = client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+    except Exception:
+        failed = 1
+        raise
+    finally:
+        add_supabase_pool_stats(requests=1, errors=failed, total_ms=(time.perf_counter() - started) * 1000)
+
+
+def get_supabase_pool_stats() -> dict:
+    """连接池统计（用于监控）"""
+    with SUPABASE_POOL_STATS_LOCK:
+        counters = dict(SUPABASE_POOL_STATS)
+    requests_count = counters["requests"]
+    stats = {
+        "clients_created": counters["clients_created"],
+        "requests": requests_count,
+        "errors": counters["errors"],
+        "avg_ms": round(counters["total_ms"] / requests_count, 2) if requests_count else 0,
+        "http2": SUPABASE_HTTP["http2"],
+        "max_connections": SUPABASE_POOL_MAX_CONNECTIONS,
+        "max_keepalive": SUPABASE_POOL_MAX_KEEPALIVE,
+        "connections": 0,
+        "idle_connections": 0
+    }
+    for client in (SUPABASE_HTTP["client"], SUPABASE_ASYNC_HTTP["client"]):
+        if client is None:
+            continue
+        try:
+            # httpcore 未公开池状态接口，读取失败时只返回计数
+            connections = list(client._transport._pool.connections)
+            stats["connections"] += len(connections)
+            stats["idle_connections"] += sum(1 for c in connections if c.is_idle())
+        except Exception:
+            pass
+    return stats
+
+
+class SupabaseResult:
+    """查询结果"""
+    def __init__(self, data):
+        self.data = data
+
+
+class SupabaseClient:
+    """简单的 Supabase REST 客户端（共享连接池）"""
+    def __init__(self, url, key):
+        self.url = url.rstrip('/')
+        self.key = key
+        self.headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=representation"
+        }
+
+    def table(self, name):
+        return SupabaseTable(self.url, name, self.headers)
+
+    def rpc(self, name, params=None):
+        """调用数据库函数（POST /rest/v1/rpc/{name}）"""
+        return RpcBuilder(f"{self.url}/rest/v1/rpc/{name}", self.headers, params or {})
+
+
+class SupabaseTable:
+    def __init__(self, base_url, name, headers):
+        self.url = f"{base_url}/rest/v1/{name}"
+        self.headers = headers
+
+    def insert(self, data):
+        class Result:
+            def __init__(self, data):
+                self.data = data
+            def execute(self):
+                return self
+
+        response = supabase_request("POST", self.url, json=data, headers=self.headers)
+        return Result(response.json() if response.content else [data])
+
+    def select(self, columns="*"):
+        return QueryBuilder(self.url, self.headers, columns)
+
+    def update(self, data):
+        return UpdateBuilder(self.url, self.headers, data)
+
+    def delete(self):
+        return DeleteBuilder(self.url, self.headers)
+
+    def upsert(self, data, on_conflict, returning=False):
+        return UpsertBuilder(self.url, self.headers, data, on_conflict, returning)
+
+
+class UpsertBuilder:
+    """批量 upsert：冲突列相同的行合并更新（Prefer: resolution=merge-duplicates），returning=True 时返回写入后的行"""
+    def __init__(self, url, headers, data, on_conflict, returning=False):
+        self.url = url
+        self.returning = returning
+        prefer = "return=representation" if returning else "return=minimal"
+        self.headers = dict(headers, Prefer=f"resolution=merge-duplicates,{prefer}")
+        self.params = {"on_conflict": on_conflict}
+        self.data = data
+
+    def execute(self):
+        response = supabase_request("POST", self.url, params=self.params, json=self.data, headers=self.headers)
+        return SupabaseResult(response.json() if self.returning and response.content else [])
+
+
+class QueryBuilder:
+    def __init__(self, url, headers, columns):
+        self.url = url
+        self.headers = headers
+        self.params = {"select": columns}
+        self.filters = []
+
+    def eq(self, column, value):
+        self.filters.append((column, "eq", value))
+        return self
+
+    def gte(self, column, value):
+        self.filters.append((column, "gte", value))
+        return self
+
+    def lt(self, column, value):
+        self.filters.append((column, "lt", value))
+        return self
+
+    def ilike(self, column, value):
+        self.filters.append((column, "ilike", value))
+        return self
+
+    def lte(self, column, value):
+        self.filters.append((column, "lte", value))
+        return self
+
+    def gt(self, column, value):
+        self.filters.append((column, "gt", value))
+        return self
+
+    def in_(self, column, values):
+        self.filters.append((column, "in", f"({','.join(str(v) for v in values)})"))
+        return self
+
+    def or_(self, conditions: str):
+        """PostgREST 的 or 过滤，如 or_("id.gt.10,updated_at.gte.2026-01-01")"""
+        self.params["or"] = f"({conditions})"
+        return self
+
+    def order(self, column, desc=False):
+        """排序；多次调用按调用顺序追加排序列"""
+        term = f"{column}.{'desc' if desc else 'asc'}"
+        self.params["order"] = f"{self.params['order']},{term}" if "order" in self.params else term
+        return self
+
+    def limit(self, count: int):
+        self.params["limit"] = str(count)
+        return self
+
+    def query_params(self) -> list:
+        """查询参数列表：同一列可以有多个过滤条件（如 created_at 的 gte 与 lt 同时生效）"""
+        return list(self.params.items()) + [(column, f"{op}.{value}") for column, op, value in self.filters]
+
+    def execute(self):
+        response = supabase_request("GET", self.url, params=self.query_params(), headers=self.headers)
+        return SupabaseResult(response.json())
+
+
+class UpdateBuilder:
+    def __init__(self, url, headers, data):
+        self.url = url
+        self.headers = headers
+        self.data = data
+        self.params = {}
+        self.filters = []
+
+    def eq(self, column, value):
+        self.filters.append((column, "eq", value))
+        return self
+
+    def execute(self):
+        for column, op, value in self.filters:
+            self.params[column] = f"{op}.{value}"
+
+        response = supabase_request("PATCH", self.url, params=self.params, json=self.data, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else [])
+
+
+class DeleteBuilder:
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.params = {}
+        self.filters = []
+
+    def eq(self, column, value):
+        self.filters.append((column, "eq", value))
+        return self
+
+    def in_(self, column, values):
+        self.filters.append((column, "in", f"({','.join(str(v) for v in values)})"))
+        return self
+
+    def execute(self):
+        for column, op, value in self.filters:
+            self.params[column] = f"{op}.{value}"
+
+        response = supabase_request("DELETE", self.url, params=self.params, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else [])
+
+
+class RpcBuilder:
+    def __init__(self, url, headers, params):
+        self.url = url
+        self.headers = headers
+        self.params = params
+
+    def execute(self):
+        response = supabase_request("POST", self.url, json=self.params, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else None)
+
+
+SUPABASE_CLIENT = {"value": None}
+
+
 def get_supabase_client():
-    """创建简单的 Supabase REST 客户端"""
-    class SupabaseClient:
-        def __init__(self, url, key):
-            self.url = url.rstrip('/')
-            self.key = key
-            self.headers = {
-                "apikey": key,
-                "Authorization": f"Bearer {key}",
-                "Content-Type": "application/json",
-                "Prefer": "return=representation"
-            }
-        
-        def table(self, name):
-            return SupabaseTable(self.url, name, self.headers)
-    
-    class SupabaseTable:
-        def __init__(self, base_url, name, headers):
-            self.url = f"{base_url}/rest/v1/{name}"
-            self.headers = headers
-        
-        def insert(self, data):
-            class Result:
-                def __init__(self, data):
-                    self.data = data
-                def execute(self):
-                    return self
-            
-            response = httpx.post(self.url, json=data, headers=self.headers, timeout=8.0)
-            response.raise_for_status()
-            return Result(response.json() if response.content else [data])
-        
-        def select(self, columns="*"):
-            return QueryBuilder(self.url, self.headers, columns)
+    """获取 Supabase REST 客户端（进程内单例，所有查询共用连接池）"""
+    client = SUPABASE_CLIENT["value"]
+    if client is None:
+        client = SupabaseClient(SUPABASE_URL, SUPABASE_KEY)
+        SUPABASE_CLIENT["value"] = client
+    return client
 
-        def update(self, data):
-            return UpdateBuilder(self.url, self.headers, data)
 
-        def delete(self):
-            return DeleteBuilder(self.url, self.headers)
-    
-    class QueryBuilder:
-        def __init__(self, url, headers, columns):
-            self.url = url
-            self.headers = headers
-            self.params = {"select": columns}
-            self.filters = []
-        
-        def eq(self, column, value):
-            self.filters.append((column, "eq", value))
-            return self
-        
-        def gte(self, column, value):
-            self.filters.append((column, "gte", value))
-            return self
-        
-        def lt(self, column, value):
-            self.filters.append((column, "lt", value))
-            return self
+# 可选数据库函数（README 中的 SQL 未执行时不存在）：函数名 -> 下次重新探测的时间
+SUPABASE_RPC_MISSING = {}
+SUPABASE_RPC_RETRY_SECONDS = 600
 
-        def ilike(self, column, value):
-            self.filters.append((column, "ilike", value))
-            return self
 
-        def lte(self, column, value):
-            self.filters.append((column, "lte", value))
-            return self
-        
-        def order(self, column, desc=False):
-            self.params["order"] = f"{column}.{'desc' if desc else 'asc'}"
-            return self
+def is_rpc_missing_error(e: Exception) -> bool:
+    """PostgREST 找不到函数时返回 404 / PGRST202"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return False
+    return response.status_code == 404 or "PGRST202" in response.text
 
-        def limit(self, count: int):
-            self.params["limit"] = str(count)
-            return self
-        
-        def execute(self):
-            for column, op, value in self.filters:
-                self.params[column] = f"{op}.{value}"
-            
-            response = httpx.get(self.url, params=self.params, headers=self.headers, timeout=8.0)
-            response.raise_for_status()
-            class Result:
-                def __init__(self, data):
-                    self.data = data
-            return Result(response.json())
-
-    class UpdateBuilder:
-        def __init__(self, url, headers, data):
-            self.url = url
-            self.headers = headers
-            self.data = data
-            self.params = {}
-            self.filters = []
-
-        def eq(self, column, value):
-            self.filters.append((column, "eq", value))
-            return self
-
-        def execute(self):
-            for column, op, value in self.filters:
-                self.params[column] = f"{op}.{value}"
-
-            response = httpx.patch(self.url, params=self.params, json=self.data, headers=self.headers, timeout=8.0)
-            response.raise_for_status()
-            class Result:
-                def __init__(self, data):
-                    self.data = data
-            return Result(response.json() if response.content else [])
-
-    class DeleteBuilder:
-        def __init__(self, url, headers):
-            self.url = url
-            self.headers = headers
-            self.params = {}
-            self.filters = []
-
-        def eq(self, column, value):
-            self.filters.append((column, "eq", value))
-            return self
-
-        def execute(self):
-            for column, op, value in self.filters:
-                self.params[column] = f"{op}.{value}"
-
-            response = httpx.delete(self.url, params=self.params, headers=self.headers, timeout=8.0)
-            response.raise_for_status()
-            class Result:
-                def __init__(self, data):
-                    self.data = data
-            return Result(response.json() if response.content else [])
-    
-    return SupabaseClient(SUPABASE_URL, SUPABASE_KEY)
+
+def call_optional_rpc(name: str, params: dict = None):
+    """调用可选的数据库函数，返回结果；函数不存在或调用失败时返回 None，由调用方走 Python 回退。
+
+    函数不存在时记下来，SUPABASE_RPC_RETRY_SECONDS 内不再请求（执行 SQL 后最迟这么久自动启用）。
+    """
+    now = int(time.time())
+    if now < SUPABASE_RPC_MISSING.get(name, 0):
+        return None
+    try:
+        return get_supabase_client().rpc(name, params).execute().data
+    except Exception as e:
+        if is_rpc_missing_error(e):
+            SUPABASE_RPC_MISSING[name] = now + SUPABASE_RPC_RETRY_SECONDS
+            print(f"数据库函数 {name} 不存在，使用本地汇总")
+        else:
+            print(f"调用数据库函数 {name} 错误: {str(e)[:100]}")
+        return None
+
+
+# ============ 异步数据库客户端（供 async 路由使用，不阻塞事件循环）============
+SUPABASE_ASYNC_HTTP = {"client": None}
+
+
+def get_supabase_async_http_client() -> httpx.AsyncClient:
+    """获取进程级共享的 httpx.AsyncClient（与同步客户端使用相同的连接池配置）"""
+    client = SUPABASE_ASYNC_HTTP["client"]
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=SUPABASE_TIMEOUT,
+            http2=supabase_http2_available(),
+            limits=httpx.Limits(
+                max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=SUPABASE_POOL_KEEPALIVE_EXPIRY
+            )
+        )
+        SUPABASE_ASYNC_HTTP["client"] = client
+        add_supabase_pool_stats(clients_created=1)
+    return client
+
+
+async def close_supabase_async_http_client():
+    """关闭共享异步客户端（进程退出时调用）"""
+    client = SUPABASE_ASYNC_HTTP["client"]
+    SUPABASE_ASYNC_HTTP["client"] = None
+    if client is not None:
+        await client.aclose()
+
+
+async def supabase_request_async(method: str, url: str, **kwargs) -> httpx.Response:
+    """异步版 supabase_request，统计计入同一份连接池指标"""
+    client = get_supabase_async_http_client()
+    started = time.perf_counter()
+    failed = 0
+    try:
+        response = await client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+    except Exception:
+        failed = 1
+        raise
+    finally:
+        add_supabase_pool_stats(requests=1, errors=failed, total_ms=(time.perf_counter() - started) * 1000)
+
+
+class AsyncSupabaseClient(SupabaseClient):
+    """异步 Supabase REST 客户端：与同步版相同的链式接口，execute() 需 await"""
+    def table(self, name):
+        return AsyncSupabaseTable(self.url, name, self.headers)
+
+    def rpc(self, name, params=None):
+        return AsyncRpcBuilder(f"{self.url}/rest/v1/rpc/{name}", self.headers, params or {})
+
+
+class AsyncSupabaseTable(SupabaseTable):
+    def insert(self, data):
+        return AsyncInsertBuilder(self.url, self.headers, data)
+
+    def select(self, columns="*"):
+        return AsyncQueryBuilder(self.url, self.headers, columns)
+
+    def update(self, data):
+        return AsyncUpdateBuilder(self.url, self.headers, data)
+
+    def delete(self):
+        return AsyncDeleteBuilder(self.url, self.headers)
+
+
+class AsyncInsertBuilder:
+    def __init__(self, url, headers, data):
+        self.url = url
+        self.headers = headers
+        self.data = data
+
+    async def execute(self):
+        response = await supabase_request_async("POST", self.url, json=self.data, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else [self.data])
+
+
+class AsyncQueryBuilder(QueryBuilder):
+    async def execute(self):
+        response = await supabase_request_async("GET", self.url, params=self.query_params(), headers=self.headers)
+        return SupabaseResult(response.json())
+
+
+class AsyncUpdateBuilder(UpdateBuilder):
+    async def execute(self):
+        for column, op, value in self.filters:
+            self.params[column] = f"{op}.{value}"
+
+        response = await supabase_request_async("PATCH", self.url, params=self.params, json=self.data, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else [])
+
+
+class AsyncDeleteBuilder(DeleteBuilder):
+    async def execute(self):
+        for column, op, value in self.filters:
+            self.params[column] = f"{op}.{value}"
+
+        response = await supabase_request_async("DELETE", self.url, params=self.params, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else [])
+
+
+class AsyncRpcBuilder(RpcBuilder):
+    async def execute(self):
+        response = await supabase_request_async("POST", self.url, json=self.params, headers=self.headers)
+        return SupabaseResult(response.json() if response.content else None)
+
+
+SUPABASE_ASYNC_CLIENT = {"value": None}
+
+
+def get_supabase_async_client():
+    """获取异步 Supabase REST 客户端（进程内单例）"""
+    client = SUPABASE_ASYNC_CLIENT["value"]
+    if client is None:
+        client = AsyncSupabaseClient(SUPABASE_URL, SUPABASE_KEY)
+        SUPABASE_ASYNC_CLIENT["value"] = client
+    return client
 
 
 def add_record(openid: str, nickname: str, amount: float, category: str, description: str, created_at: datetime = None):
@@ -243,7 +650,7 @@ def add_record(openid: str, nickname: str, amount: float, category: str, descrip
             "created_at": created_at_value
         }
         result = supabase.table("records").insert(data).execute()
-        invalidate_records_cache()  # 清除缓存
+        apply_records_to_cache(result.data)  # 写穿缓存
         return result
     except Exception as e:
         print(f"数据库错误: {str(e)[:100]}")
@@ -273,49 +680,725 @@ def get_records(start_date: datetime = None, end_date: datetime = None, category
         return []
 
 
-def get_records_cached(max_records: int = 5000, force_refresh: bool = False):
-    """获取所有记录（带缓存，用于管理后台统计）。force_refresh=True 时强制从数据库重新加载。"""
+async def get_records_async(start_date: datetime = None, end_date: datetime = None, category: str = None, limit: int = None):
+    """查询记录（异步版，供 async 路由使用）"""
+    try:
+        supabase = get_supabase_async_client()
+        query = supabase.table("records").select("*")
+
+        if start_date:
+            query = query.gte("created_at", to_utc_iso(start_date))
+        if end_date:
+            query = query.lt("created_at", to_utc_iso(end_date))
+        if category:
+            query = query.eq("category", category)
+
+        query = query.order("created_at", desc=True)
+        if limit:
+            query = query.limit(limit)
+        result = await query.execute()
+        return result.data
+    except Exception as e:
+        print(f"查询错误: {str(e)[:100]}")
+        return []
+
+
+SECONDS_PER_DAY = 86400
+
+
+class DailyRollup:
+    """按北京时间自然日汇总的金额/笔数及其前缀和。
+
+    days 为升序的本地日序号（local_ts // 86400），cum_amounts/cum_counts 比 days 多一位，
+    [start_day, end_day) 的合计为两次二分查找后的前缀和之差。
+    """
+
+    def __init__(self, local_ts, amounts):
+        days = array("q")
+        cum_amounts = array("d", [0.0])
+        cum_counts = array("q", [0])
+        # local_ts 按时间倒序，从尾部往前即为升序
+        for i in range(len(local_ts) - 1, -1, -1):
+            day = local_ts[i] // SECONDS_PER_DAY
+            if not days or days[-1] != day:
+                days.append(day)
+                cum_amounts.append(cum_amounts[-1])
+                cum_counts.append(cum_counts[-1])
+            cum_amounts[-1] += amounts[i]
+            cum_counts[-1] += 1
+        self.days = days
+        self.cum_amounts = cum_amounts
+        self.cum_counts = cum_counts
+
+    def totals(self, start_day: int, end_day: int) -> tuple:
+        """[start_day, end_day) 整日区间的 (金额, 笔数)"""
+        i = bisect_left(self.days, start_day)
+        j = max(i, bisect_left(self.days, end_day))
+        return self.cum_amounts[j] - self.cum_amounts[i], self.cum_counts[j] - self.cum_counts[i]
+
+
+class CategoryCube:
+    """按 (本地日, 分类 id) 汇总金额/笔数的稀疏立方体，另按 (本地日, 小时) 汇总供分时趋势使用。
+
+    随 RecordStore 的写入增量维护（修改先减旧值再加新值），查询时只遍历区间内有数据的日期。
+    """
+
+    GROUP_BY = ("category", "day", "month", "hour")
+
+    def __init__(self):
+        self.cells = {}   # 日序号 -> {分类 id: [金额, 笔数]}
+        self.hours = {}   # 日序号 -> {小时: [金额, 笔数]}
+        self.days = []    # 有数据的日序号（升序）
+        self.owned_days = None  # 副本已复制过的日期；None 表示全部归自己所有
+
+    def copy(self) -> "CategoryCube":
+        """写时复制：先共享全部数据，写入时才复制外层索引和被改到的那一天"""
+        other = CategoryCube()
+        other.cells = self.cells
+        other.hours = self.hours
+        other.days = self.days
+        other.owned_days = set()
+        return other
+
+    def _own(self, day: int):
+        """写入 day 前确保它不与其他副本共享"""
+        owned = self.owned_days
+        if owned is None or day in owned:
+            return
+        if not owned:
+            self.cells = dict(self.cells)
+            self.hours = dict(self.hours)
+            self.days = list(self.days)
+            owned.add(None)
+        if day in self.cells:
+            self.cells[day] = {k: list(v) for k, v in self.cells[day].items()}
+            self.hours[day] = {k: list(v) for k, v in self.hours[day].items()}
+        owned.add(day)
+
+    def add(self, local_ts: int, category_id: int, amount: float, count: int = 1):
+        """累加一条记录（count=-1 为撤销）"""
+        day, seconds = divmod(local_ts, SECONDS_PER_DAY)
+        self._own(day)
+        if day not in self.cells:
+            self.cells[day] = {}
+            self.hours[day] = {}
+            insort(self.days, day)
+        for cell, key in ((self.cells[day], category_id), (self.hours[day], seconds // 3600)):
+            totals = cell.setdefault(key, [0.0, 0])
+            totals[0] += amount
+            totals[1] += count
+            if totals[1] <= 0:
+                del cell[key]
+        if not self.cells[day]:
+            del self.cells[day]
+            del self.hours[day]
+            self.days.pop(bisect_left(self.days, day))
+
+    def sum(self, start_day: int = None, end_day: int = None, group_by: str = "category") -> dict:
+        """[start_day, end_day) 整日区间按维度汇总，返回 {键: [金额, 笔数]}。
+
+        键：category 为分类 id，day 为日序号，month 为 "YYYY-MM"，hour 为 0-23。
+        """
+        if group_by not in self.GROUP_BY:
+            raise ValueError(f"unsupported group_by: {group_by}")
+        i = bisect_left(self.days, start_day) if start_day is not None else 0
+        j = bisect_left(self.days, end_day) if end_day is not None else len(self.days)
+        result = {}
+        month_key = None
+        for day in self.days[i:j]:
+            if group_by == "category":
+                items = self.cells[day].items()
+            elif group_by == "hour":
+                items = self.hours[day].items()
+            else:
+                if group_by == "day":
+                    key = day
+                else:
+                    # 同一个月的日期连续出现，只在跨月时重新格式化
+                    if month_key is None or day >= month_end:
+                        month_start = from_local_ts(day * SECONDS_PER_DAY)
+                        month_key = month_start.strftime("%Y-%m")
+                        month_end = to_local_ts(add_months(month_start, 1)) // SECONDS_PER_DAY
+                    key = month_key
+                items = ((key, [sum(v[0] for v in self.cells[day].values()),
+                                sum(v[1] for v in self.cells[day].values())]),)
+            for key, (amount, count) in items:
+                totals = result.setdefault(key, [0.0, 0])
+                totals[0] += amount
+                totals[1] += count
+        return result
+
+
+class RecordStore:
+    """记录缓存的列式存储（按 created_at 倒序）。
+
+    时间戳、金额、分类在加载时一次性解析：local_ts 为北京时间墙钟的 epoch 秒，
+    amounts 为 float，分类驻留为整数 id；只有接口需要返回明细时才物化为 dict。
+    copy() 是写时复制的：各列在副本第一次写入时才复制，没改到的列与原 store 共享。
+    """
+
+    COLUMNS = ("ids", "local_ts", "amounts", "category_ids", "descriptions", "openids", "nicknames", "created_at")
+    SLOT_CHANGES_LIMIT = 4096  # slot 改动累计超过该数量时，下次 copy 合并成新的 slots
+
+    def __init__(self):
+        self.ids = array("q")
+        self.local_ts = array("q")
+        self.amounts = array("d")
+        self.category_ids = array("i")
+        self.categories = []          # 分类 id -> 分类名
+        self.category_index = {}      # 分类名 -> 分类 id
+        self.descriptions = []
+        self.openids = []
+        self.nicknames = []
+        self.created_at = []          # 原始 created_at 字符串，物化时原样返回
+        self.slots = {}               # 记录 id -> 下标 - base（见 position），可能与其他副本共享，只读
+        self.slot_changes = {}        # 本副本改动过的 slot（None 表示已删除），查找时优先
+        self.base = 0                 # 在最前面插入时 base 加一，已有记录的 slot 不用改
+        self.owned = set(self.COLUMNS)  # 归本副本所有、可以原地修改的列
+        self._rollup = None           # 按日前缀和，首次使用时构建，写入后失效
+        self.cube = CategoryCube()    # 分类 × 日汇总，随写入增量维护
+        self.fingerprint = 0          # 内容指纹：各行摘要的异或，随写入增量维护，与行顺序和加载方式无关
+
+    def __len__(self):
+        return len(self.ids)
+
+    def copy(self) -> "RecordStore":
+        """写时复制的副本：可在副本上合并后整体替换，原 store 不受影响（复制后不应再修改原 store）。
+
+        各列先共享，第一次写入时才复制；slots 共享，副本的改动记在 slot_changes；
+        CategoryCube 只复制被改到的日期。
+        """
+        other = RecordStore()
+        for name in self.COLUMNS:
+            setattr(other, name, getattr(self, name))
+        other.owned = set()
+        other.categories = list(self.categories)
+        other.category_index = dict(self.category_index)
+        if len(self.slot_changes) > self.SLOT_CHANGES_LIMIT:
+            slots = dict(self.slots)
+            slots.update(self.slot_changes)
+            for record_id, slot in self.slot_changes.items():
+                if slot is None:
+                    del slots[record_id]
+            other.slots = slots
+        else:
+            other.slots = self.slots
+            other.slot_changes = dict(self.slot_changes)
+        other.base = self.base
+        other.cube = self.cube.copy()
+        other.fingerprint = self.fingerprint
+        return other
+
+    def _own(self, name: str):
+        """写入前确保该列不与其他副本共享（array/list 切片即完整复制）"""
+        if name not in self.owned:
+            setattr(self, name, getattr(self, name)[:])
+            self.owned.add(name)
+
+    @property
+    def version(self) -> str:
+        """数据版本（条数 + 内容指纹）：内容不变时重新加载也保持不变，用于导出缓存等"""
+        return f"{len(self.ids)}-{self.fingerprint:08x}"
+
+    def _digest(self, pos: int) -> int:
+        """第 pos 行的摘要（id、时间、金额、分类、描述）"""
+        text = (f"{self.ids[pos]}|{self.local_ts[pos]}|{self.amounts[pos]!r}|"
+                f"{self.categories[self.category_ids[pos]]}|{self.descriptions[pos]}")
+        return zlib.crc32(text.encode("utf-8"))
+
+    def intern_category(self, category: str) -> int:
+        """分类名 -> 分类 id（不存在时新建）"""
+        category_id = self.category_index.get(category)
+        if category_id is None:
+            category_id = len(self.categories)
+            self.categories.append(category)
+            self.category_index[category] = category_id
+        return category_id
+
+    def _values(self, r: dict) -> tuple:
+        """把一条数据库记录解析为各列的值（顺序同 COLUMNS）"""
+        return (
+            int(r["id"]),
+            to_local_ts(to_local_datetime(r["created_at"])),
+            float(r.get("amount") or 0),
+            self.intern_category(r.get("category") or ""),
+            sys.intern(r.get("description") or ""),
+            sys.intern(r.get("openid") or ""),
+            sys.intern(r.get("nickname") or ""),
+            r["created_at"]
+        )
+
+    def _set(self, pos: int, values: tuple):
+        """写入第 pos 行（pos == len 时追加；覆盖时只复制值有变化的列）"""
+        self._rollup = None
+        if pos == len(self.ids):
+            for name, value in zip(self.COLUMNS, values):
+                self._own(name)
+                getattr(self, name).append(value)
+        else:
+            self.cube.add(self.local_ts[pos], self.category_ids[pos], -self.amounts[pos], -1)
+            self.fingerprint ^= self._digest(pos)
+            for name, value in zip(self.COLUMNS, values):
+                if getattr(self, name)[pos] != value:
+                    self._own(name)
+                    getattr(self, name)[pos] = value
+        self.cube.add(values[1], values[3], values[2])
+        self.fingerprint ^= self._digest(pos)
+        self.slot_changes[values[0]] = pos - self.base
+
+    def position(self, record_id: int):
+        """记录 id -> 当前下标（不存在时返回 None）"""
+        changes = self.slot_changes
+        slot = changes[record_id] if record_id in changes else self.slots.get(record_id)
+        return None if slot is None else slot + self.base
+
+    def _reindex(self, lo: int, hi: int):
+        """重写下标 [lo, hi) 各行的 slot"""
+        self.slot_changes.update(zip(self.ids[lo:hi], range(lo - self.base, hi - self.base)))
+
+    def _insert(self, values: tuple):
+        """按 (local_ts, id) 倒序二分插入一行。
+
+        插入点之后的行下标都加一：只改较短的一侧（插在前半段时 base 加一再修正前面的行），
+        新记账插在最前面时不需要改任何已有记录。
+        """
+        key = (values[1], values[0])
+        local_ts, ids = self.local_ts, self.ids
+        pos = bisect_desc(len(ids), lambda i: (local_ts[i], ids[i]), key)
+        self._rollup = None
+        for name, value in zip(self.COLUMNS, values):
+            self._own(name)
+            getattr(self, name).insert(pos, value)
+        self.cube.add(values[1], values[3], values[2])
+        self.fingerprint ^= self._digest(pos)
+        if pos <= len(self.ids) - 1 - pos:
+            self.base += 1
+            self._reindex(0, pos + 1)
+        else:
+            self._reindex(pos, len(self.ids))
+
+    def _delete(self, pos: int):
+        """删除第 pos 行（汇总由调用方扣减）；同样只修正较短一侧的 slot"""
+        self.slot_changes[self.ids[pos]] = None
+        for name in self.COLUMNS:
+            self._own(name)
+            del getattr(self, name)[pos]
+        self._rollup = None
+        if pos <= len(self.ids) - pos:
+            self.base -= 1
+            self._reindex(0, pos)
+        else:
+            self._reindex(pos, len(self.ids))
+
+    def extend(self, records: list):
+        """追加已按 created_at 倒序排列的记录（全量加载逐页调用）"""
+        for r in records:
+            self._set(len(self.ids), self._values(r))
+
+    def upsert(self, records: list):
+        """按 id 合并新增/修改的记录。
+
+        时间没变的修改原地覆盖；新增的记录二分插入到对应位置（新记账一般在最前面），
+        改了时间的记录先移除再插入，不需要整体重排。
+        """
+        latest = {}
+        for r in records:
+            latest[int(r["id"])] = r
+        inserts = []
+        for record_id, r in latest.items():
+            values = self._values(r)
+            pos = self.position(record_id)
+            if pos is not None and self.local_ts[pos] == values[1]:
+                self._set(pos, values)
+            else:
+                inserts.append(values)
+        if not inserts:
+            return
+        self.remove([values[0] for values in inserts])
+        for values in inserts:
+            self._insert(values)
+
+    def remove(self, record_ids: list):
+        """按 id 删除记录（同步扣减汇总），其余记录保持原有顺序"""
+        drop = sorted({pos for pos in map(self.position, map(int, record_ids)) if pos is not None})
+        if not drop:
+            return
+        for pos in drop:
+            self.cube.add(self.local_ts[pos], self.category_ids[pos], -self.amounts[pos], -1)
+            self.fingerprint ^= self._digest(pos)
+        if len(drop) <= 64:
+            # 少量删除（撤销、删最近几条）：逐行删除，从后往前删，前面的下标不受影响
+            for pos in reversed(drop):
+                self._delete(pos)
+            return
+        drop = set(drop)
+        self._reorder([i for i in range(len(self.ids)) if i not in drop])
+
+    def _reorder(self, order: list):
+        """按下标列表重排（或筛掉）各列"""
+        self.ids = array("q", (self.ids[i] for i in order))
+        self.local_ts = array("q", (self.local_ts[i] for i in order))
+        self.amounts = array("d", (self.amounts[i] for i in order))
+        self.category_ids = array("i", (self.category_ids[i] for i in order))
+        self.descriptions = [self.descriptions[i] for i in order]
+        self.openids = [self.openids[i] for i in order]
+        self.nicknames = [self.nicknames[i] for i in order]
+        self.created_at = [self.created_at[i] for i in order]
+        self.slots = {record_id: pos for pos, record_id in enumerate(self.ids)}
+        self.slot_changes = {}
+        self.base = 0
+        self.owned = set(self.COLUMNS)
+        self._rollup = None
+
+    def select(self, start_date: datetime = None, end_date: datetime = None) -> range:
+        """按北京时间筛选（左闭右开），返回下标区间；不传时间时返回全部。
+
+        local_ts 按时间倒序，区间内的记录必然连续，两次二分即可定位，不需要逐条扫描。
+        """
+        return self._slice(
+            to_local_ts(start_date) if start_date else None,
+            to_local_ts(end_date) if end_date else None
+        )
+
+    def _slice(self, start_ts: int = None, end_ts: int = None) -> range:
+        """[start_ts, end_ts) 对应的下标区间（本地 epoch 秒）"""
+        local_ts = self.local_ts
+        hi = len(local_ts)
+        if start_ts is not None:
+            hi = bisect_desc(len(local_ts), lambda i: local_ts[i], start_ts)
+        lo = 0
+        if end_ts is not None:
+            lo = bisect_desc(hi, lambda i: local_ts[i], end_ts)
+        return range(lo, hi)
+
+    def daily_rollup(self) -> DailyRollup:
+        """按日汇总的前缀和（同一份 store 发布后只读，构建一次后复用）"""
+        rollup = self._rollup
+        if rollup is None:
+            rollup = self._rollup = DailyRollup(self.local_ts, self.amounts)
+        return rollup
+
+    def totals(self, start_date: datetime = None, end_date: datetime = None) -> tuple:
+        """按北京时间区间（左闭右开）求 (金额, 笔数)。
+
+        中间的整日走按日前缀和，只有首尾不足一天的部分按下标切片求和。
+        """
+        if not len(self.ids):
+            return 0, 0
+        start_ts = to_local_ts(start_date) if start_date else self.local_ts[-1]
+        end_ts = to_local_ts(end_date) if end_date else self.local_ts[0] + 1
+        first_day = -(-start_ts // SECONDS_PER_DAY)
+        last_day = end_ts // SECONDS_PER_DAY
+        if first_day >= last_day:
+            indices = self._slice(start_ts, end_ts)
+            return self.total(indices), len(indices)
+        amount, count = self.daily_rollup().totals(first_day, last_day)
+        for indices in (self._slice(start_ts, first_day * SECONDS_PER_DAY),
+                        self._slice(last_day * SECONDS_PER_DAY, end_ts)):
+            amount += self.total(indices)
+            count += len(indices)
+        return amount, count
+
+    def total(self, indices) -> float:
+        """下标对应记录的金额合计（连续区间直接对切片求和）"""
+        amounts = self.amounts
+        if isinstance(indices, range) and indices.step == 1:
+            return sum(amounts[indices.start:indices.stop])
+        return sum(amounts[i] for i in indices)
+
+    def aggregate(self, start_date: datetime = None, end_date: datetime = None, group_by: str = "category") -> dict:
+        """按北京时间区间（左闭右开）和维度汇总，返回 {标签: [金额, 笔数]}。
+
+        整日部分查 CategoryCube，首尾不足一天的部分按下标切片逐条累加。标签：category 为分类名，
+        day 为 "YYYY-MM-DD"，month 为 "YYYY-MM"，hour 为 "HH:00"。
+        """
+        start_ts = to_local_ts(start_date) if start_date else None
+        end_ts = to_local_ts(end_date) if end_date else None
+        first_day = -(-start_ts // SECONDS_PER_DAY) if start_ts is not None else None
+        last_day = end_ts // SECONDS_PER_DAY if end_ts is not None else None
+        if first_day is not None and last_day is not None and first_day >= last_day:
+            totals, edges = {}, [self._slice(start_ts, end_ts)]
+        else:
+            totals = self.cube.sum(first_day, last_day, group_by)
+            edges = []
+            if start_ts is not None:
+                edges.append(self._slice(start_ts, first_day * SECONDS_PER_DAY))
+            if end_ts is not None:
+                edges.append(self._slice(last_day * SECONDS_PER_DAY, end_ts))
+        for indices in edges:
+            for i in indices:
+                if group_by == "category":
+                    key = self.category_ids[i]
+                elif group_by == "hour":
+                    key = self.local_ts[i] % SECONDS_PER_DAY // 3600
+                elif group_by == "day":
+                    key = self.local_ts[i] // SECONDS_PER_DAY
+                else:
+                    key = self.local_datetime(i).strftime("%Y-%m")
+                cell = totals.setdefault(key, [0.0, 0])
+                cell[0] += self.amounts[i]
+                cell[1] += 1
+        if group_by == "category":
+            return {self.categories[k]: v for k, v in totals.items()}
+        if group_by == "hour":
+            return {f"{k:02d}:00": v for k, v in totals.items()}
+        if group_by == "day":
+            return {from_local_ts(k * SECONDS_PER_DAY).strftime("%Y-%m-%d"): v for k, v in totals.items()}
+        return totals
+
+    def order_by_recent(self, categories, start_date: datetime = None, end_date: datetime = None) -> list:
+        """把区间内出现过的 categories 按最近一次使用排序（同逐条倒序遍历时首次出现的顺序）。
+
+        按日期从新到旧跳过，只有 CategoryCube 显示当天有尚未排到的分类时才逐条扫描当天的记录。
+        """
+        remaining = {self.category_index[c] for c in categories if c in self.category_index}
+        indices = self.select(start_date, end_date)
+        ordered = []
+        pos = indices.start
+        while remaining and pos < indices.stop:
+            day = self.local_ts[pos] // SECONDS_PER_DAY
+            stop = min(indices.stop, self._slice(day * SECONDS_PER_DAY).stop)
+            if remaining & self.cube.cells.get(day, {}).keys():
+                for i in range(pos, stop):
+                    category_id = self.category_ids[i]
+                    if category_id in remaining:
+                        remaining.discard(category_id)
+                        ordered.append(self.categories[category_id])
+            pos = stop
+        return ordered
+
+    def category(self, i: int) -> str:
+        return self.categories[self.category_ids[i]]
+
+    def local_datetime(self, i: int) -> datetime:
+        """第 i 条记录的北京时间（秒级）"""
+        return from_local_ts(self.local_ts[i])
+
+    def row(self, i: int) -> dict:
+        """物化第 i 条记录为 dict（字段与数据库行一致）"""
+        return {
+            "id": self.ids[i],
+            "openid": self.openids[i],
+            "nickname": self.nicknames[i],
+            "amount": self.amounts[i],
+            "category": self.categories[self.category_ids[i]],
+            "description": self.descriptions[i],
+            "created_at": self.created_at[i]
+        }
+
+    def rows(self, indices: list = None) -> list:
+        """物化多条记录；不传下标时返回全部"""
+        if indices is None:
+            indices = range(len(self.ids))
+        return [self.row(i) for i in indices]
+
+
+def iter_all_records_pages(page_size: int = None, start_date: datetime = None, end_date: datetime = None):
+    """按 (created_at, id) 倒序键集分页读取 records 表（可限定 created_at 区间），逐页产出（不受单次查询行数上限影响）"""
+    page_size = page_size or RECORDS_PAGE_SIZE
+    supabase = get_supabase_client()
+    cursor = None
+    while True:
+        query = (
+            supabase.table("records")
+            .select("*")
+            .order("created_at", desc=True)
+            .order("id", desc=True)
+            .limit(page_size)
+        )
+        if start_date:
+            query = query.gte("created_at", to_utc_iso(start_date))
+        if end_date:
+            query = query.lt("created_at", to_utc_iso(end_date))
+        if cursor:
+            created_at, record_id = cursor
+            query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{record_id})')
+        page = query.execute().data
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        cursor = (page[-1]["created_at"], page[-1]["id"])
+
+
+def get_records_cached(force_refresh: bool = False) -> "RecordStore":
+    """获取所有记录的列式存储（带缓存，用于管理后台统计）。
+
+    缓存过期后只增量拉取 id/updated_at 水位之后的记录并合并；每 RECORDS_FULL_SYNC_INTERVAL 秒
+    全量对账一次以发现删除。force_refresh=True 时强制全量重新加载。
+    """
     now = int(time.time())
     if force_refresh:
         RECORDS_CACHE["expires_at"] = 0
-    if not force_refresh and RECORDS_CACHE["value"] and now < RECORDS_CACHE["expires_at"]:
-        print(f"使用缓存: {len(RECORDS_CACHE['value'])} 条记录")
-        return RECORDS_CACHE["value"]
+    if not force_refresh and RECORDS_CACHE["store"] is not None and now < RECORDS_CACHE["expires_at"]:
+        print(f"使用缓存: {len(RECORDS_CACHE['store'])} 条记录")
+        return RECORDS_CACHE["store"]
+    # 并发请求同时遇到缓存过期时只加载一次，其余等待后直接使用新缓存
+    with RECORDS_CACHE_LOCK:
+        if not force_refresh and RECORDS_CACHE["store"] is not None and int(time.time()) < RECORDS_CACHE["expires_at"]:
+            return RECORDS_CACHE["store"]
+        full = (
+            force_refresh
+            or RECORDS_CACHE["store"] is None
+            or RECORDS_CACHE["full_sync_required"]
+            or now - RECORDS_CACHE["full_sync_at"] >= RECORDS_FULL_SYNC_INTERVAL
+        )
+        if not full:
+            try:
+                return _sync_records_cache_delta(now)
+            except Exception as e:
+                print(f"增量同步失败，改为全量加载: {str(e)[:100]}")
+        return _load_records_cache(now)
+
+
+def _update_records_watermarks(records: list):
+    """根据记录更新 id / updated_at 水位"""
+    for r in records:
+        if r.get("id") is not None and r["id"] > RECORDS_CACHE["max_id"]:
+            RECORDS_CACHE["max_id"] = r["id"]
+        updated_at = r.get("updated_at") or ""
+        if updated_at > RECORDS_CACHE["updated_at"]:
+            RECORDS_CACHE["updated_at"] = updated_at
+
+
+def _sync_records_cache_delta(now: int):
+    """增量同步：拉取新增（id 大于水位）与修改（updated_at 不早于水位）的记录，按 id 合并进缓存"""
+    generation = RECORDS_CACHE["generation"]
+    supabase = get_supabase_client()
+    since = ""
+    if RECORDS_CACHE["updated_at"]:
+        since = to_utc_iso(to_local_datetime(RECORDS_CACHE["updated_at"]) - timedelta(seconds=RECORDS_DELTA_OVERLAP))
+    changed = []
+    last_id = 0
+    # 按 id 键集分页，变更量再大也不会被单次查询上限截断
+    while True:
+        query = supabase.table("records").select("*").order("id").limit(RECORDS_PAGE_SIZE)
+        if since:
+            query = query.or_(f'id.gt.{RECORDS_CACHE["max_id"]},updated_at.gte."{since}"').gt("id", last_id)
+        else:
+            query = query.gt("id", max(last_id, RECORDS_CACHE["max_id"]))
+        page = query.execute().data
+        changed.extend(page)
+        if len(page) < RECORDS_PAGE_SIZE:
+            break
+        last_id = page[-1]["id"]
+    if changed:
+        # 复制后合并再替换，避免其他线程读取到合并中的数据
+        store = RECORDS_CACHE["store"].copy()
+        store.upsert(changed)
+        RECORDS_CACHE["store"] = store
+        _update_records_watermarks(changed)
+        RECORDS_CACHE["count"] = len(store)
+    print(f"增量同步: {len(changed)} 条新增/修改记录")
+    # 同步期间有写入失效了缓存时保持过期，下次读取再同步一次
+    if RECORDS_CACHE["generation"] == generation:
+        RECORDS_CACHE["expires_at"] = now + RECORDS_CACHE_TTL
+    return RECORDS_CACHE["store"]
+
+
+def _load_records_cache(now: int):
+    """从数据库全量加载记录缓存（键集分页读完整张表，逐页转为列式；调用方持有 RECORDS_CACHE_LOCK）"""
+    generation = RECORDS_CACHE["generation"]
+    # 加载期间的删除会重新置位，加载完成后仍需全量对账
+    RECORDS_CACHE["full_sync_required"] = False
     try:
         print("缓存过期或为空，从数据库加载...")
-        supabase = get_supabase_client()
-        query = supabase.table("records").select("*").order("created_at", desc=True).limit(max_records)
-        result = query.execute()
-        records = result.data
-        print(f"从数据库加载了 {len(records)} 条记录")
+        store = RecordStore()
+        RECORDS_CACHE["max_id"] = 0
+        RECORDS_CACHE["updated_at"] = ""
+        pages = 0
+        for page in iter_all_records_pages():
+            store.extend(page)
+            _update_records_watermarks(page)
+            pages += 1
+        print(f"从数据库加载了 {len(store)} 条记录（{pages} 页）")
         # 更新缓存
-        RECORDS_CACHE["value"] = records
-        RECORDS_CACHE["expires_at"] = now + RECORDS_CACHE_TTL
-        RECORDS_CACHE["count"] = len(records)
-        return records
+        RECORDS_CACHE["store"] = store
+        RECORDS_CACHE["count"] = len(store)
+        RECORDS_CACHE["full_sync_at"] = now
+        # 加载期间有写入失效了缓存（读到的可能是写入前的数据）时保持过期，下次读取再同步
+        if RECORDS_CACHE["generation"] == generation:
+            RECORDS_CACHE["expires_at"] = now + RECORDS_CACHE_TTL
+        else:
+            print("加载期间记录有变动，缓存保持过期状态")
+        return store
     except Exception as e:
         import traceback
+        RECORDS_CACHE["full_sync_required"] = True
         print(f"缓存查询错误: {traceback.format_exc()}")
         # 如果有旧缓存，返回旧缓存
-        if RECORDS_CACHE["value"]:
-            print(f"使用旧缓存: {len(RECORDS_CACHE['value'])} 条记录")
-            return RECORDS_CACHE["value"]
-        return []
+        if RECORDS_CACHE["store"] is not None:
+            print(f"使用旧缓存: {len(RECORDS_CACHE['store'])} 条记录")
+            return RECORDS_CACHE["store"]
+        return RecordStore()
+
+
+async def get_records_cached_async(force_refresh: bool = False) -> "RecordStore":
+    """get_records_cached 的 async 入口：缓存有效时直接返回，需要加载时放到线程池执行，不阻塞事件循环"""
+    now = int(time.time())
+    if not force_refresh and RECORDS_CACHE["store"] is not None and now < RECORDS_CACHE["expires_at"]:
+        return RECORDS_CACHE["store"]
+    return await run_in_threadpool(get_records_cached, force_refresh)
+
 
+def apply_records_to_cache(rows: list = None, deleted_ids: list = None):
+    """写穿：把写操作返回的行（return=representation）直接合并进记录缓存及其汇总，失败时退回 invalidate_records_cache。
+
+    不推进 id/updated_at 水位，这些行下次增量同步会被再取一次（按 id 合并，幂等），避免漏掉其他写入。
+    """
+    if RECORDS_CACHE["store"] is None or not (rows or deleted_ids):
+        return
+    # 正在加载/同步时不等待，交给下次同步
+    if not RECORDS_CACHE_LOCK.acquire(blocking=False):
+        invalidate_records_cache(full=bool(deleted_ids))
+        return
+    try:
+        # 复制后合并再替换，读者不会看到写了一半的缓存
+        store = RECORDS_CACHE["store"].copy()
+        if deleted_ids:
+            store.remove(deleted_ids)
+        if rows:
+            store.upsert(rows)
+        RECORDS_CACHE["store"] = store
+        RECORDS_CACHE["count"] = len(store)
+    except Exception as e:
+        print(f"写穿缓存失败，改为清除缓存: {str(e)[:100]}")
+        invalidate_records_cache(full=True)
+    finally:
+        RECORDS_CACHE_LOCK.release()
 
-def invalidate_records_cache():
-    """清除记录缓存（记录变动后调用）"""
+
+def invalidate_records_cache(full: bool = False):
+    """清除记录缓存（记录变动后调用）。新增/修改只需增量同步；有删除时传 full=True 触发全量对账。"""
+    RECORDS_CACHE["generation"] += 1
     RECORDS_CACHE["expires_at"] = 0
+    # 表中没有 updated_at 列（水位为空）时无法增量发现修改，只能全量
+    if full or not RECORDS_CACHE["updated_at"]:
+        RECORDS_CACHE["full_sync_required"] = True
+
+
+def bisect_desc(n: int, key_at, value) -> int:
+    """在按 key 倒序排列的前 n 个元素中二分，返回第一个 key < value 的下标"""
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < value:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
 
 
 def filter_records_by_local_range(records: list, start_date: datetime, end_date: datetime) -> list:
-    """按北京时间过滤记录（左闭右开）"""
-    filtered = []
-    for r in records:
-        dt = to_local_datetime(r["created_at"])
-        if start_date <= dt < end_date:
-            filtered.append(r)
-    return filtered
+    """按北京时间过滤记录（左闭右开）。
+
+    records 须按 created_at 倒序（get_records 等查询均如此），区间两端二分定位后直接切片，
+    只需解析 O(log n) 个时间戳。
+    """
+    key_at = lambda i: to_local_datetime(records[i]["created_at"])
+    hi = bisect_desc(len(records), key_at, start_date)
+    lo = bisect_desc(hi, key_at, end_date)
+    return records[lo:hi]
 
 
 def get_records_by_keyword(start_date: datetime = None, end_date: datetime = None, keyword: str = "", limit: int = None):
@@ -360,7 +1443,24 @@ def get_records_by_user(openid: str, limit: int = 1):
 
 
 def get_statistics(start_date: datetime = None, end_date: datetime = None):
-    """获取统计数据（所有人共同）"""
+    """获取统计数据（所有人共同）。优先由数据库函数 ledger_stats 在服务端汇总，函数不存在时拉取明细在本地汇总"""
+    stats = call_optional_rpc("ledger_stats", {
+        "start_at": to_utc_iso(start_date) if start_date else None,
+        "end_at": to_utc_iso(end_date) if end_date else None
+    })
+    if stats is not None:
+        return {
+            "total": float(stats.get("total") or 0),
+            "by_category": {cat: float(amount) for cat, amount in (stats.get("by_category") or {}).items()},
+            "count": int(stats.get("count") or 0),
+            "max_record": stats.get("max_record"),
+            "latest_record": stats.get("latest_record")
+        }
+    return get_statistics_local(start_date, end_date)
+
+
+def get_statistics_local(start_date: datetime = None, end_date: datetime = None):
+    """本地汇总统计数据（ledger_stats 不可用时的回退）"""
     fetch_start = start_date - timedelta(days=1) if start_date else None
     fetch_end = end_date + timedelta(days=1) if end_date else None
     records = get_records(fetch_start, fetch_end)
@@ -394,6 +1494,21 @@ def to_local_datetime(value: str) -> datetime:
     return dt.astimezone(LOCAL_TZ)
 
 
+LOCAL_EPOCH = datetime(1970, 1, 1)
+
+
+def to_local_ts(dt: datetime) -> int:
+    """时间转为北京时间墙钟的 epoch 秒（// 86400 即本地日序号）"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=LOCAL_TZ)
+    return (dt.astimezone(LOCAL_TZ).replace(tzinfo=None) - LOCAL_EPOCH) // timedelta(seconds=1)
+
+
+def from_local_ts(ts: int) -> datetime:
+    """北京时间墙钟 epoch 秒转回带时区的 datetime"""
+    return (LOCAL_EPOCH + timedelta(seconds=ts)).replace(tzinfo=LOCAL_TZ)
+
+
 def to_utc_iso(dt: datetime) -> str:
     """将时间转为 UTC ISO 字符串"""
     if dt.tzinfo is None:
@@ -449,7 +1564,7 @@ def update_record(record_id: int, amount: float, category: str, description: str
         "description": description
     }
     result = supabase.table("records").update(data).eq("id", record_id).execute()
-    invalidate_records_cache()  # 清除缓存
+    apply_records_to_cache(result.data)  # 写穿缓存
     return result
 
 
@@ -457,7 +1572,15 @@ def delete_record(record_id: int):
     """删除记账记录"""
     supabase = get_supabase_client()
     result = supabase.table("records").delete().eq("id", record_id).execute()
-    invalidate_records_cache()  # 清除缓存
+    apply_records_to_cache(deleted_ids=[record_id])  # 删除无法增量发现，直接从缓存移除
+    return result
+
+
+def delete_records(record_ids: list):
+    """批量删除记账记录：一次请求，缓存里一次移除"""
+    supabase = get_supabase_client()
+    result = supabase.table("records").delete().in_("id", record_ids).execute()
+    apply_records_to_cache(deleted_ids=list(record_ids))  # 删除无法增量发现，直接从缓存移除
     return result
 
 
@@ -510,7 +1633,8 @@ def restore_deleted_record(deleted_by: str, index: int):
         "description": record.get("description", ""),
         "created_at": record.get("created_at", "")
     }
-    supabase.table("records").insert(insert_data).execute()
+    result = supabase.table("records").insert(insert_data).execute()
+    apply_records_to_cache(result.data)
     supabase.table("records_deleted").delete().eq("id", record["id"]).execute()
     return {"restored": record}
 
@@ -575,8 +1699,7 @@ def archive_old_records():
         for date_key, amount in totals_by_date.items():
             add_daily_total(date_key, amount)
 
-        for r in records:
-            delete_record(r["id"])
+        delete_records([r["id"] for r in records])
 
         return len(records)
     except Exception as e:
@@ -737,34 +1860,221 @@ def list_subscribers(report_type: str):
         return []
 
 
-def is_duplicate_message(msg_id: str) -> bool:
-    """检查消息是否已处理（使用内存缓存，避免数据库查询延迟）"""
-    if not msg_id:
-        return False
-    now = time.time()
-    # 检查内存缓存
-    if msg_id in MSG_DEDUP_CACHE:
+# ============ 会话状态存储 ============
+class MemoryStateStore:
+    """进程内状态存储：每个命名空间一个按写入先后排列的 OrderedDict，过期/超量从最旧一端淘汰"""
+
+    def __init__(self):
+        self._data = {}    # namespace -> OrderedDict(key -> (expires_at, value))
+        self._stats = {}   # namespace -> {"expired": n, "evicted": n}
+        self._lock = threading.Lock()
+
+    def _namespace(self, namespace: str) -> OrderedDict:
+        entries = self._data.get(namespace)
+        if entries is None:
+            entries = self._data[namespace] = OrderedDict()
+            self._stats[namespace] = {"expired": 0, "evicted": 0}
+        return entries
+
+    def _live(self, namespace: str, key: str, now: float):
+        """返回未过期的 (expires_at, value)；已过期的顺手删除"""
+        entries = self._namespace(namespace)
+        entry = entries.get(key)
+        if entry is not None and entry[0] <= now:
+            del entries[key]
+            self._stats[namespace]["expired"] += 1
+            entry = None
+        return entry
+
+    def _put(self, namespace: str, key: str, value, ttl: float, max_size: int, now: float):
+        entries = self._namespace(namespace)
+        entries[key] = (now + ttl, value)
+        entries.move_to_end(key)
+        stats = self._stats[namespace]
+        # 同一命名空间 TTL 相同，最旧的最先过期
+        while entries and next(iter(entries.values()))[0] <= now:
+            entries.popitem(last=False)
+            stats["expired"] += 1
+        while max_size and len(entries) > max_size:
+            entries.popitem(last=False)
+            stats["evicted"] += 1
+
+    def get(self, namespace: str, key: str):
+        with self._lock:
+            entry = self._live(namespace, key, time.time())
+            return entry[1] if entry is not None else None
+
+    def set(self, namespace: str, key: str, value, ttl: float, max_size: int = 0) -> None:
+        with self._lock:
+            self._put(namespace, key, value, ttl, max_size, time.time())
+
+    def add(self, namespace: str, key: str, value, ttl: float, max_size: int = 0) -> bool:
+        """仅在不存在（或已过期）时写入，返回是否写入"""
+        with self._lock:
+            now = time.time()
+            if self._live(namespace, key, now) is not None:
+                return False
+            self._put(namespace, key, value, ttl, max_size, now)
+            return True
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._namespace(namespace).pop(key, None)
+
+    def stats(self, namespace: str) -> dict:
+        with self._lock:
+            entries = self._namespace(namespace)
+            return {"backend": "memory", "size": len(entries), **self._stats[namespace]}
+
+
+class SqliteStateStore:
+    """SQLite 状态存储：同一台机器上的多个 worker 进程共享；值以 JSON 保存，过期由 expires_at 判断并定期清理"""
+
+    PURGE_EVERY = 64  # 每写入多少次清理一次过期/超量数据
+
+    def __init__(self, path: str):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._max_sizes = {}
+        self._stats = {}
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (namespace, expires_at)")
+
+    def _conn(self):
+        """每个线程一个连接（自动提交，写锁冲突时最多等待 5 秒）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, namespace: str, field: str, n: int) -> None:
+        if n > 0:
+            with self._lock:
+                stats = self._stats.setdefault(namespace, {"expired": 0, "evicted": 0})
+                stats[field] += n
+
+    def _after_write(self, namespace: str, max_size: int) -> None:
+        with self._lock:
+            if max_size:
+                self._max_sizes[namespace] = max_size
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY:
+                return
+            max_sizes = dict(self._max_sizes)
+        self.purge(max_sizes)
+
+    def purge(self, max_sizes: dict = None) -> None:
+        """删除过期数据；超出容量的命名空间删除最早过期的部分"""
+        conn = self._conn()
+        now = time.time()
+        expired = conn.execute(
+            "SELECT namespace, COUNT(*) FROM state WHERE expires_at <= ? GROUP BY namespace", (now,)
+        ).fetchall()
+        conn.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+        for namespace, count in expired:
+            self._count(namespace, "expired", count)
+        for namespace, max_size in (max_sizes or {}).items():
+            cursor = conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key IN ("
+                "SELECT key FROM state WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (namespace, namespace, max_size)
+            )
+            self._count(namespace, "evicted", cursor.rowcount)
+
+    def get(self, namespace: str, key: str):
+        row = self._conn().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value, ttl: float, max_size: int = 0) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+        )
+        self._after_write(namespace, max_size)
+
+    def add(self, namespace: str, key: str, value, ttl: float, max_size: int = 0) -> bool:
+        """仅在不存在（或已过期）时写入，返回是否写入；单条语句完成，多进程并发时只有一个成功"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE state.expires_at <= ?",
+            (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+        )
+        if cursor.rowcount != 1:
+            return False
+        self._after_write(namespace, max_size)
         return True
-    return False
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._conn().execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def stats(self, namespace: str) -> dict:
+        size = self._conn().execute(
+            "SELECT COUNT(*) FROM state WHERE namespace = ? AND expires_at > ?", (namespace, time.time())
+        ).fetchone()[0]
+        with self._lock:
+            stats = dict(self._stats.get(namespace, {"expired": 0, "evicted": 0}))
+        return {"backend": "sqlite", "size": size, **stats}
+
+
+def get_state_store():
+    """会话状态存储（首次使用时按 STATE_BACKEND 创建；SQLite 打开失败时退回内存）"""
+    store = STATE_STORE["value"]
+    if store is None:
+        with STATE_STORE_LOCK:
+            store = STATE_STORE["value"]
+            if store is None:
+                if STATE_BACKEND == "sqlite":
+                    try:
+                        store = SqliteStateStore(STATE_SQLITE_PATH)
+                    except Exception as e:
+                        print(f"状态存储 SQLite 打开失败，改用内存: {str(e)[:100]}")
+                if store is None:
+                    store = MemoryStateStore()
+                STATE_STORE["value"] = store
+    return store
 
 
-def record_message_id(msg_id: str) -> None:
-    """记录消息 ID 用于去重（使用内存缓存）"""
+def claim_message_id(msg_id: str) -> bool:
+    """记录消息 ID 用于去重；已处理过（未超过 MSG_DEDUP_TTL）返回 False。检查与记录是一次原子操作，多 worker 下同一条消息只处理一次"""
     if not msg_id:
-        return
-    now = time.time()
-    MSG_DEDUP_CACHE[msg_id] = now
-    # 清理过期和超量的消息ID
-    if len(MSG_DEDUP_CACHE) > MSG_DEDUP_MAX_SIZE:
-        # 删除过期的
-        expired = [k for k, v in MSG_DEDUP_CACHE.items() if now - v > MSG_DEDUP_TTL]
-        for k in expired:
-            MSG_DEDUP_CACHE.pop(k, None)
-        # 如果还是太多，删除最老的
-        if len(MSG_DEDUP_CACHE) > MSG_DEDUP_MAX_SIZE:
-            sorted_items = sorted(MSG_DEDUP_CACHE.items(), key=lambda x: x[1])
-            for k, _ in sorted_items[:len(MSG_DEDUP_CACHE) - MSG_DEDUP_MAX_SIZE // 2]:
-                MSG_DEDUP_CACHE.pop(k, None)
+        return True
+    claimed = get_state_store().add(STATE_DEDUP, msg_id, 1, MSG_DEDUP_TTL, MSG_DEDUP_MAX_SIZE)
+    MSG_DEDUP_STATS["misses" if claimed else "hits"] += 1
+    return claimed
+
+
+def get_dedup_stats() -> dict:
+    """消息去重统计（用于监控）"""
+    stats = get_state_store().stats(STATE_DEDUP)
+    lookups = MSG_DEDUP_STATS["hits"] + MSG_DEDUP_STATS["misses"]
+    return {
+        "backend": stats["backend"],
+        "size": stats["size"],
+        "max_size": MSG_DEDUP_MAX_SIZE,
+        "ttl": MSG_DEDUP_TTL,
+        "hits": MSG_DEDUP_STATS["hits"],
+        "misses": MSG_DEDUP_STATS["misses"],
+        "expired": stats["expired"],
+        "evicted": stats["evicted"],
+        "hit_rate": round(MSG_DEDUP_STATS["hits"] / lookups, 4) if lookups else 0
+    }
 
 
 # ============ 消息解析 ============
@@ -783,6 +2093,10 @@ def get_category_aliases() -> dict:
                 category = str(row.get("category", "")).strip()
                 if keyword and category:
                     aliases[keyword] = category
+        # 队列中尚未写入数据库的别名以内存为准
+        with ALIAS_WRITE_LOCK:
+            for keyword, row in ALIAS_WRITE_QUEUE.items():
+                aliases[keyword] = row["category"]
         CATEGORY_ALIAS_CACHE["value"] = aliases
         CATEGORY_ALIAS_CACHE["expires_at"] = now + ALIAS_CACHE_TTL
         return aliases
@@ -801,29 +2115,60 @@ def add_category_alias(keyword: str, category: str) -> bool:
     if CATEGORY_ALIAS_CACHE["value"]:
         CATEGORY_ALIAS_CACHE["value"][keyword] = category
     
-    # 异步写入数据库（不阻塞响应）
+    # 放入写入队列，由后台批量写入数据库（不阻塞响应）
+    enqueue_alias_write({
+        "keyword": keyword,
+        "category": category,
+        "enabled": True,
+        "updated_at": datetime.now(LOCAL_TZ).isoformat()
+    })
+    return True
+
+
+def enqueue_alias_write(row: dict):
+    """别名写入排队：同一关键词只保留最新一次，积压到 ALIAS_FLUSH_BATCH 条或等待 ALIAS_FLUSH_INTERVAL 秒后批量写入"""
+    with ALIAS_WRITE_LOCK:
+        ALIAS_WRITE_QUEUE[row["keyword"]] = row
+        full = len(ALIAS_WRITE_QUEUE) >= ALIAS_FLUSH_BATCH
+    schedule_alias_flush(0 if full else ALIAS_FLUSH_INTERVAL)
+
+
+def schedule_alias_flush(delay: float):
+    """安排一次后台写入；已有待执行的计划时不重复安排（delay=0 时提前执行）"""
+    with ALIAS_WRITE_LOCK:
+        timer = ALIAS_WRITE_TIMER["value"]
+        if timer is not None and timer.is_alive():
+            if delay > 0:
+                return
+            timer.cancel()
+        timer = threading.Timer(delay, flush_alias_writes)
+        timer.daemon = True
+        ALIAS_WRITE_TIMER["value"] = timer
+        timer.start()
+
+
+def flush_alias_writes() -> int:
+    """把队列中的别名一次性 upsert 到 category_aliases（on_conflict=keyword），返回写入条数；失败时放回队列稍后重试"""
+    with ALIAS_WRITE_LOCK:
+        rows = list(ALIAS_WRITE_QUEUE.values())
+        ALIAS_WRITE_QUEUE.clear()
+        timer = ALIAS_WRITE_TIMER["value"]
+        ALIAS_WRITE_TIMER["value"] = None
+    if timer is not None:
+        timer.cancel()
+    if not rows:
+        return 0
     try:
-        supabase = get_supabase_client()
-        existing = supabase.table("category_aliases").select("keyword").eq("keyword", keyword).limit(1).execute()
-        now = datetime.now(LOCAL_TZ).isoformat()
-        if existing.data:
-            supabase.table("category_aliases").update({
-                "category": category,
-                "enabled": True,
-                "updated_at": now
-            }).eq("keyword", keyword).execute()
-        else:
-            supabase.table("category_aliases").insert({
-                "keyword": keyword,
-                "category": category,
-                "enabled": True,
-                "created_at": now,
-                "updated_at": now
-            }).execute()
-        return True
-    except Exception:
-        # 数据库写入失败不影响，内存缓存已更新
-        return True
+        get_supabase_client().table("category_aliases").upsert(rows, on_conflict="keyword").execute()
+        return len(rows)
+    except Exception as e:
+        print(f"别名批量写入错误: {str(e)[:100]}")
+        # 放回队列（期间又有新值的关键词以新值为准）
+        with ALIAS_WRITE_LOCK:
+            for row in rows:
+                ALIAS_WRITE_QUEUE.setdefault(row["keyword"], row)
+        schedule_alias_flush(ALIAS_FLUSH_INTERVAL)
+        return 0
 
 
 def parse_category(text: str) -> str:
@@ -841,15 +2186,35 @@ def match_alias_category(text: str) -> str:
     matched = aliases.get(text_lower, "")
     if not matched:
         return ""
-    # 验证目标分类仍然存在于用户的分类列表中（防止别名指向已删除/不存在的分类如「购物」「交通」）
-    all_cats = get_all_categories()
-    for cat in all_cats:
-        if cat == matched or cat.startswith(matched + "|") or matched.startswith(cat + "|"):
-            return matched
+    # 验证目标分类仍然存在于用户的分类列表中（防止别名指向已删除/不存在的分类如「购物」「交通」）：
+    # 与某分类相同、是某分类的上级，或是某分类的下级
+    index = get_category_index()
+    if matched in index["exact"] or matched in index["ancestors"]:
+        return matched
+    if any(ancestor in index["exact"] for ancestor in category_ancestors(matched)):
+        return matched
     # 目标分类不存在，视为无效别名
     return ""
 
 
+def category_ancestors(path: str) -> list:
+    """分类路径的所有上级路径：正餐|午餐|外卖 -> [正餐, 正餐|午餐]"""
+    return [path[:i] for i, ch in enumerate(path) if ch == "|"]
+
+
+def get_category_index() -> dict:
+    """分类索引（exact：全部分类；ancestors：各分类的所有上级路径），随 CATEGORY_LIST_CACHE 刷新重建"""
+    categories = get_all_categories()
+    index = CATEGORY_LIST_CACHE["index"]
+    if index is None or index["source"] is not categories:
+        ancestors = set()
+        for cat in categories:
+            ancestors.update(category_ancestors(cat))
+        index = {"source": categories, "exact": set(categories), "ancestors": ancestors}
+        CATEGORY_LIST_CACHE["index"] = index
+    return index
+
+
 def get_category_candidates() -> list:
     """可选分类列表（仅来自数据库/预设，不再使用内置关键词）"""
     categories = get_all_categories()
@@ -872,16 +2237,36 @@ def build_category_pick_prompt(description: str, amount: float, categories: list
     return "\n".join(lines)
 
 
+# 记账文本语法（模块加载时预编译，按顺序尝试）
+RECORD_UNIT_SPACED_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(块钱|块|元|rmb|RMB)\s*')
+RECORD_UNIT_RE = re.compile(r'(\d+(?:\.\d+)?)(块钱|块|元|rmb|RMB)(?=\D|$)')
+RECORD_UNIT_CHARS = ("块", "元", "rmb", "RMB")
+RECORD_HAS_DIGIT_RE = re.compile(r'\d')
+RECORD_NUMBER_RE = re.compile(r'^\d+(?:\.\d+)?$')
+RECORD_EXPLICIT_RE = re.compile(r'^(\S+)\s+(.+?)\s+(\d+(?:\.\d+)?)\s*$')
+RECORD_DESC_AMOUNT_NOTE_RE = re.compile(r'^(.+?)\s+(\d+(?:\.\d+)?)\s*(.*)$')
+RECORD_SIMPLE_RE = re.compile(r'^(\S+)\s+(\d+(?:\.\d+)?)\s*$')
+RECORD_AMOUNT_DESC_RE = re.compile(r'^(\d+(?:\.\d+)?)\s+(.+)$')
+RECORD_QTY_RE = re.compile(r'^(\S+)[\*\sxX](\d+)\s+(\d+(?:\.\d+)?)$')
+RECORD_NO_SPACE_DESC_AMOUNT_RE = re.compile(r'^(.+?)(\d+(?:\.\d+)?)\s*$')
+RECORD_NO_SPACE_AMOUNT_DESC_RE = re.compile(r'^(\d+(?:\.\d+)?)(.+)$')
+
+
 def parse_record_text(text: str) -> dict:
     """解析记账文本，支持多种写法：早餐8块、15块咖啡、打车 22、买菜 30 西红柿 等"""
     text = text.strip()
+    # 每种写法都需要金额，没有数字直接返回
+    if not RECORD_HAS_DIGIT_RE.search(text):
+        return {"type": "unknown"}
     # 先统一去掉金额后的 块/元/块钱（保留数字）
-    text_norm = re.sub(r'(\d+(?:\.\d+)?)\s*(块钱|块|元|rmb|RMB)\s*', r'\1 ', text)
-    text_norm = re.sub(r'(\d+(?:\.\d+)?)(块钱|块|元|rmb|RMB)(?=\D|$)', r'\1', text_norm)
+    text_norm = text
+    if any(unit in text for unit in RECORD_UNIT_CHARS):
+        text_norm = RECORD_UNIT_SPACED_RE.sub(r'\1 ', text_norm)
+        text_norm = RECORD_UNIT_RE.sub(r'\1', text_norm)
     text_norm = text_norm.strip()
 
     # 分类 描述 金额（三部分，手动分类）
-    explicit_match = re.match(r'^(\S+)\s+(.+?)\s+(\d+(?:\.\d+)?)\s*$', text_norm)
+    explicit_match = RECORD_EXPLICIT_RE.match(text_norm)
     if explicit_match:
         category, desc, amount = explicit_match.groups()
         return {
@@ -893,13 +2278,13 @@ def parse_record_text(text: str) -> dict:
         }
 
     # 描述 金额 [备注]（如：买菜 30 西红柿）
-    desc_amount_note = re.match(r'^(.+?)\s+(\d+(?:\.\d+)?)\s*(.*)$', text_norm)
+    desc_amount_note = RECORD_DESC_AMOUNT_NOTE_RE.match(text_norm)
     if desc_amount_note:
         desc, amount, extra = desc_amount_note.groups()
         desc = desc.strip()
         extra = extra.strip()
         amount = float(amount)
-        if desc and not re.match(r'^\d+(?:\.\d+)?$', desc):  # 描述不是纯数字
+        if desc and not RECORD_NUMBER_RE.match(desc):  # 描述不是纯数字
             description = (desc + " " + extra) if extra else desc
             return {
                 "type": "record",
@@ -910,7 +2295,7 @@ def parse_record_text(text: str) -> dict:
             }
 
     # 描述 金额（两段，无备注）
-    simple_match = re.match(r'^(\S+)\s+(\d+(?:\.\d+)?)\s*$', text_norm)
+    simple_match = RECORD_SIMPLE_RE.match(text_norm)
     if simple_match:
         desc, amount = simple_match.groups()
         return {
@@ -922,7 +2307,7 @@ def parse_record_text(text: str) -> dict:
         }
 
     # 金额 描述（如：15 咖啡、8块 早餐）
-    amount_desc = re.match(r'^(\d+(?:\.\d+)?)\s+(.+)$', text_norm)
+    amount_desc = RECORD_AMOUNT_DESC_RE.match(text_norm)
     if amount_desc:
         amount, desc = amount_desc.groups()
         return {
@@ -934,7 +2319,7 @@ def parse_record_text(text: str) -> dict:
         }
 
     # 描述*数量 金额
-    qty_match = re.match(r'^(\S+)[\*\sxX](\d+)\s+(\d+(?:\.\d+)?)$', text_norm)
+    qty_match = RECORD_QTY_RE.match(text_norm)
     if qty_match:
         desc, qty, amount = qty_match.groups()
         total = float(qty) * float(amount)
@@ -947,10 +2332,10 @@ def parse_record_text(text: str) -> dict:
         }
 
     # 无空格：描述+金额 或 金额+描述（如 早餐8、15咖啡）
-    no_space_desc_amount = re.match(r'^(.+?)(\d+(?:\.\d+)?)\s*$', text_norm)
+    no_space_desc_amount = RECORD_NO_SPACE_DESC_AMOUNT_RE.match(text_norm)
     if no_space_desc_amount:
         desc, amount = no_space_desc_amount.groups()
-        if desc and not re.match(r'^\d+(?:\.\d+)?$', desc):
+        if desc and not RECORD_NUMBER_RE.match(desc):
             return {
                 "type": "record",
                 "amount": float(amount),
@@ -958,7 +2343,7 @@ def parse_record_text(text: str) -> dict:
                 "category": desc.strip(),
                 "explicit_category": False
             }
-    no_space_amount_desc = re.match(r'^(\d+(?:\.\d+)?)(.+)$', text_norm)
+    no_space_amount_desc = RECORD_NO_SPACE_AMOUNT_DESC_RE.match(text_norm)
     if no_space_amount_desc:
         amount, desc = no_space_amount_desc.groups()
         if desc.strip():
@@ -973,201 +2358,266 @@ def parse_record_text(text: str) -> dict:
     return {"type": "unknown"}
 
 
-def parse_message(content: str) -> dict:
-    """解析用户消息"""
-    import re
-    content = content.strip()
-    
-    # 查询命令
-    if content in ["今日", "今天"]:
-        return {"type": "query", "period": "today"}
-    if content in ["昨日", "昨天"]:
-        return {"type": "query", "period": "yesterday"}
-    if content in ["七天", "近七天"]:
-        return {"type": "query", "period": "7days"}
-    if content in ["半个月", "十五天", "近半个月"]:
-        return {"type": "query", "period": "15days"}
-    if content in ["一个月", "近一个月", "30天"]:
-        return {"type": "query", "period": "30days"}
-    if content in ["本周", "这周"]:
-        return {"type": "query", "period": "week"}
-    if content in ["本月", "这个月"]:
-        return {"type": "query", "period": "month"}
-    if content in ["明细", "详情", "记录"]:
-        return {"type": "detail", "period": "today"}
-    if content.startswith("明细 "):
-        return {"type": "detail", "period": content.split(maxsplit=1)[1].strip()}
-    if content in ["帮助", "help", "?"]:
-        return {"type": "help"}
-    if content in ["网页", "管理", "后台", "管理后台"]:
-        return {"type": "admin_url"}
-    if content in ["面板", "统计面板"]:
-        return {"type": "dashboard"}
-    if content in ["确认删", "确认删除"]:
-        return {"type": "record_delete_confirm"}
-    if content in ["取消删", "取消删除"]:
-        return {"type": "record_delete_cancel"}
-    if content in ["上次", "最近"]:
-        return {"type": "last_record"}
-    if content in ["撤销", "撤销上一条"]:
-        return {"type": "undo_last"}
-    if content == "统计":
-        return {"type": "query", "period": "7days"}
-
-    # 导出
-    export_excel_match = re.match(r'^(导出excel|导出Excel|导出表格)\s*(.*)$', content)
-    if export_excel_match:
-        target = export_excel_match.group(2)
-        return {"type": "export", "target": target.strip() if target else ""}
-
-    export_match = re.match(r'^导出\s*(.*)$', content)
-    if export_match:
-        target = export_match.group(1)
-        return {"type": "export", "target": target.strip() if target else ""}
-
-    # 快捷记账
-    if content.startswith("+"):
-        parsed = parse_record_text(content[1:].strip())
-        if parsed["type"] == "record":
-            return parsed
-        return {"type": "unknown"}
+# ============ 消息命令分发（模块加载时构建）============
+def build_exact_commands() -> dict:
+    """整条消息即命令的关键词 -> 解析结果"""
+    groups = [
+        (["今日", "今天"], {"type": "query", "period": "today"}),
+        (["昨日", "昨天"], {"type": "query", "period": "yesterday"}),
+        (["七天", "近七天", "统计"], {"type": "query", "period": "7days"}),
+        (["半个月", "十五天", "近半个月"], {"type": "query", "period": "15days"}),
+        (["一个月", "近一个月", "30天"], {"type": "query", "period": "30days"}),
+        (["本周", "这周"], {"type": "query", "period": "week"}),
+        (["本月", "这个月"], {"type": "query", "period": "month"}),
+        (["明细", "详情", "记录"], {"type": "detail", "period": "today"}),
+        (["帮助", "help", "?"], {"type": "help"}),
+        (["网页", "管理", "后台", "管理后台"], {"type": "admin_url"}),
+        (["面板", "统计面板"], {"type": "dashboard"}),
+        (["确认删", "确认删除"], {"type": "record_delete_confirm"}),
+        (["取消删", "取消删除"], {"type": "record_delete_cancel"}),
+        (["上次", "最近"], {"type": "last_record"}),
+        (["撤销", "撤销上一条"], {"type": "undo_last"}),
+        (["回收站"], {"type": "deleted_list"}),
+        (["分类列表", "所有分类", "查看分类"], {"type": "category_list"}),
+        (["查询外债"], {"type": "debt_query_all"}),
+    ]
+    commands = {}
+    for keywords, result in groups:
+        for keyword in keywords:
+            commands[keyword] = result
+    # 周报/月报订阅
+    for action in ["订阅周报", "订阅月报", "取消周报", "取消月报", "周报", "月报"]:
+        commands[action] = {"type": "report", "action": action}
+    return commands
 
-    # 记一笔 分类 [金额] [备注]（如：记一笔 早餐、记一笔 打车 22、记一笔 买菜 30 西红柿）
-    jiyibi_match = re.match(r'^记一笔\s+(\S+)(?:\s+(\d+(?:\.\d+)?))?\s*(.*)$', content)
-    if jiyibi_match:
-        category_part = jiyibi_match.group(1).strip()
-        amount_part = jiyibi_match.group(2)
-        note_part = (jiyibi_match.group(3) or "").strip()
-        if amount_part:
-            amount = float(amount_part)
-            description = (category_part + " " + note_part).strip() if note_part else category_part
-            return {
-                "type": "record",
-                "amount": amount,
-                "description": description,
-                "category": category_part,
-                "explicit_category": False
-            }
-        return {"type": "record_need_amount", "category": category_part}
-
-    # 补记（昨天/日期）
-    backfill_match = re.match(r'^补记\s+(\S+)\s+(.+)$', content)
-    if backfill_match:
-        date_token = backfill_match.group(1).strip()
-        rest = backfill_match.group(2).strip()
-        parsed = parse_record_text(rest)
-        if parsed["type"] == "record":
-            return {
-                "type": "record_backfill",
-                "date_token": date_token,
-                "amount": parsed["amount"],
-                "description": parsed["description"],
-                "category": parsed["category"]
-            }
-        return {"type": "unknown"}
 
-    # 记录修改/删除
-    edit_match = re.match(r'^(改|修改)\s+(\d+)\s+(.+)$', content)
-    if edit_match:
-        index = int(edit_match.group(2))
-        rest = edit_match.group(3).strip()
-        parsed = parse_record_text(rest)
-        if parsed["type"] == "record":
-            return {
-                "type": "record_edit",
-                "index": index,
-                "amount": parsed["amount"],
-                "description": parsed["description"],
-                "category": parsed["category"]
-            }
-        return {"type": "unknown"}
+EXACT_COMMANDS = build_exact_commands()
 
-    delete_match = re.match(r'^(删|删除)\s*(.+)$', content)
-    if delete_match:
-        return {"type": "record_delete", "raw": delete_match.group(2).strip()}
+# 「统计 xxx」中的时间段
+STATS_PERIODS = {
+    "今日": "today",
+    "今天": "today",
+    "昨天": "yesterday",
+    "昨日": "yesterday",
+    "七天": "7days",
+    "近七天": "7days",
+    "半个月": "15days",
+    "十五天": "15days",
+    "近半个月": "15days",
+    "一个月": "30days",
+    "近一个月": "30days",
+    "本周": "week",
+    "本月": "month"
+}
 
-    if content == "回收站":
-        return {"type": "deleted_list"}
 
-    restore_match = re.match(r'^恢复\s+(\d+)$', content)
-    if restore_match:
-        return {"type": "restore_deleted", "index": int(restore_match.group(1))}
+def _cmd_detail(match, content):
+    return {"type": "detail", "period": content.split(maxsplit=1)[1].strip()}
 
-    # 周报/月报订阅
-    if content in ["订阅周报", "订阅月报", "取消周报", "取消月报", "周报", "月报"]:
-        return {"type": "report", "action": content}
 
-    learn_match = re.match(r'^纠错\s+(\S+)\s+(\S+)$', content)
-    if learn_match:
-        keyword, category = learn_match.groups()
-        return {"type": "category_learn", "keyword": keyword.strip(), "category": category.strip()}
+def _cmd_export(match, content):
+    target = match.group(match.lastindex)
+    return {"type": "export", "target": target.strip() if target else ""}
+
+
+def _cmd_quick_record(match, content):
+    parsed = parse_record_text(content[1:].strip())
+    if parsed["type"] == "record":
+        return parsed
+    return {"type": "unknown"}
+
+
+def _cmd_jiyibi(match, content):
+    """记一笔 分类 [金额] [备注]（如：记一笔 早餐、记一笔 打车 22、记一笔 买菜 30 西红柿）"""
+    category_part = match.group(1).strip()
+    amount_part = match.group(2)
+    note_part = (match.group(3) or "").strip()
+    if amount_part:
+        amount = float(amount_part)
+        description = (category_part + " " + note_part).strip() if note_part else category_part
+        return {
+            "type": "record",
+            "amount": amount,
+            "description": description,
+            "category": category_part,
+            "explicit_category": False
+        }
+    return {"type": "record_need_amount", "category": category_part}
+
+
+def _cmd_backfill(match, content):
+    """补记（昨天/日期）"""
+    date_token = match.group(1).strip()
+    rest = match.group(2).strip()
+    parsed = parse_record_text(rest)
+    if parsed["type"] == "record":
+        return {
+            "type": "record_backfill",
+            "date_token": date_token,
+            "amount": parsed["amount"],
+            "description": parsed["description"],
+            "category": parsed["category"]
+        }
+    return {"type": "unknown"}
+
+
+def _cmd_edit(match, content):
+    index = int(match.group(2))
+    rest = match.group(3).strip()
+    parsed = parse_record_text(rest)
+    if parsed["type"] == "record":
+        return {
+            "type": "record_edit",
+            "index": index,
+            "amount": parsed["amount"],
+            "description": parsed["description"],
+            "category": parsed["category"]
+        }
+    return {"type": "unknown"}
+
+
+def _cmd_delete(match, content):
+    return {"type": "record_delete", "raw": match.group(2).strip()}
+
+
+def _cmd_restore(match, content):
+    return {"type": "restore_deleted", "index": int(match.group(1))}
+
+
+def _cmd_learn(match, content):
+    keyword, category = match.groups()
+    return {"type": "category_learn", "keyword": keyword.strip(), "category": category.strip()}
+
+
+def _cmd_rename(match, content):
+    old_name, new_name = match.groups()
+    return {"type": "category_rename", "old_name": old_name.strip(), "new_name": new_name.strip()}
+
+
+def _cmd_debt_add(match, content):
+    name, amount, note = match.groups()
+    return {"type": "debt_add", "name": name, "amount": float(amount), "note": note.strip()}
+
+
+def _cmd_debt_repay(match, content):
+    name, amount = match.groups()
+    return {"type": "debt_repay", "name": name, "amount": float(amount)}
+
+
+def _cmd_category_query(match, content):
+    return {"type": "query_category", "category": content.split(maxsplit=1)[1].strip()}
+
+
+def _cmd_stats(match, content):
+    target = content.split(maxsplit=1)[1].strip()
+    if target in STATS_PERIODS:
+        return {"type": "query", "period": STATS_PERIODS[target]}
+    month_range = parse_month_token(target)
+    if month_range:
+        start_date, end_date, label = month_range
+        return {"type": "query_month", "start_date": start_date, "end_date": end_date, "label": label}
+    return {"type": "query_category", "category": target}
+
+
+def _cmd_month_stats(match, content):
+    """xx月统计；不是月份时返回 None，继续按分类/记账解析"""
+    month_range = parse_month_token(content.replace("统计", "").strip())
+    if month_range:
+        start_date, end_date, label = month_range
+        return {"type": "query_month", "start_date": start_date, "end_date": end_date, "label": label}
+    return None
+
+
+# 带参数的命令，按优先级排列：(可能的首字符, 预编译正则, 处理函数)。首字符为空表示任意开头；
+# 处理函数返回 None 时继续尝试后面的规则
+MESSAGE_RULES = [
+    ("明", re.compile(r'^明细 '), _cmd_detail),
+    ("导", re.compile(r'^(导出excel|导出Excel|导出表格)\s*(.*)$'), _cmd_export),
+    ("导", re.compile(r'^导出\s*(.*)$'), _cmd_export),
+    ("+", re.compile(r'^\+'), _cmd_quick_record),
+    ("记", re.compile(r'^记一笔\s+(\S+)(?:\s+(\d+(?:\.\d+)?))?\s*(.*)$'), _cmd_jiyibi),
+    ("补", re.compile(r'^补记\s+(\S+)\s+(.+)$'), _cmd_backfill),
+    ("改修", re.compile(r'^(改|修改)\s+(\d+)\s+(.+)$'), _cmd_edit),
+    ("删", re.compile(r'^(删|删除)\s*(.+)$'), _cmd_delete),
+    ("恢", re.compile(r'^恢复\s+(\d+)$'), _cmd_restore),
+    ("纠", re.compile(r'^纠错\s+(\S+)\s+(\S+)$'), _cmd_learn),
+    ("重", re.compile(r'^重命名分类\s+(\S+)\s+(\S+)$'), _cmd_rename),
+    ("欠", re.compile(r'^欠\s+(\S+)\s+(\d+(?:\.\d+)?)\s*(.*)$'), _cmd_debt_add),
+    ("还", re.compile(r'^还\s+(\S+)\s+(\d+(?:\.\d+)?)$'), _cmd_debt_repay),
+    ("分", re.compile(r'^分类 '), _cmd_category_query),
+    ("统", re.compile(r'^统计 '), _cmd_stats),
+    ("", re.compile(r'统计$'), _cmd_month_stats),
+]
+# 按首字符预先筛好规则，记账等普通消息不必逐条尝试所有命令正则
+MESSAGE_RULES_BY_CHAR = {
+    ch: [(pattern, handler) for chars, pattern, handler in MESSAGE_RULES if not chars or ch in chars]
+    for chars, _, _ in MESSAGE_RULES for ch in chars
+}
+MESSAGE_RULES_ANY_CHAR = [(pattern, handler) for chars, pattern, handler in MESSAGE_RULES if not chars]
+
+
+def parse_message(content: str) -> dict:
+    """解析用户消息：整条命令查表，带参数的命令按首字符分发到预编译正则，其余按分类名/记账解析"""
+    content = content.strip()
+
+    command = EXACT_COMMANDS.get(content)
+    if command is not None:
+        return dict(command)
+
+    rules = MESSAGE_RULES_BY_CHAR.get(content[:1], MESSAGE_RULES_ANY_CHAR)
+    for pattern, handler in rules:
+        match = pattern.search(content)
+        if match:
+            parsed = handler(match, content)
+            if parsed is not None:
+                return parsed
 
-    # 分类管理
-    if content in ["分类列表", "所有分类", "查看分类"]:
-        return {"type": "category_list"}
-    
-    rename_match = re.match(r'^重命名分类\s+(\S+)\s+(\S+)$', content)
-    if rename_match:
-        old_name, new_name = rename_match.groups()
-        return {"type": "category_rename", "old_name": old_name.strip(), "new_name": new_name.strip()}
-
-    # 外债相关（我欠别人）
-    debt_add_match = re.match(r'^欠\s+(\S+)\s+(\d+(?:\.\d+)?)\s*(.*)$', content)
-    if debt_add_match:
-        name, amount, note = debt_add_match.groups()
-        return {"type": "debt_add", "name": name, "amount": float(amount), "note": note.strip()}
-
-    debt_repay_match = re.match(r'^还\s+(\S+)\s+(\d+(?:\.\d+)?)$', content)
-    if debt_repay_match:
-        name, amount = debt_repay_match.groups()
-        return {"type": "debt_repay", "name": name, "amount": float(amount)}
-
-    debt_query_match = re.match(r'^查询外债$', content)
-    if debt_query_match:
-        return {"type": "debt_query_all"}
-
-    # 自定义分类查询
-    if content.startswith("分类 "):
-        return {"type": "query_category", "category": content.split(maxsplit=1)[1].strip()}
-    if content.startswith("统计 "):
-        target = content.split(maxsplit=1)[1].strip()
-        if target in ["今日", "今天", "昨天", "昨日", "七天", "近七天", "半个月", "十五天", "近半个月", "一个月", "近一个月", "本周", "本月"]:
-            mapping = {
-                "今日": "today",
-                "今天": "today",
-                "昨天": "yesterday",
-                "昨日": "yesterday",
-                "七天": "7days",
-                "近七天": "7days",
-                "半个月": "15days",
-                "十五天": "15days",
-                "近半个月": "15days",
-                "一个月": "30days",
-                "近一个月": "30days",
-                "本周": "week",
-                "本月": "month"
-            }
-            return {"type": "query", "period": mapping[target]}
-        month_range = parse_month_token(target)
-        if month_range:
-            start_date, end_date, label = month_range
-            return {"type": "query_month", "start_date": start_date, "end_date": end_date, "label": label}
-        return {"type": "query_category", "category": target}
-
-    if content.endswith("统计"):
-        month_token = content.replace("统计", "").strip()
-        month_range = parse_month_token(month_token)
-        if month_range:
-            start_date, end_date, label = month_range
-            return {"type": "query_month", "start_date": start_date, "end_date": end_date, "label": label}
-    
     # 分类查询：仅识别用户已有分类名（记录+预设）
-    for category in get_all_categories():
-        if content.strip() == category:
-            return {"type": "query_category", "category": category}
+    if content in get_category_index()["exact"]:
+        return {"type": "query_category", "category": content}
     return parse_record_text(content)
 
 
+def split_batch_lines(content: str) -> list:
+    """批量记账：按换行/分号拆成多行（去掉「批量」字样与空行）"""
+    raw = content.replace("批量", "").strip()
+    raw = raw.replace("；", "\n").replace(";", "\n")
+    return [l.strip() for l in raw.splitlines() if l.strip()]
+
+
+DELETE_INDEX_RE = re.compile(r'\d+\s*-\s*\d+|\d+')
+DELETE_PERIOD_TOKENS = ["今天", "今日", "昨天", "昨日", "本周", "本月"]
+
+
+def parse_delete_indices(raw: str) -> list:
+    """解析删除编号（支持 2、1,3,5、1-4），返回去重排序后的编号"""
+    raw = normalize_dash(raw)
+    raw = raw.replace("，", ",")
+    indices = []
+    for part in DELETE_INDEX_RE.findall(raw):
+        part = part.replace(" ", "")
+        if "-" in part:
+            start, end = part.split("-", 1)
+            if start.isdigit() and end.isdigit():
+                s = int(start)
+                e = int(end)
+                if s <= e:
+                    indices.extend(list(range(s, e + 1)))
+        elif part.isdigit():
+            indices.append(int(part))
+    return sorted(set(indices))
+
+
+def parse_delete_target(raw: str):
+    """解析「删」后面的内容：可选时间段（默认今天）+ 编号，返回 (时间段, 编号列表)"""
+    tokens = raw.split()
+    period_token = "今天"
+    if tokens and tokens[0] in DELETE_PERIOD_TOKENS or ("-" in tokens[0]):
+        period_token = tokens[0]
+        raw = " ".join(tokens[1:]).strip()
+    return period_token, parse_delete_indices(raw)
+
+
 def get_date_range(period: str):
     """获取日期范围"""
     now = datetime.now(LOCAL_TZ)
@@ -1297,11 +2747,59 @@ def build_export_link(openid: str, period: str) -> str:
     return f"{PUBLIC_BASE_URL}/api/export?openid={openid}&period={period}&ts={ts}&sig={sig}"
 
 
-def build_report_text(period_key: str, label: str) -> str:
-    """生成统计文本"""
+def aggregate_report_stats(records: list) -> tuple:
+    """一次遍历同时汇总全体和每个 openid 的统计（结构同 get_statistics_local），返回 (全体, {openid: 个人})。
+
+    records 须按 created_at 倒序，每组第一条即最新记录。
+    """
+    overall = {"total": 0.0, "by_category": {}, "count": 0, "max_record": None, "latest_record": None}
+    per_user = {}
+    for r in records:
+        amount = float(r["amount"])
+        category = r["category"]
+        user = per_user.get(r["openid"])
+        if user is None:
+            user = {"total": 0.0, "by_category": {}, "count": 0, "max_record": None, "latest_record": r}
+            per_user[r["openid"]] = user
+        for stats in (overall, user):
+            stats["total"] += amount
+            stats["by_category"][category] = stats["by_category"].get(category, 0) + amount
+            stats["count"] += 1
+            if stats["max_record"] is None or amount > float(stats["max_record"]["amount"]):
+                stats["max_record"] = r
+    if records:
+        overall["latest_record"] = records[0]
+    return overall, per_user
+
+
+def format_personal_statistics(stats: dict, overall_total: float) -> str:
+    """格式化个人部分（附在共同统计之后）"""
+    if not stats or stats["count"] == 0:
+        return "👤 我的支出：暂无记录"
+    share = stats["total"] / overall_total * 100 if overall_total else 0
+    lines = [f"👤 我的支出：{stats['total']:.2f} 元，{stats['count']} 笔（占 {share:.0f}%）"]
+    for cat, amount in sorted(stats["by_category"].items(), key=lambda x: -x[1])[:3]:
+        lines.append(f"  {cat} {amount:.2f}")
+    return "\n".join(lines)
+
+
+def build_report_texts(period_key: str, label: str, openids: list) -> dict:
+    """生成每个订阅者的统计文本 {openid: 文本}：区间明细只查询一次（超过单页上限时按键集分页），
+    一次遍历汇总全体与个人，共同部分只渲染一次，查询次数与订阅人数无关"""
+    if not openids:
+        return {}
     start_date, end_date = get_date_range(period_key)
-    stats = get_statistics(start_date=start_date, end_date=end_date)
-    return format_statistics(stats, label, start_date, end_date)
+    records = []
+    for page in iter_all_records_pages(start_date=start_date, end_date=end_date):
+        records.extend(page)
+    overall, per_user = aggregate_report_stats(records)
+    shared = format_statistics(overall, label, start_date, end_date)
+    if overall["count"] == 0:
+        return {openid: shared for openid in openids}
+    return {
+        openid: f"{shared}\n\n{format_personal_statistics(per_user.get(openid), overall['total'])}"
+        for openid in openids
+    }
 
 
 def verify_export_signature(openid: str, period: str, ts: str, sig: str) -> bool:
@@ -1318,130 +2816,478 @@ def verify_export_signature(openid: str, period: str, ts: str, sig: str) -> bool
     return hmac.compare_digest(expected, sig)
 
 
-def build_export_excel_bytes(records: list, start_date: datetime, end_date: datetime, limit: int = 1000) -> bytes:
-    """导出 Excel（二进制）"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "汇总"
+def write_export_workbook(records: list, start_date: datetime, end_date: datetime, limit: int, target) -> None:
+    """导出 Excel 写入 target（文件路径或二进制流）：只写模式逐行写出，写入时即设置样式，不在内存中保留整个工作簿"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+    from openpyxl.styles.fonts import DEFAULT_FONT
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("汇总")
+    ws_detail = wb.create_sheet("明细")
+
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill("solid", fgColor="4F81BD")
+    center_align = Alignment(horizontal="center", vertical="center")
+    bold_font = Font(bold=True)
+    border = Border(
+        left=Side(style="thin", color="D9D9D9"),
+        right=Side(style="thin", color="D9D9D9"),
+        top=Side(style="thin", color="D9D9D9"),
+        bottom=Side(style="thin", color="D9D9D9")
+    )
+
+    def header_row(sheet, values):
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(sheet, value)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = center_align
+            cell.border = border
+            cells.append(cell)
+        return cells
+
+    def summary_row(values, font=None, bordered=True):
+        """汇总表数据行：第 2 列数字保留两位小数"""
+        cells = []
+        for column, value in enumerate(values, 1):
+            cell = WriteOnlyCell(ws, value)
+            if font is not None:
+                cell.font = font
+            if bordered:
+                cell.border = border
+            if column == 2 and isinstance(value, (int, float)):
+                cell.number_format = "0.00"
+            cells.append(cell)
+        return cells
+
+    # 本地时间只换算一次，汇总与明细共用
+    records = records[:limit]
+    local_times = [to_local_datetime(r["created_at"]) for r in records]
+
+    # 期间与类目统计
+    total_amount = 0
+    category_totals = {}
+    daily_totals = {}
+    for r, dt in zip(records, local_times):
+        day_key = f"{dt.month}.{dt.day}"
+        category = r["category"]
+        amount = float(r["amount"])
+        total_amount += amount
+        category_totals[category] = category_totals.get(category, 0) + amount
+        daily_totals[day_key] = daily_totals.get(day_key, 0) + amount
+
+    ws.freeze_panes = "A5"
+    ws.column_dimensions["A"].width = 16
+    ws.column_dimensions["B"].width = 16
+    ws.column_dimensions["C"].width = 12
+    ws.append(summary_row(["统计区间", f"{start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}"], bold_font, False))
+    ws.append(summary_row(["记录数", len(records)], bold_font, False))
+    ws.append(summary_row(["总支出", round(total_amount, 2)], bold_font, False))
+    ws.append([])
+
+    ws.append(summary_row(["类目统计"]))
+    ws.append(header_row(ws, ["类目", "金额", "占比"]))
+    for cat, amount in sorted(category_totals.items(), key=lambda x: -x[1]):
+        percent = (amount / total_amount * 100) if total_amount else 0
+        ws.append(summary_row([cat, round(amount, 2), f"{percent:.1f}%"]))
+
+    ws.append([])
+    ws.append(summary_row(["每日合计"]))
+    ws.append(header_row(ws, ["日期", "金额", None]))
+    for day, amount in sorted(daily_totals.items()):
+        ws.append(summary_row([day, round(amount, 2)]))
+
+    # 明细表
+    ws_detail.freeze_panes = "A2"
+    ws_detail.column_dimensions["A"].width = 10
+    ws_detail.column_dimensions["B"].width = 14
+    ws_detail.column_dimensions["C"].width = 10
+    ws_detail.column_dimensions["D"].width = 30
+    ws_detail.column_dimensions["E"].width = 12
+    ws_detail.column_dimensions["F"].width = 12
+    ws_detail.append(header_row(ws_detail, ["ID", "日期", "时间", "描述", "金额", "分类"]))
+
+    # 明细单元格数量大，用命名样式按名称套用，避免每个单元格重复登记边框样式
+    wb.add_named_style(NamedStyle(name="明细", font=DEFAULT_FONT, border=border))
+    wb.add_named_style(NamedStyle(name="明细金额", font=DEFAULT_FONT, border=border, number_format="0.00"))
+    for r, dt in zip(records, local_times):
+        row = []
+        for column, value in enumerate((
+            r["id"],
+            dt.strftime("%Y-%m-%d"),
+            dt.strftime("%H:%M"),
+            r["description"],
+            float(r["amount"]),
+            r["category"]
+        ), 1):
+            if value is None:
+                row.append(None)
+                continue
+            cell = WriteOnlyCell(ws_detail, value)
+            cell.style = "明细金额" if column == 5 else "明细"
+            row.append(cell)
+        ws_detail.append(row)
+
+    wb.save(target)
+
+
+def build_export_excel_bytes(records: list, start_date: datetime, end_date: datetime, limit: int = 1000) -> bytes:
+    """导出 Excel（二进制）"""
+    bio = io.BytesIO()
+    write_export_workbook(records, start_date, end_date, limit, bio)
+    return bio.getvalue()
+
+
+def iter_export_file(path: str):
+    """分块读取导出文件用于流式响应"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def export_row_values(record: dict) -> list:
+    """明细行（与 Excel 明细表列一致）：ID、日期、时间、描述、金额、分类"""
+    dt = to_local_datetime(record["created_at"])
+    return [
+        record["id"],
+        dt.strftime("%Y-%m-%d"),
+        dt.strftime("%H:%M"),
+        record["description"],
+        float(record["amount"]),
+        record["category"]
+    ]
+
+
+def export_records_digest(records: list) -> str:
+    """明细内容摘要（导出任务复用判断用）：任一行的导出列有变化摘要就不同"""
+    crc = 0
+    for record in records:
+        crc = zlib.crc32(json.dumps(export_row_values(record), ensure_ascii=False).encode("utf-8"), crc)
+    return f"{crc:08x}"
+
+
+def load_export_records(start_date: datetime, end_date: datetime) -> list:
+    """按北京时间区间（左闭右开）读取导出用记录：键集分页读完整个区间，不受单次查询行数上限截断"""
+    records = []
+    for page in iter_all_records_pages(start_date=start_date - timedelta(days=1), end_date=end_date + timedelta(days=1)):
+        records.extend(page)
+    return filter_records_by_local_range(records, start_date, end_date)
+
+
+def iter_export_csv(records):
+    """逐行生成 CSV（带 BOM，Excel 可直接打开中文），每 EXPORT_ROWS_PER_CHUNK 行输出一次"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(["ID", "日期", "时间", "描述", "金额", "分类"])
+    for count, record in enumerate(records, 1):
+        writer.writerow(export_row_values(record))
+        if count % EXPORT_ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def iter_export_ndjson_gz(records):
+    """逐行生成 gzip 压缩的 NDJSON（每行一条记录），边压缩边输出"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    lines = []
+    for record in records:
+        record_id, date_text, time_text, description, amount, category = export_row_values(record)
+        lines.append(json.dumps({
+            "id": record_id,
+            "created_at": record["created_at"],
+            "date": date_text,
+            "time": time_text,
+            "description": description,
+            "amount": amount,
+            "category": category
+        }, ensure_ascii=False))
+        if len(lines) >= EXPORT_ROWS_PER_CHUNK:
+            chunk = compressor.compress(("\n".join(lines) + "\n").encode("utf-8"))
+            lines = []
+            if chunk:
+                yield chunk
+    if lines:
+        yield compressor.compress(("\n".join(lines) + "\n").encode("utf-8"))
+    yield compressor.flush()
+
+
+def write_export_file(records, export_format: str, start_date: datetime, end_date: datetime, limit: int, path: str) -> None:
+    """按格式把记录写入导出文件（xlsx 只取前 limit 条，csv/ndjson.gz 不限条数）"""
+    if export_format == "xlsx":
+        write_export_workbook(records, start_date, end_date, limit, path)
+        return
+    chunks = iter_export_csv(records) if export_format == "csv" else iter_export_ndjson_gz(records)
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+# ============ 导出任务 ============
+def get_export_executor() -> ThreadPoolExecutor:
+    """导出任务线程池（首次使用时创建）"""
+    executor = EXPORT_EXECUTOR["value"]
+    if executor is None:
+        with EXPORT_EXECUTOR_LOCK:
+            executor = EXPORT_EXECUTOR["value"]
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+                EXPORT_EXECUTOR["value"] = executor
+    return executor
+
+
+def export_job_paths(job_id: str) -> tuple:
+    """导出任务的 (文件路径, 元信息路径)"""
+    return os.path.join(EXPORT_CACHE_DIR, job_id), os.path.join(EXPORT_CACHE_DIR, f"{job_id}.json")
+
+
+def load_cached_export_job(job_id: str):
+    """从磁盘恢复已完成的任务（本进程重启过或由其他 worker 生成）；不存在或已过期时返回 None"""
+    path, meta_path = export_job_paths(job_id)
+    try:
+        if time.time() - os.path.getmtime(path) > EXPORT_CACHE_TTL:
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        return {
+            "job_id": job_id,
+            "status": "done",
+            "filename": meta["filename"],
+            "media_type": meta["media_type"],
+            "path": path,
+            "size": os.path.getsize(path),
+            "error": "",
+            "future": None,
+            "scope": meta.get("scope", "admin"),
+            "created_at": meta.get("created_at", 0),
+            "finished_at": meta.get("finished_at", 0)
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_export_job(job_id: str):
+    """按 job_id 查找任务（内存中没有时查磁盘缓存）"""
+    if not EXPORT_JOB_ID_RE.match(job_id or ""):
+        return None
+    with EXPORT_JOBS_LOCK:
+        job = EXPORT_JOBS.get(job_id)
+        if job is not None and (job["status"] != "done" or os.path.exists(job["path"])):
+            return job
+    return load_cached_export_job(job_id)
+
+
+def submit_export_job(key: dict, filename: str, export_format: str, write, scope: str = "admin") -> dict:
+    """提交导出任务：key 相同（含数据版本）时复用进行中的任务或已缓存的文件；write(path) 负责生成文件。
+
+    scope 决定查询和下载任务时的校验方式："admin" 需要管理员 token，"link" 需要带签名的链接（见 authorize_export_job）。
+    """
+    payload = json.dumps(key, ensure_ascii=False, sort_keys=True, default=str)
+    job_id = hmac.new(TOKEN.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+    with EXPORT_JOBS_LOCK:
+        job = EXPORT_JOBS.get(job_id)
+        if job is not None and job["status"] in ("pending", "running"):
+            return job
+        cached = load_cached_export_job(job_id)
+        if cached is not None:
+            EXPORT_JOBS[job_id] = cached
+            return cached
+        path, _ = export_job_paths(job_id)
+        job = {
+            "job_id": job_id,
+            "status": "pending",
+            "filename": filename,
+            "media_type": EXPORT_FORMATS[export_format][1],
+            "path": path,
+            "size": 0,
+            "error": "",
+            "future": None,
+            "scope": scope,
+            "created_at": time.time(),
+            "finished_at": 0
+        }
+        EXPORT_JOBS[job_id] = job
+        job["future"] = get_export_executor().submit(run_export_job, job, write)
+    return job
+
+
+def run_export_job(job: dict, write) -> None:
+    """在线程池中生成导出文件：先写临时文件再原子替换，避免下载到写了一半的文件"""
+    job["status"] = "running"
+    path, meta_path = export_job_paths(job["job_id"])
+    partial = f"{path}.{os.getpid()}.part"
+    started = time.perf_counter()
+    try:
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        write(partial)
+        os.replace(partial, path)
+        job["finished_at"] = time.time()
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "filename": job["filename"],
+                "media_type": job["media_type"],
+                "scope": job["scope"],
+                "created_at": job["created_at"],
+                "finished_at": job["finished_at"]
+            }, f, ensure_ascii=False)
+        job["size"] = os.path.getsize(path)
+        job["status"] = "done"
+        print(f"导出完成: {job['filename']} {job['size'] // 1024} KB，耗时 {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)[:200]
+        job["finished_at"] = time.time()
+        print(f"导出任务失败: {str(e)[:100]}")
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+    finally:
+        prune_export_cache()
+
+
+def prune_export_cache() -> None:
+    """清理导出缓存：删除超过 EXPORT_CACHE_TTL 的文件，总大小超过 EXPORT_CACHE_MAX_BYTES 时从最早的开始删除"""
+    now = time.time()
+    try:
+        names = os.listdir(EXPORT_CACHE_DIR)
+    except OSError:
+        return
+    artifacts = []
+    for name in names:
+        path = os.path.join(EXPORT_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if now - stat.st_mtime > EXPORT_CACHE_TTL:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        elif EXPORT_JOB_ID_RE.match(name):
+            artifacts.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in artifacts)
+    for _, size, name in sorted(artifacts):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        for path in export_job_paths(name):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+    # 内存中的任务只保留未完成的和缓存期内的
+    with EXPORT_JOBS_LOCK:
+        for job_id, job in list(EXPORT_JOBS.items()):
+            if job["status"] in ("done", "failed") and now - job["finished_at"] > EXPORT_CACHE_TTL:
+                EXPORT_JOBS.pop(job_id, None)
+
+
+def build_export_job_query(job: dict, openid: str) -> str:
+    """任务地址的访问参数：link 任务附带 openid 和签名（有效期同导出链接），admin 任务由请求头带管理员 token"""
+    if job["scope"] != "link":
+        return ""
+    ts = int(time.time())
+    sig = build_export_signature(openid, f"job:{job['job_id']}", ts)
+    return f"?openid={openid}&ts={ts}&sig={sig}"
 
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill("solid", fgColor="4F81BD")
-    center_align = Alignment(horizontal="center", vertical="center")
-    border = Border(
-        left=Side(style="thin", color="D9D9D9"),
-        right=Side(style="thin", color="D9D9D9"),
-        top=Side(style="thin", color="D9D9D9"),
-        bottom=Side(style="thin", color="D9D9D9")
-    )
 
-    # 期间与类目统计
-    total_amount = sum(float(r["amount"]) for r in records[:limit])
-    ws.append(["统计区间", f"{start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}"])
-    ws.append(["记录数", len(records[:limit])])
-    ws.append(["总支出", round(total_amount, 2)])
-    ws.append([])
+def authorize_export_job(request: Request, job: dict) -> str:
+    """校验任务访问权限，失败时抛 HTTPException；返回后续任务地址应带的访问参数"""
+    if job["scope"] != "link":
+        verify_admin_token_flexible(request)
+        return ""
+    params = request.query_params
+    openid = params.get("openid", "")
+    if not verify_export_signature(openid, f"job:{job['job_id']}", params.get("ts", ""), params.get("sig", "")):
+        raise HTTPException(status_code=403, detail="签名验证失败")
+    return build_export_job_query(job, openid)
 
-    category_totals = {}
-    daily_totals = {}
-    for r in records[:limit]:
-        dt = to_local_datetime(r["created_at"])
-        day_key = f"{dt.month}.{dt.day}"
-        category = r["category"]
-        amount = float(r["amount"])
-        category_totals[category] = category_totals.get(category, 0) + amount
-        daily_totals[day_key] = daily_totals.get(day_key, 0) + amount
 
-    ws.append(["类目统计"])
-    ws.append(["类目", "金额", "占比"])
-    for cell in ws[ws.max_row]:
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = center_align
-        cell.border = border
-    for cat, amount in sorted(category_totals.items(), key=lambda x: -x[1]):
-        percent = (amount / total_amount * 100) if total_amount else 0
-        ws.append([cat, round(amount, 2), f"{percent:.1f}%"])
+def export_job_status(job: dict, query: str = "") -> dict:
+    """任务状态（供前端轮询）；query 为 build_export_job_query 生成的访问参数"""
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "filename": job["filename"],
+        "size": job["size"],
+        "error": job["error"],
+        "status_url": f"/api/export/jobs/{job['job_id']}{query}",
+        "download_url": f"/api/export/jobs/{job['job_id']}/download{query}"
+    }
 
-    ws.append([])
-    ws.append(["每日合计"])
-    ws.append(["日期", "金额"])
-    for cell in ws[ws.max_row]:
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = center_align
-        cell.border = border
-    for day, amount in sorted(daily_totals.items()):
-        ws.append([day, round(amount, 2)])
 
-    ws.freeze_panes = "A5"
-    ws.column_dimensions["A"].width = 16
-    ws.column_dimensions["B"].width = 16
-    ws.column_dimensions["C"].width = 12
+def export_job_download(job: dict) -> StreamingResponse:
+    """流式返回已完成任务的文件"""
+    return StreamingResponse(
+        iter_export_file(job["path"]),
+        media_type=job["media_type"],
+        headers={
+            "Content-Disposition": f'attachment; filename="{job["filename"]}"',
+            "Content-Length": str(os.path.getsize(job["path"]))
+        }
+    )
 
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=3):
-        for cell in row:
-            if cell.value is None:
-                continue
-            if cell.row in [1, 2, 3]:
-                cell.font = Font(bold=True)
-            if cell.row > 4:
-                cell.border = border
-            if cell.column in [2] and isinstance(cell.value, (int, float)):
-                cell.number_format = "0.00"
 
-    # 明细表
-    ws_detail = wb.create_sheet("明细")
-    ws_detail.append(["ID", "日期", "时间", "描述", "金额", "分类"])
-    for cell in ws_detail[ws_detail.max_row]:
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = center_align
-        cell.border = border
+def export_job_waiting_page(job: dict, query: str = "") -> HTMLResponse:
+    """任务未完成时给浏览器的等待页：每 3 秒刷新下载地址（带新签名），完成后自动开始下载"""
+    page = f"""<!DOCTYPE html><html><head><meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<meta http-equiv="refresh" content="3;url=/api/export/jobs/{job['job_id']}/download{html.escape(query)}">
+<title>正在生成导出文件</title></head>
+<body style="font-family:sans-serif;text-align:center;padding-top:80px">
+<p>⏳ 正在生成 {html.escape(job['filename'])}，完成后会自动开始下载…</p></body></html>"""
+    return HTMLResponse(content=page, status_code=202)
 
-    for r in records[:limit]:
-        dt = to_local_datetime(r["created_at"])
-        ws_detail.append([
-            r["id"],
-            dt.strftime("%Y-%m-%d"),
-            dt.strftime("%H:%M"),
-            r["description"],
-            float(r["amount"]),
-            r["category"]
-        ])
 
-    ws_detail.freeze_panes = "A2"
-    ws_detail.column_dimensions["A"].width = 10
-    ws_detail.column_dimensions["B"].width = 14
-    ws_detail.column_dimensions["C"].width = 10
-    ws_detail.column_dimensions["D"].width = 30
-    ws_detail.column_dimensions["E"].width = 12
-    ws_detail.column_dimensions["F"].width = 12
+async def respond_export_job(job: dict, page: bool = False, query: str = ""):
+    """等待任务最多 EXPORT_WAIT_SECONDS 秒：完成则直接返回文件，否则返回任务状态（page=True 时返回自动刷新的等待页）"""
+    future = job.get("future")
+    if future is not None and job["status"] in ("pending", "running"):
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), EXPORT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    if job["status"] == "done":
+        return export_job_download(job)
+    if job["status"] == "failed":
+        if page:
+            return Response(content=f"导出失败: {job['error']}", status_code=500)
+        return JSONResponse(content={"success": False, "error": job["error"]}, status_code=500)
+    if page:
+        return export_job_waiting_page(job, query)
+    return JSONResponse(content={"success": True, **export_job_status(job, query)}, status_code=202)
 
-    for row in ws_detail.iter_rows(min_row=2, max_row=ws_detail.max_row, min_col=1, max_col=6):
-        for cell in row:
-            if cell.value is None:
-                continue
-            cell.border = border
-            if cell.column == 5 and isinstance(cell.value, (int, float)):
-                cell.number_format = "0.00"
 
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return bio.read()
+def parse_import_excel(file_bytes: bytes) -> dict:
+    """解析导入的 Excel：只读模式打开，返回逐行产出更新项的生成器（从明细表读取）"""
+    from openpyxl import load_workbook
+
+    try:
+        wb = load_workbook(io.BytesIO(file_bytes), read_only=True)
+    except Exception as e:
+        print(f"解析导入 Excel 错误: {str(e)[:100]}")
+        return {"error": "parse_failed"}
+    if "明细" not in wb.sheetnames:
+        wb.close()
+        return {"error": "no_detail_sheet"}
+    return {"updates": iter_import_updates(wb)}
 
 
-def parse_import_excel(file_bytes: bytes) -> dict:
-    """解析导入的 Excel（从明细表读取）"""
+def iter_import_updates(wb):
+    """逐行读取明细表，产出 {id, description, amount, category[, created_at]}；读完后关闭工作簿"""
+    ws = wb["明细"]
     try:
-        wb = load_workbook(io.BytesIO(file_bytes))
-        if "明细" not in wb.sheetnames:
-            return {"error": "no_detail_sheet"}
-        
-        ws = wb["明细"]
-        rows = list(ws.iter_rows(min_row=2, values_only=True))
-        updates = []
-        for row in rows:
+        for row in ws.iter_rows(min_row=2, values_only=True):
             if not row or len(row) < 6:
                 continue
             record_id, date_str, time_str, description, amount, category = row[:6]
@@ -1485,43 +3331,161 @@ def parse_import_excel(file_bytes: bytes) -> dict:
             }
             if created_at:
                 update_item["created_at"] = to_utc_iso(created_at)
-            updates.append(update_item)
-        return {"updates": updates}
-    except Exception as e:
-        print(f"解析导入 Excel 错误: {str(e)[:100]}")
-        return {"error": "parse_failed"}
+            yield update_item
+    finally:
+        wb.close()
 
 
-def batch_update_records(updates: list) -> dict:
-    """批量更新记录（支持修改日期时间）"""
-    supabase = get_supabase_client()
+def fetch_import_targets(ids: list) -> dict:
+    """从数据库读取导入目标记录的当前值 id -> {openid、nickname、created_at、金额、分类、描述、local_ts}。
+
+    每批一次 id=in.(...) 查询；是否存在以数据库为准（不看本进程缓存，缓存可能还留着别处已删除的记录）。
+    """
+    result = (get_supabase_client().table("records")
+              .select("id,openid,nickname,amount,category,description,created_at")
+              .in_("id", ids).execute())
+    targets = {}
+    for row in result.data or []:
+        targets[row["id"]] = {
+            "openid": row["openid"],
+            "nickname": row.get("nickname"),
+            "created_at": row["created_at"],
+            "amount": float(row["amount"]),
+            "category": row["category"],
+            "description": row["description"],
+            "local_ts": to_local_ts(to_local_datetime(row["created_at"]))
+        }
+    return targets
+
+
+def diff_import_row(upd: dict, target: dict) -> dict:
+    """比较导入行与当前记录，返回有变化的字段 {字段: [原值, 新值]}；时间只精确到分钟（Excel 里只有 HH:MM）"""
+    changes = {}
+    if round(target["amount"], 2) != round(upd["amount"], 2):
+        changes["amount"] = [target["amount"], upd["amount"]]
+    for field in ("category", "description"):
+        if target[field] != upd[field]:
+            changes[field] = [target[field], upd[field]]
+    if "created_at" in upd:
+        new_ts = to_local_ts(to_local_datetime(upd["created_at"]))
+        if new_ts // 60 != target["local_ts"] // 60:
+            changes["created_at"] = [from_local_ts(target["local_ts"]).strftime("%Y-%m-%d %H:%M"),
+                                     from_local_ts(new_ts).strftime("%Y-%m-%d %H:%M")]
+    return changes
+
+
+def upsert_import_chunk(chunk: dict, dry_run: bool = False) -> dict:
+    """把一批更新项与数据库里的当前记录比较，只把有变化的行按 id 批量 upsert（merge-duplicates）。
+
+    upsert 的插入分支会先校验 NOT NULL 列，所以每行都带上原记录的 openid、nickname、created_at；
+    数据库里不存在的 id 不提交（否则会被当成新记录插入），按失败返回。dry_run 时只比较不写入。
+    返回 {"rows": 写入后的行, "missing": 不存在的 id, "unchanged": 未变化条数, "diff": [{id, changes}]}
+    """
+    targets = fetch_import_targets(list(chunk))
+    payload = []
+    missing = []
+    diff = []
+    unchanged = 0
+    for record_id, upd in chunk.items():
+        target = targets.get(record_id)
+        if target is None:
+            missing.append(record_id)
+            continue
+        changes = diff_import_row(upd, target)
+        if not changes:
+            unchanged += 1
+            continue
+        diff.append({"id": record_id, "changes": changes})
+        payload.append({
+            "id": record_id,
+            "openid": target["openid"],
+            "nickname": target["nickname"],
+            "description": upd["description"],
+            "amount": upd["amount"],
+            "category": upd["category"],
+            "created_at": upd["created_at"] if "created_at" in changes else target["created_at"]
+        })
+    rows = []
+    if payload and not dry_run:
+        rows = get_supabase_client().table("records").upsert(payload, on_conflict="id", returning=True).execute().data or []
+    return {"rows": rows, "missing": missing, "unchanged": unchanged, "diff": diff}
+
+
+def batch_update_records(updates, chunk_size: int = None, dry_run: bool = False) -> dict:
+    """批量更新记录（支持修改日期时间）：按 chunk_size 条一批与数据库当前值比较，只写入有变化的行；updates 可以是生成器。
+
+    返回写入条数、有变化/未变化条数、失败 id、改动明细（最多 IMPORT_DIFF_LIMIT 条）、
+    出错的批次（序号、行数、首尾 id、错误）以及耗时和每秒行数。dry_run 时只生成改动明细不写入。
+    """
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    started = time.perf_counter()
     success = 0
+    changed = 0
+    unchanged = 0
     failed = []
-    for upd in updates:
+    diff = []
+    chunk_errors = []
+    updated_rows = []
+    total = 0
+    chunk_index = 0
+    parse_error = None
+    chunk = {}  # id -> 更新项；同一批里重复的 id 以后出现的为准
+
+    def flush():
+        nonlocal success, changed, unchanged, chunk_index
+        ids = list(chunk)
         try:
-            update_data = {
-                "description": upd["description"],
-                "amount": upd["amount"],
-                "category": upd["category"]
-            }
-            # 如果提供了新的日期时间，也更新
-            if "created_at" in upd:
-                update_data["created_at"] = upd["created_at"]
-            
-            result = supabase.table("records").update(update_data).eq("id", upd["id"]).execute()
-            if result.data:
-                success += 1
-            else:
-                failed.append(upd["id"])
-        except Exception:
-            failed.append(upd["id"])
-    invalidate_records_cache()
-    return {"success": success, "failed": failed}
+            result = upsert_import_chunk(chunk, dry_run)
+            updated_rows.extend(result["rows"])
+            failed.extend(result["missing"])
+            unchanged += result["unchanged"]
+            changed += len(result["diff"])
+            if not dry_run:
+                success += len(result["diff"])
+            diff.extend(result["diff"][:IMPORT_DIFF_LIMIT - len(diff)])
+        except Exception as e:
+            failed.extend(ids)
+            chunk_errors.append({"chunk": chunk_index, "rows": len(ids), "first_id": ids[0], "last_id": ids[-1],
+                                 "error": str(e)[:200]})
+            print(f"导入第 {chunk_index + 1} 批失败（{len(ids)} 条）: {str(e)[:100]}")
+        chunk_index += 1
+        chunk.clear()
+
+    try:
+        for upd in updates:
+            total += 1
+            chunk.pop(upd["id"], None)
+            chunk[upd["id"]] = upd
+            if len(chunk) >= chunk_size:
+                flush()
+    except Exception as e:
+        # 文件读到一半损坏：已提交的批次保留，报告解析错误
+        parse_error = str(e)[:200]
+        print(f"解析导入 Excel 错误: {str(e)[:100]}")
+    if chunk:
+        flush()
+    apply_records_to_cache(updated_rows)
+    elapsed = time.perf_counter() - started
+    return {
+        "success": success,
+        "changed": changed,
+        "unchanged": unchanged,
+        "failed": failed,
+        "diff": diff,
+        "dry_run": dry_run,
+        "total": total,
+        "chunks": chunk_index,
+        "chunk_errors": chunk_errors,
+        "parse_error": parse_error,
+        "elapsed": round(elapsed, 3),
+        "rows_per_second": round(total / elapsed, 1) if elapsed > 0 else 0.0
+    }
 
 
 def rename_category(old_name: str, new_name: str) -> dict:
     """批量重命名分类（包括历史记录）"""
     try:
+        flush_alias_writes()  # 先写入排队中的别名，避免之后覆盖本次改名
         supabase = get_supabase_client()
         # 更新所有记录
         result = supabase.table("records").update({
@@ -1538,7 +3502,7 @@ def rename_category(old_name: str, new_name: str) -> dict:
         CATEGORY_ALIAS_CACHE["expires_at"] = 0
         CATEGORY_LIST_CACHE["value"] = []
         CATEGORY_LIST_CACHE["expires_at"] = 0
-        invalidate_records_cache()
+        apply_records_to_cache(result.data)
 
         return {"success": True, "count": len(result.data) if result.data else 0}
     except Exception as e:
@@ -1664,10 +3628,12 @@ def merge_categories_to_tree(mappings: list) -> dict:
     """将旧分类名批量改为新路径：mappings = [ {"from": "早饭", "to": "正餐|早饭"}, ... ]。同时更新 category_aliases。"""
     if not mappings:
         return {"success": 0, "failed": 0, "errors": []}
+    flush_alias_writes()  # 先写入排队中的别名，避免之后覆盖本次合并
     supabase = get_supabase_client()
     updated = 0
     failed = 0
     errors = []
+    updated_rows = []
     for m in mappings:
         from_name = (m.get("from") or "").strip()
         to_path = (m.get("to") or "").strip()
@@ -1676,11 +3642,12 @@ def merge_categories_to_tree(mappings: list) -> dict:
         try:
             r = supabase.table("records").update({"category": to_path}).eq("category", from_name).execute()
             updated += len(r.data) if r.data else 0
+            updated_rows.extend(r.data or [])
             supabase.table("category_aliases").update({"category": to_path}).eq("category", from_name).execute()
         except Exception as e:
             failed += 1
             errors.append(f"{from_name}→{to_path}: {str(e)[:50]}")
-    invalidate_records_cache()
+    apply_records_to_cache(updated_rows)
     CATEGORY_ALIAS_CACHE["expires_at"] = 0
     CATEGORY_LIST_CACHE["expires_at"] = 0
     return {"success": updated, "failed": failed, "errors": errors}
@@ -1724,19 +3691,45 @@ def remove_category_preset(path: str) -> bool:
     return ok
 
 
+def get_record_category_counts() -> dict:
+    """记录中各分类的记录数。
+
+    优先调用数据库函数 category_counts（GROUP BY，返回量只与分类数有关）；不可用时用已加载的记录缓存
+    （经 get_records_cached，过期时先同步），都没有才拉取整表的 category 列在本地计数。
+    """
+    rows = call_optional_rpc("category_counts")
+    if rows is not None:
+        counts = {}
+        for r in rows:
+            cat = (r.get("category") or "").strip()
+            if cat:
+                counts[cat] = counts.get(cat, 0) + int(r.get("count") or 0)
+        return counts
+    if RECORDS_CACHE["store"] is not None:
+        store = get_records_cached()
+        counts = {}
+        for cat, (_, count) in store.aggregate(group_by="category").items():
+            cat = cat.strip()
+            if cat:
+                counts[cat] = counts.get(cat, 0) + count
+        return counts
+    supabase = get_supabase_client()
+    result = supabase.table("records").select("category").execute()
+    counts = {}
+    for r in result.data:
+        cat = r.get("category", "").strip()
+        if cat:
+            counts[cat] = counts.get(cat, 0) + 1
+    return counts
+
+
 def get_all_categories() -> list:
     """获取所有分类 = 记录中出现的 + 手动添加的预设"""
     now = int(time.time())
     if CATEGORY_LIST_CACHE["value"] and now < CATEGORY_LIST_CACHE["expires_at"]:
         return CATEGORY_LIST_CACHE["value"]
     try:
-        supabase = get_supabase_client()
-        result = supabase.table("records").select("category").execute()
-        categories = set()
-        for r in result.data:
-            cat = r.get("category", "").strip()
-            if cat:
-                categories.add(cat)
+        categories = set(get_record_category_counts())
         for p in get_category_presets():
             if p:
                 categories.add(p)
@@ -1754,13 +3747,7 @@ def get_all_categories() -> list:
 def get_category_stats() -> list:
     """获取分类统计（含记录数）"""
     try:
-        supabase = get_supabase_client()
-        result = supabase.table("records").select("category").execute()
-        category_count = {}
-        for r in result.data:
-            cat = r.get("category", "").strip()
-            if cat:
-                category_count[cat] = category_count.get(cat, 0) + 1
+        category_count = get_record_category_counts()
         return [{"category": cat, "count": count} for cat, count in sorted(category_count.items())]
     except Exception as e:
         print(f"分类统计错误: {str(e)[:100]}")
@@ -1769,6 +3756,9 @@ def get_category_stats() -> list:
 
 def build_category_excel_bytes() -> bytes:
     """导出分类管理 Excel"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+
     wb = Workbook()
     ws = wb.active
     ws.title = "分类管理"
@@ -1821,6 +3811,8 @@ def build_category_excel_bytes() -> bytes:
 
 def parse_category_excel(file_bytes: bytes) -> dict:
     """解析分类管理 Excel"""
+    from openpyxl import load_workbook
+
     try:
         wb = load_workbook(io.BytesIO(file_bytes))
         if "分类管理" not in wb.sheetnames:
@@ -1847,6 +3839,9 @@ def parse_category_excel(file_bytes: bytes) -> dict:
 
 def build_category_mapping_excel_bytes() -> bytes:
     """导出「分类映射表」模板：原分类、新分类。支持一级/二级/三级，新分类用----分隔如 正餐----晚餐----外卖。"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill
+
     try:
         wb = Workbook()
         ws = wb.active
@@ -1888,6 +3883,8 @@ def _normalize_new_category(s: str) -> str:
 
 def parse_category_mapping_excel(file_bytes: bytes) -> dict:
     """解析分类映射表 Excel。支持两列「原分类、新分类」或单列「新分类----原分类」。新分类可多级如 正餐----晚餐----外卖。"""
+    from openpyxl import load_workbook
+
     try:
         wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
         sheet_name = "分类映射" if "分类映射" in wb.sheetnames else (wb.sheetnames[0] if wb.sheetnames else "")
@@ -1947,6 +3944,7 @@ def batch_rename_categories(renames: list) -> dict:
 def clear_category_aliases(category_name: str) -> bool:
     """清除某分类下的所有别名（该分类无记录时用于「删除分类」）"""
     try:
+        flush_alias_writes()  # 先写入排队中的别名，避免清除后又被写回
         supabase = get_supabase_client()
         supabase.table("category_aliases").delete().eq("category", category_name.strip()).execute()
         CATEGORY_ALIAS_CACHE["value"] = {}
@@ -1985,33 +3983,20 @@ def build_dashboard_text() -> str:
         lines.append("🧭 本月分类占比：暂无数据")
         lines.append("")
 
-    # 趋势数据（近4周 / 近6月 / 近3年）
+    # 趋势数据（近4周 / 近6月 / 近3年），各区间合计直接查记录缓存的按日前缀和
     week_start = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=now.weekday())
-    start_year = now.replace(year=now.year - 2, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    records = get_records(start_date=start_year - timedelta(days=1), end_date=now + timedelta(days=1))
-    records = filter_records_by_local_range(records, start_year, now + timedelta(days=1))
-
-    weekly_totals = {}
-    monthly_totals = {}
-    yearly_totals = {}
+    range_end = now + timedelta(days=1)
+    store = get_records_cached()
 
-    for r in records:
-        dt = to_local_datetime(r["created_at"])
-        amount = float(r["amount"])
-        week_key = (dt - timedelta(days=dt.weekday())).strftime("%Y-%m-%d")
-        month_key = dt.strftime("%Y-%m")
-        year_key = str(dt.year)
-        weekly_totals[week_key] = weekly_totals.get(week_key, 0) + amount
-        monthly_totals[month_key] = monthly_totals.get(month_key, 0) + amount
-        yearly_totals[year_key] = yearly_totals.get(year_key, 0) + amount
+    def period_total(start: datetime, end: datetime) -> float:
+        return store.totals(start, min(end, range_end))[0]
 
     # 周趋势（近4周）
     lines.append("📅 近4周趋势")
     for i in range(3, -1, -1):
         ws = week_start - timedelta(weeks=i)
         we = ws + timedelta(days=6)
-        key = ws.strftime("%Y-%m-%d")
-        total = weekly_totals.get(key, 0)
+        total = period_total(ws, ws + timedelta(days=7))
         lines.append(f"{ws.strftime('%m/%d')}-{we.strftime('%m/%d')} {total:.2f}元")
     lines.append("")
 
@@ -2020,15 +4005,14 @@ def build_dashboard_text() -> str:
     first_month = add_months(month_start, -5)
     for i in range(6):
         current = add_months(first_month, i)
-        key = current.strftime("%Y-%m")
-        total = monthly_totals.get(key, 0)
+        total = period_total(current, add_months(current, 1))
         lines.append(f"{current.strftime('%Y-%m')} {total:.2f}元")
     lines.append("")
 
     # 年趋势（近3年）
     lines.append("📈 近3年趋势")
     for year in range(now.year - 2, now.year + 1):
-        total = yearly_totals.get(str(year), 0)
+        total = period_total(datetime(year, 1, 1, tzinfo=LOCAL_TZ), datetime(year + 1, 1, 1, tzinfo=LOCAL_TZ))
         lines.append(f"{year}年 {total:.2f}元")
 
     return "\n".join(lines)
@@ -2075,6 +4059,160 @@ def send_text_message(openid: str, text: str) -> bool:
     return data.get("errcode") == 0
 
 
+# ============ 订阅推送（并发发送客服消息）============
+class TokenBucket:
+    """异步令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个；acquire() 拿不到令牌时等待"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def get_wechat_async_http_client() -> httpx.AsyncClient:
+    """获取进程级共享的 httpx.AsyncClient（连接复用，供并发推送使用）"""
+    client = WECHAT_ASYNC_HTTP["client"]
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=REPORT_SEND_TIMEOUT,
+            limits=httpx.Limits(max_connections=REPORT_CONCURRENCY, max_keepalive_connections=REPORT_CONCURRENCY)
+        )
+        WECHAT_ASYNC_HTTP["client"] = client
+    return client
+
+
+async def close_wechat_async_http_client():
+    """关闭共享的推送客户端（进程退出时调用）"""
+    client = WECHAT_ASYNC_HTTP["client"]
+    WECHAT_ASYNC_HTTP["client"] = None
+    if client is not None:
+        await client.aclose()
+
+
+async def refresh_access_token(stale: str) -> str:
+    """access_token 失效时清掉缓存重新获取（其他地方已刷新过则直接返回新值）"""
+    if ACCESS_TOKEN_CACHE["value"] == stale:
+        ACCESS_TOKEN_CACHE["value"] = ""
+        ACCESS_TOKEN_CACHE["expires_at"] = 0
+    return await run_in_threadpool(get_access_token)
+
+
+async def send_text_message_async(openid: str, text: str, token: str) -> int:
+    """异步发送一条客服消息，返回微信 errcode（HTTP 错误、超时等直接抛出）"""
+    response = await get_wechat_async_http_client().post(
+        "https://api.weixin.qq.com/cgi-bin/message/custom/send",
+        params={"access_token": token},
+        json={"touser": openid, "msgtype": "text", "text": {"content": text}}
+    )
+    response.raise_for_status()
+    return int(response.json().get("errcode", -1))
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """已排序列表的百分位数（最近秩法）；空列表返回 0"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+async def fan_out_text_messages(messages: dict) -> dict:
+    """并发推送 {openid: 文本}（每人可以不同），返回投递报告。
+
+    最多 REPORT_CONCURRENCY 个请求同时在途，整体速率受令牌桶限制（REPORT_RATE_PER_SECOND），
+    系统繁忙/频率限制/网络错误按指数退避最多重试 REPORT_MAX_RETRIES 次，access_token 失效时刷新后重试；
+    其余 errcode（如超过 48 小时互动窗口）不重试，直接记为失败。
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, REPORT_CONCURRENCY))
+    bucket = TokenBucket(REPORT_RATE_PER_SECOND, REPORT_RATE_BURST)
+    token = {"value": await run_in_threadpool(get_access_token)}
+    token_lock = asyncio.Lock()
+    latencies = []
+    failures = []
+    stats = {"sent": 0, "retries": 0}
+
+    async def deliver(openid: str, text: str):
+        attempt = 0
+        while True:
+            # 只在发送期间占用并发名额，退避等待时让给其他收件人
+            async with semaphore:
+                await bucket.acquire()
+                current = token["value"]
+                sent_at = time.perf_counter()
+                try:
+                    errcode = await send_text_message_async(openid, text, current)
+                    error = f"errcode {errcode}"
+                    retryable = errcode in WECHAT_RETRY_ERRCODES
+                except (httpx.TransportError, httpx.HTTPStatusError, ValueError) as e:
+                    errcode = None
+                    error = str(e)[:100] or type(e).__name__
+                    retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+            if errcode == 0:
+                stats["sent"] += 1
+                return
+            if errcode in WECHAT_TOKEN_ERRCODES and attempt == 0:
+                # 刷新失败只记为该收件人失败，不中断整批推送
+                try:
+                    async with token_lock:
+                        if token["value"] == current:
+                            token["value"] = await refresh_access_token(current)
+                    retryable = True
+                except Exception as e:
+                    error = f"{error}, refresh access_token failed: {str(e)[:100]}"
+                    retryable = False
+            if not retryable or attempt >= REPORT_MAX_RETRIES:
+                failures.append({"openid": openid, "error": error, "attempts": attempt + 1})
+                return
+            attempt += 1
+            stats["retries"] += 1
+            await asyncio.sleep(REPORT_RETRY_BASE_DELAY * (2 ** (attempt - 1)) * (1 + random.random()))
+
+    await asyncio.gather(*(deliver(openid, text) for openid, text in messages.items()))
+    latencies.sort()
+    return {
+        "total": len(messages),
+        "sent": stats["sent"],
+        "failed": len(failures),
+        "retries": stats["retries"],
+        "failures": failures,
+        "elapsed": round(time.perf_counter() - started, 3),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p90": round(percentile(latencies, 90), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(latencies[-1], 1) if latencies else 0.0
+        }
+    }
+
+
+def format_delivery_report(report: dict) -> str:
+    """推送报告文本：首行保持 ok 成功数/总数"""
+    latency = report["latency_ms"]
+    lines = [
+        f"ok {report['sent']}/{report['total']}",
+        f"failed {report['failed']}, retries {report['retries']}, elapsed {report['elapsed']}s",
+        f"latency ms p50 {latency['p50']} p90 {latency['p90']} p99 {latency['p99']} max {latency['max']}"
+    ]
+    for failure in report["failures"][:20]:
+        lines.append(f"{failure['openid']}: {failure['error']} ({failure['attempts']} attempts)")
+    return "\n".join(lines)
+
+
 def format_debts(debts: list) -> str:
     """格式化外债列表"""
     if not debts:
@@ -2134,12 +4272,11 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
     content = content.strip()
 
     # 分类选择处理
-    pending_pick = PENDING_CATEGORY_PICKS.get(openid)
+    state = get_state_store()
+    pending_pick = state.get(STATE_CATEGORY_PICK, openid)
     if pending_pick:
-        if time.time() - pending_pick["ts"] > PENDING_CATEGORY_TTL:
-            PENDING_CATEGORY_PICKS.pop(openid, None)
-        elif content in ["取消", "取消分类"]:
-            PENDING_CATEGORY_PICKS.pop(openid, None)
+        if content in ["取消", "取消分类"]:
+            state.delete(STATE_CATEGORY_PICK, openid)
             return "✅ 已取消分类选择"
         elif content.isdigit():
             idx = int(content)
@@ -2154,7 +4291,7 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
                     description=pending_pick["description"]
                 )
                 add_category_alias(pending_pick["description"], category)
-                PENDING_CATEGORY_PICKS.pop(openid, None)
+                state.delete(STATE_CATEGORY_PICK, openid)
                 return (
                     f"✅ 记账成功！\n{pending_pick['description']}：{pending_pick['amount']:.2f} 元\n"
                     f"分类：{category}\n已记住，下次将自动归类"
@@ -2165,9 +4302,7 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
 
     # 批量记账：一行一条
     if "批量" in content or "\n" in content or "；" in content or ";" in content:
-        raw = content.replace("批量", "").strip()
-        raw = raw.replace("；", "\n").replace(";", "\n")
-        lines = [l.strip() for l in raw.splitlines() if l.strip()]
+        lines = split_batch_lines(content)
         if len(lines) >= 2:
             success = 0
             failed = []
@@ -2221,12 +4356,11 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
                 if not alias_category:
                     # 未出现过的备注：一定让用户自己选择分类，不自动归到任何类
                     categories = get_category_candidates()
-                    PENDING_CATEGORY_PICKS[openid] = {
-                        "ts": time.time(),
+                    state.set(STATE_CATEGORY_PICK, openid, {
                         "description": parsed["description"],
                         "amount": parsed["amount"],
                         "categories": categories
-                    }
+                    }, PENDING_CATEGORY_TTL)
                     return build_category_pick_prompt(parsed["description"], parsed["amount"], categories)
                 category = alias_category
                 # 仅当用户选过并记住的别名才自动学习，此处已是匹配到的
@@ -2315,36 +4449,7 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
 
     elif parsed["type"] == "record_delete":
         try:
-            # 清理过期
-            pending = PENDING_DELETES.get(openid)
-            if pending and (time.time() - pending["ts"] > PENDING_DELETE_TTL):
-                PENDING_DELETES.pop(openid, None)
-
-            def parse_indices(raw: str) -> list:
-                raw = normalize_dash(raw)
-                raw = raw.replace("，", ",")
-                matches = re.findall(r'\d+\s*-\s*\d+|\d+', raw)
-                indices = []
-                for part in matches:
-                    part = part.replace(" ", "")
-                    if "-" in part:
-                        start, end = part.split("-", 1)
-                        if start.isdigit() and end.isdigit():
-                            s = int(start)
-                            e = int(end)
-                            if s <= e:
-                                indices.extend(list(range(s, e + 1)))
-                    elif part.isdigit():
-                        indices.append(int(part))
-                return sorted(set(indices))
-
-            raw = parsed["raw"]
-            tokens = raw.split()
-            period_token = "今天"
-            if tokens and tokens[0] in ["今天", "今日", "昨天", "昨日", "本周", "本月"] or ("-" in tokens[0]):
-                period_token = tokens[0]
-                raw = " ".join(tokens[1:]).strip()
-            indices = parse_indices(raw)
+            period_token, indices = parse_delete_target(parsed["raw"])
             if not indices:
                 return "❌ 格式错误，示例：删 2 或 删 1,3,5 或 删 1-4 或 删 昨天 1-3"
 
@@ -2369,10 +4474,7 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
                 return "❌ 编号无效，请先发送「明细」查看编号"
 
             selected = [records[i - 1] for i in indices]
-            PENDING_DELETES[openid] = {
-                "ts": time.time(),
-                "items": selected
-            }
+            state.set(STATE_PENDING_DELETE, openid, {"items": selected}, PENDING_DELETE_TTL)
 
             lines = [f"将删除以下 {len(selected)} 条记录："]
             for i, r in zip(indices, selected):
@@ -2388,21 +4490,16 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
 
     elif parsed["type"] == "record_delete_confirm":
         try:
-            pending = PENDING_DELETES.get(openid)
+            pending = state.get(STATE_PENDING_DELETE, openid)
             if not pending:
-                return "❌ 没有待确认的删除"
-            if time.time() - pending["ts"] > PENDING_DELETE_TTL:
-                PENDING_DELETES.pop(openid, None)
-                return "❌ 删除已过期，请重新发起"
+                return "❌ 没有待确认的删除（或已过期，请重新发起）"
 
-            deleted = 0
             for record in pending["items"]:
                 archive_deleted_record(record, deleted_by=openid)
-                result = delete_record(record["id"])
-                if getattr(result, "data", []):
-                    deleted += 1
+            result = delete_records([record["id"] for record in pending["items"]])
+            deleted = len(getattr(result, "data", None) or [])
 
-            PENDING_DELETES.pop(openid, None)
+            state.delete(STATE_PENDING_DELETE, openid)
             if deleted == 0:
                 return "❌ 删除失败，可能没有权限（请检查 RLS 策略）"
             return f"✅ 已删除 {deleted} 条记录"
@@ -2411,7 +4508,7 @@ def handle_message(openid: str, nickname: str, content: str) -> str:
             return "❌ 删除失败，请稍后重试"
 
     elif parsed["type"] == "record_delete_cancel":
-        PENDING_DELETES.pop(openid, None)
+        state.delete(STATE_PENDING_DELETE, openid)
         return "✅ 已取消删除"
 
     elif parsed["type"] == "deleted_list":
@@ -2704,6 +4801,82 @@ def check_signature(signature, timestamp, nonce):
     return tmp_str == signature
 
 
+# ============ 公众号消息处理（工作线程池 + 回复时限）============
+def get_webhook_executor() -> ThreadPoolExecutor:
+    """消息处理线程池（首次使用时创建）"""
+    executor = WEBHOOK_EXECUTOR["value"]
+    if executor is None:
+        with WEBHOOK_EXECUTOR_LOCK:
+            executor = WEBHOOK_EXECUTOR["value"]
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+                WEBHOOK_EXECUTOR["value"] = executor
+    return executor
+
+
+def process_webhook_message(job: dict, openid: str, nickname: str, content: str) -> str:
+    """在线程池中处理消息；webhook 已超时返回时，处理完改用客服消息推送结果"""
+    started = time.perf_counter()
+    try:
+        reply = handle_message(openid, nickname, content)
+    except Exception as e:
+        print(f"处理消息错误: {str(e)[:100]}")
+        WEBHOOK_STATS["errors"] += 1
+        reply = ""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    WEBHOOK_STATS["total_ms"] += elapsed_ms
+    WEBHOOK_STATS["max_ms"] = max(WEBHOOK_STATS["max_ms"], elapsed_ms)
+    # 与 webhook 的超时判断互斥：要么被动回复，要么推送，不会重复也不会丢
+    with job["lock"]:
+        job["reply"] = reply
+        expired = job["expired"]
+    if expired and reply:
+        try:
+            if send_text_message(openid, reply):
+                WEBHOOK_STATS["delivered"] += 1
+            else:
+                WEBHOOK_STATS["delivery_failed"] += 1
+        except Exception as e:
+            WEBHOOK_STATS["delivery_failed"] += 1
+            print(f"客服消息推送错误: {str(e)[:100]}")
+    return reply
+
+
+async def run_webhook_message(openid: str, nickname: str, content: str):
+    """提交消息处理，最多等待 WEBHOOK_REPLY_BUDGET 秒；超时返回 None（结果稍后推送）"""
+    job = {"lock": threading.Lock(), "expired": False, "reply": None}
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_webhook_executor(), process_webhook_message, job, openid, nickname, content)
+    try:
+        # shield：超时只是不再等待，处理本身继续进行
+        return await asyncio.wait_for(asyncio.shield(future), timeout=WEBHOOK_REPLY_BUDGET)
+    except asyncio.TimeoutError:
+        with job["lock"]:
+            reply = job["reply"]
+            if reply is None:
+                job["expired"] = True
+        if reply is None:
+            WEBHOOK_STATS["deferred"] += 1
+        return reply
+
+
+def get_webhook_stats() -> dict:
+    """消息处理统计（用于监控）"""
+    handled = WEBHOOK_STATS["passive"] + WEBHOOK_STATS["deferred"]
+    return {
+        "passive": WEBHOOK_STATS["passive"],
+        "deferred": WEBHOOK_STATS["deferred"],
+        "delivered": WEBHOOK_STATS["delivered"],
+        "delivery_failed": WEBHOOK_STATS["delivery_failed"],
+        "errors": WEBHOOK_STATS["errors"],
+        "deferred_rate": round(WEBHOOK_STATS["deferred"] / handled, 4) if handled else 0,
+        "avg_ms": round(WEBHOOK_STATS["total_ms"] / handled, 2) if handled else 0,
+        "max_ms": round(WEBHOOK_STATS["max_ms"], 2),
+        "reply_budget": WEBHOOK_REPLY_BUDGET,
+        "workers": WEBHOOK_WORKERS
+    }
+
+
 # ============ API 路由 ============
 @app.get("/api/wechat")
 async def verify(request: Request):
@@ -2736,6 +4909,25 @@ async def health_head():
     return Response(content="", status_code=200)
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """进程退出时等待处理中的消息和导出任务完成、写入排队中的别名，再释放连接池"""
+    with WEBHOOK_EXECUTOR_LOCK:
+        executor = WEBHOOK_EXECUTOR["value"]
+        WEBHOOK_EXECUTOR["value"] = None
+    if executor is not None:
+        await run_in_threadpool(executor.shutdown, True)
+    with EXPORT_EXECUTOR_LOCK:
+        executor = EXPORT_EXECUTOR["value"]
+        EXPORT_EXECUTOR["value"] = None
+    if executor is not None:
+        await run_in_threadpool(executor.shutdown, True)
+    await run_in_threadpool(flush_alias_writes)
+    close_supabase_http_client()
+    await close_supabase_async_http_client()
+    await close_wechat_async_http_client()
+
+
 @app.post("/api/wechat")
 async def webhook(request: Request):
     """接收微信公众号消息"""
@@ -2758,17 +4950,18 @@ async def webhook(request: Request):
         
         content = xml_tree.find("Content").text
 
-        if msg_id and is_duplicate_message(msg_id):
+        # 先记录消息 ID：重复消息、以及处理超时后微信的重试直接回 success，结果由客服消息推送
+        if msg_id and not claim_message_id(msg_id):
             return Response(content="success", media_type="text/plain")
         
         # 获取用户信息（可选，需要 access_token）
         nickname = from_user[:8]  # 暂时用 openid 前8位作为标识
-        
-        # 处理消息
-        reply_content = handle_message(from_user, nickname, content)
 
-        if msg_id:
-            record_message_id(msg_id)
+        # 处理消息（超过回复时限时返回 None）
+        reply_content = await run_webhook_message(from_user, nickname, content)
+        if not reply_content:
+            return Response(content="success", media_type="text/plain")
+        WEBHOOK_STATS["passive"] += 1
         
         # 构造回复 XML
         to_user = xml_tree.find("FromUserName").text
@@ -2802,6 +4995,10 @@ async def export_excel(request: Request):
         if not verify_export_signature(openid, period, ts, sig):
             return Response(content="签名验证失败", status_code=403)
 
+        export_format = params.get("format", "xlsx")
+        if export_format not in EXPORT_FORMATS:
+            return Response(content="导出格式错误（支持 xlsx、csv、ndjson.gz）", status_code=400)
+
         if period.startswith("month:"):
             month_text = period.split("month:", 1)[1]
             month_range = parse_month_token(month_text)
@@ -2814,11 +5011,12 @@ async def export_excel(request: Request):
         if not start_date or not end_date:
             return Response(content="日期范围错误", status_code=400)
             
-        records = get_records(start_date=start_date - timedelta(days=1), end_date=end_date + timedelta(days=1))
-        records = filter_records_by_local_range(records, start_date, end_date)
-        # 全部导出时增加限制到10000条
+        # 按日期范围分页查数据库（不经过全量缓存，首次导出不用加载整表，也不会读到过期的行）
+        records = await run_in_threadpool(load_export_records, start_date, end_date)
+        # 全部导出时增加限制到10000条（只限 xlsx，csv/ndjson.gz 不限条数）
         limit = 10000 if period == "all" else 1000
-        data = build_export_excel_bytes(records, start_date, end_date, limit=limit)
+        if export_format == "xlsx":
+            records = records[:limit]
         
         # 生成文件名：导出时间_范围.xlsx（使用英文避免编码问题）
         export_time = datetime.now(LOCAL_TZ).strftime("%Y%m%d_%H%M%S")
@@ -2829,15 +5027,14 @@ async def export_excel(request: Request):
             range_text = "all"
         else:
             range_text = period
-        filename = f"records_{export_time}_{range_text}.xlsx"
-        headers = {
-            "Content-Disposition": f'attachment; filename="{filename}"'
-        }
-        return StreamingResponse(
-            io.BytesIO(data),
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers=headers
-        )
+        filename = f"records_{export_time}_{range_text}.{EXPORT_FORMATS[export_format][0]}"
+
+        # 同一范围、格式、明细内容的导出只生成一次（手机和电脑先后打开同一链接时直接复用）
+        key = {"kind": "link", "start": start_date.strftime("%Y-%m-%d"), "end": end_date.strftime("%Y-%m-%d"),
+               "count": len(records), "format": export_format, "limit": limit, "digest": export_records_digest(records)}
+        job = submit_export_job(key, filename, export_format, lambda path: write_export_file(
+            records, export_format, start_date, end_date, limit, path), scope="link")
+        return await respond_export_job(job, page=True, query=build_export_job_query(job, openid))
     except Exception as e:
         import traceback
         error_detail = traceback.format_exc()
@@ -2845,6 +5042,26 @@ async def export_excel(request: Request):
         return Response(content=f"导出失败: {str(e)}", status_code=500)
 
 
+@app.get("/api/export/jobs/{job_id}")
+async def export_job_info(job_id: str, request: Request):
+    """导出任务状态（管理后台任务需管理员 token，聊天导出任务需签名参数）"""
+    job = get_export_job(job_id)
+    if job is None:
+        return JSONResponse(content={"success": False, "error": "导出任务不存在或已过期"}, status_code=404)
+    query = authorize_export_job(request, job)
+    return {"success": True, **export_job_status(job, query)}
+
+
+@app.get("/api/export/jobs/{job_id}/download")
+async def export_job_file(job_id: str, request: Request):
+    """下载导出文件；未完成时返回自动刷新的等待页（校验方式同任务状态）"""
+    job = get_export_job(job_id)
+    if job is None:
+        return Response(content="导出任务不存在或已过期，请重新导出", status_code=404)
+    query = authorize_export_job(request, job)
+    return await respond_export_job(job, page=True, query=query)
+
+
 @app.get("/api/import", response_class=HTMLResponse)
 async def import_page():
     """上传页面"""
@@ -2878,33 +5095,58 @@ async def import_excel(file: UploadFile = File(...), request: Request = None):
         if parsed.get("error"):
             return Response(content=parsed["error"], status_code=400)
         
-        updates = parsed.get("updates", [])
-        if not updates:
-            return Response(content="no_valid_records", status_code=400)
+        result = await run_in_threadpool(batch_update_records, parsed["updates"])
+        if not result["total"]:
+            return Response(content="parse_failed" if result["parse_error"] else "no_valid_records", status_code=400)
         
-        result = batch_update_records(updates)
-        return Response(
-            content=f"ok: {result['success']} success, {len(result['failed'])} failed",
-            media_type="text/plain"
-        )
+        lines = [f"ok: {result['success']} success, {len(result['failed'])} failed, {result['unchanged']} unchanged",
+                 f"{result['chunks']} chunks, {result['elapsed']}s, {result['rows_per_second']} rows/s"]
+        for err in result["chunk_errors"]:
+            lines.append(f"chunk {err['chunk'] + 1} (id {err['first_id']}~{err['last_id']}, {err['rows']} rows) failed: {err['error']}")
+        if result["parse_error"]:
+            lines.append(f"parse stopped early: {result['parse_error']}")
+        return Response(content="\n".join(lines), media_type="text/plain")
     except Exception as e:
         print(f"导入错误: {str(e)[:100]}")
         return Response(content="error", status_code=500)
 
 
 @app.post("/api/admin/import")
-async def admin_import_excel(file: UploadFile = File(...), payload: dict = Depends(verify_admin_token)):
-    """管理后台：批量导入修改后的 Excel（按 ID 更新已有记录）"""
+async def admin_import_excel(file: UploadFile = File(...), dry_run: bool = False, payload: dict = Depends(verify_admin_token)):
+    """管理后台：批量导入修改后的 Excel（按 ID 更新已有记录，只写入有变化的行；dry_run=1 时只预览改动）"""
     try:
         file_bytes = await file.read()
         parsed = parse_import_excel(file_bytes)
         if parsed.get("error"):
             return {"success": False, "error": parsed["error"]}
-        updates = parsed.get("updates", [])
-        if not updates:
-            return {"success": False, "error": "没有可更新的记录"}
-        result = batch_update_records(updates)
-        return {"success": True, "updated": result["success"], "failed": len(result["failed"]), "message": f"已更新 {result['success']} 条，失败 {len(result['failed'])} 条"}
+        result = await run_in_threadpool(batch_update_records, parsed["updates"], None, dry_run)
+        if not result["total"]:
+            return {"success": False, "error": result["parse_error"] or "没有可更新的记录"}
+        if dry_run:
+            message = f"预览：将更新 {result['changed']} 条，未变化 {result['unchanged']} 条，无法更新 {len(result['failed'])} 条"
+        else:
+            message = f"已更新 {result['success']} 条，未变化 {result['unchanged']} 条，失败 {len(result['failed'])} 条"
+        message += f"（{result['chunks']} 批，耗时 {result['elapsed']}s，{result['rows_per_second']} 条/秒）"
+        if result["chunk_errors"]:
+            message += "；失败批次：" + "；".join(
+                f"第 {err['chunk'] + 1} 批（ID {err['first_id']}~{err['last_id']}）{err['error']}" for err in result["chunk_errors"])
+        if result["parse_error"]:
+            message += f"；文件读取中断：{result['parse_error']}"
+        return {
+            "success": True,
+            "dry_run": dry_run,
+            "updated": result["success"],
+            "changed": result["changed"],
+            "unchanged": result["unchanged"],
+            "failed": len(result["failed"]),
+            "failed_ids": result["failed"][:100],
+            "diff": result["diff"],
+            "chunks": result["chunks"],
+            "chunk_errors": result["chunk_errors"],
+            "elapsed": result["elapsed"],
+            "rows_per_second": result["rows_per_second"],
+            "message": message
+        }
     except Exception as e:
         print(f"导入错误: {str(e)[:100]}")
         return {"success": False, "error": str(e)}
@@ -2960,13 +5202,12 @@ async def report_weekly(request: Request):
     if not REPORT_TOKEN or token != REPORT_TOKEN:
         return Response(content="invalid", status_code=403)
     try:
-        text = build_report_text("7days", "近七天")
-        subscribers = list_subscribers("weekly")
-        success = 0
-        for openid in subscribers:
-            if send_text_message(openid, text):
-                success += 1
-        return Response(content=f"ok {success}/{len(subscribers)}", media_type="text/plain")
+        subscribers = await run_in_threadpool(list_subscribers, "weekly")
+        messages = await run_in_threadpool(build_report_texts, "7days", "近七天", subscribers)
+        report = await fan_out_text_messages(messages)
+        print(f"周报推送: {report['sent']}/{report['total']} 成功，重试 {report['retries']} 次，"
+              f"耗时 {report['elapsed']}s，p99 {report['latency_ms']['p99']}ms")
+        return Response(content=format_delivery_report(report), media_type="text/plain")
     except Exception as e:
         print(f"周报推送错误: {str(e)[:100]}")
         return Response(content="error", status_code=500)
@@ -2979,13 +5220,12 @@ async def report_monthly(request: Request):
     if not REPORT_TOKEN or token != REPORT_TOKEN:
         return Response(content="invalid", status_code=403)
     try:
-        text = build_report_text("30days", "近一个月")
-        subscribers = list_subscribers("monthly")
-        success = 0
-        for openid in subscribers:
-            if send_text_message(openid, text):
-                success += 1
-        return Response(content=f"ok {success}/{len(subscribers)}", media_type="text/plain")
+        subscribers = await run_in_threadpool(list_subscribers, "monthly")
+        messages = await run_in_threadpool(build_report_texts, "30days", "近一个月", subscribers)
+        report = await fan_out_text_messages(messages)
+        print(f"月报推送: {report['sent']}/{report['total']} 成功，重试 {report['retries']} 次，"
+              f"耗时 {report['elapsed']}s，p99 {report['latency_ms']['p99']}ms")
+        return Response(content=format_delivery_report(report), media_type="text/plain")
     except Exception as e:
         print(f"月报推送错误: {str(e)[:100]}")
         return Response(content="error", status_code=500)
@@ -3011,20 +5251,18 @@ async def admin_login(request: Request):
         # 获取客户端 IP
         client_ip = request.client.host if request.client else "unknown"
         
-        # 检查是否被锁定
-        if client_ip in LOGIN_ATTEMPTS:
-            attempts = LOGIN_ATTEMPTS[client_ip]
-            if attempts["count"] >= MAX_LOGIN_ATTEMPTS:
-                lockout_until = attempts.get("lockout_until", 0)
-                if int(time.time()) < lockout_until:
-                    remaining = lockout_until - int(time.time())
-                    return {
-                        "success": False,
-                        "error": f"登录失败次数过多，请 {remaining} 秒后再试"
-                    }
-                else:
-                    # 锁定时间已过，重置
-                    LOGIN_ATTEMPTS.pop(client_ip, None)
+        # 检查是否被锁定（失败记录在最后一次失败 LOGIN_LOCKOUT_TIME 秒后由状态存储自动过期）
+        state = get_state_store()
+        attempts = state.get(STATE_LOGIN, client_ip) or {"count": 0}
+        if attempts["count"] >= MAX_LOGIN_ATTEMPTS:
+            remaining = attempts.get("lockout_until", 0) - int(time.time())
+            if remaining > 0:
+                return {
+                    "success": False,
+                    "error": f"登录失败次数过多，请 {remaining} 秒后再试"
+                }
+            # 锁定时间已过，重置
+            attempts = {"count": 0}
         
         data = await request.json()
         password = data.get("password", "")
@@ -3034,26 +5272,26 @@ async def admin_login(request: Request):
         
         if password != ADMIN_PASSWORD:
             # 记录失败次数
-            if client_ip not in LOGIN_ATTEMPTS:
-                LOGIN_ATTEMPTS[client_ip] = {"count": 0}
-            LOGIN_ATTEMPTS[client_ip]["count"] += 1
+            attempts["count"] += 1
             
             # 如果超过最大次数，锁定
-            if LOGIN_ATTEMPTS[client_ip]["count"] >= MAX_LOGIN_ATTEMPTS:
-                LOGIN_ATTEMPTS[client_ip]["lockout_until"] = int(time.time()) + LOGIN_LOCKOUT_TIME
+            if attempts["count"] >= MAX_LOGIN_ATTEMPTS:
+                attempts["lockout_until"] = int(time.time()) + LOGIN_LOCKOUT_TIME
+                state.set(STATE_LOGIN, client_ip, attempts, LOGIN_LOCKOUT_TIME)
                 return {
                     "success": False,
                     "error": f"登录失败次数过多，账户已锁定 {LOGIN_LOCKOUT_TIME} 秒"
                 }
+            state.set(STATE_LOGIN, client_ip, attempts, LOGIN_LOCKOUT_TIME)
             
-            remaining = MAX_LOGIN_ATTEMPTS - LOGIN_ATTEMPTS[client_ip]["count"]
+            remaining = MAX_LOGIN_ATTEMPTS - attempts["count"]
             return {
                 "success": False,
                 "error": f"密码错误，还可尝试 {remaining} 次"
             }
         
         # 登录成功，清除失败记录
-        LOGIN_ATTEMPTS.pop(client_ip, None)
+        state.delete(STATE_LOGIN, client_ip)
         
         # 生成Token（24小时过期）
         token = jwt.encode(
@@ -3081,20 +5319,17 @@ async def admin_overview(payload: dict = Depends(verify_admin_token)):
         month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         
         # 总记录数（使用缓存）
-        all_records = get_records_cached()
-        total_count = len(all_records)
+        store = await get_records_cached_async()
+        total_count = len(store)
         
         # 今日记录
-        today_records = filter_records_by_local_range(all_records, today_start, now + timedelta(days=1))
-        today_amount = sum(float(r["amount"]) for r in today_records)
+        today_amount, _ = store.totals(today_start, now + timedelta(days=1))
         
         # 本月记录
-        month_records = filter_records_by_local_range(all_records, month_start, now + timedelta(days=1))
-        month_amount = sum(float(r["amount"]) for r in month_records)
+        month_amount, _ = store.totals(month_start, now + timedelta(days=1))
         
         # 分类数量
-        categories = set(r["category"] for r in all_records)
-        category_count = len(categories)
+        category_count = len(set(store.category_ids))
         
         return {
             "success": True,
@@ -3133,7 +5368,7 @@ async def admin_records(
         if date_to:
             end_date = datetime.strptime(date_to, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ) + timedelta(days=1)
         
-        records = get_records(start_date=start_date, end_date=end_date)
+        records = await get_records_async(start_date=start_date, end_date=end_date)
         
         # 搜索过滤
         if search:
@@ -3219,15 +5454,15 @@ async def admin_update_record(
         if created_at:
             update_data["created_at"] = to_utc_iso(created_at)
         
-        supabase = get_supabase_client()
-        result = supabase.table("records").update(update_data).eq("id", record_id).execute()
-        invalidate_records_cache()
+        supabase = get_supabase_async_client()
+        result = await supabase.table("records").update(update_data).eq("id", record_id).execute()
+        apply_records_to_cache(result.data)
         if result.data:
             # 查询同备注的记录数量，供前端判断是否需要批量修改映射
             same_desc_count = 0
             if description:
                 try:
-                    cnt = supabase.table("records").select("id", count="exact").eq("description", description).execute()
+                    cnt = await supabase.table("records").select("id", count="exact").eq("description", description).execute()
                     same_desc_count = cnt.count if cnt.count is not None else len(cnt.data)
                 except Exception:
                     same_desc_count = 1
@@ -3253,7 +5488,7 @@ async def admin_update_desc_category(request: Request, payload: dict = Depends(v
         updated = len(result.data) if result.data else 0
         # 更新别名映射
         add_category_alias(description, new_category)
-        invalidate_records_cache()
+        apply_records_to_cache(result.data)
         return {"success": True, "updated": updated}
     except Exception as e:
         print(f"批量修改备注分类错误: {str(e)[:100]}")
@@ -3305,15 +5540,15 @@ async def admin_stats(
         date = params.get("date", "")
         week = params.get("week", "")
         
-        all_records = get_records_cached()
+        store = await get_records_cached_async()
         
-        # 根据筛选条件过滤记录
+        # 根据筛选条件过滤记录（下标）
         if date:
             # 单日
             date_obj = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ)
             date_start = date_obj
             date_end = date_obj + timedelta(days=1)
-            records = filter_records_by_local_range(all_records, date_start, date_end)
+            range_start, range_end = date_start, date_end
         elif year and month:
             # 单月
             year_int = int(year)
@@ -3323,90 +5558,50 @@ async def admin_stats(
                 month_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             else:
                 month_end = datetime(year_int, month_int + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            records = filter_records_by_local_range(all_records, month_start, month_end)
+            range_start, range_end = month_start, month_end
         elif year:
             # 全年
             year_int = int(year)
             year_start = datetime(year_int, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             year_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            records = filter_records_by_local_range(all_records, year_start, year_end)
+            range_start, range_end = year_start, year_end
         elif week:
             # 本周
             now = datetime.now(LOCAL_TZ)
             days_since_monday = now.weekday()
             week_start = (now - timedelta(days=days_since_monday)).replace(hour=0, minute=0, second=0, microsecond=0)
             week_end = now + timedelta(days=1)
-            records = filter_records_by_local_range(all_records, week_start, week_end)
+            range_start, range_end = week_start, week_end
         else:
             # 全部
-            records = all_records
-        
-        # 分类统计
-        category_amounts = {}
-        for r in records:
-            cat = r.get("category", "其他")
-            amount = float(r.get("amount", 0))
-            category_amounts[cat] = category_amounts.get(cat, 0) + amount
+            range_start, range_end = None, None
         
-        category_labels = list(category_amounts.keys())
-        category_amounts_list = [category_amounts[c] for c in category_labels]
+        # 分类统计（按最近一次使用排序）
+        category_totals = store.aggregate(range_start, range_end, "category")
+        category_labels = store.order_by_recent(category_totals, range_start, range_end)
+        category_amounts_list = [category_totals[c][0] for c in category_labels]
         
         # 趋势统计
         if date:
             # 按小时统计
-            hourly_amounts = {}
-            for r in records:
-                dt = to_local_datetime(r["created_at"])
-                hour_key = dt.strftime("%H:00")
-                amount = float(r.get("amount", 0))
-                hourly_amounts[hour_key] = hourly_amounts.get(hour_key, 0) + amount
+            hourly_amounts = store.aggregate(range_start, range_end, "hour")
             sorted_hours = sorted(hourly_amounts.keys())
             trend_labels = sorted_hours
-            trend_amounts = [hourly_amounts[h] for h in sorted_hours]
-        elif year and month:
-            # 按日统计
-            daily_amounts = {}
-            for r in records:
-                dt = to_local_datetime(r["created_at"])
-                day_key = dt.strftime("%m-%d")
-                amount = float(r.get("amount", 0))
-                daily_amounts[day_key] = daily_amounts.get(day_key, 0) + amount
-            sorted_days = sorted(daily_amounts.keys())
-            trend_labels = sorted_days
-            trend_amounts = [daily_amounts[d] for d in sorted_days]
-        elif week:
-            # 按日统计（本周）
-            daily_amounts = {}
-            for r in records:
-                dt = to_local_datetime(r["created_at"])
-                day_key = dt.strftime("%m-%d")
-                amount = float(r.get("amount", 0))
-                daily_amounts[day_key] = daily_amounts.get(day_key, 0) + amount
+            trend_amounts = [hourly_amounts[h][0] for h in sorted_hours]
+        elif (year and month) or week:
+            # 按日统计（单月 / 本周）
+            daily_amounts = store.aggregate(range_start, range_end, "day")
             sorted_days = sorted(daily_amounts.keys())
-            trend_labels = sorted_days
-            trend_amounts = [daily_amounts[d] for d in sorted_days]
-        elif year:
-            # 按月统计
-            monthly_amounts = {}
-            for r in records:
-                dt = to_local_datetime(r["created_at"])
-                month_key = dt.strftime("%Y-%m")
-                amount = float(r.get("amount", 0))
-                monthly_amounts[month_key] = monthly_amounts.get(month_key, 0) + amount
-            sorted_months = sorted(monthly_amounts.keys())
-            trend_labels = sorted_months
-            trend_amounts = [monthly_amounts[m] for m in sorted_months]
+            trend_labels = [d[5:] for d in sorted_days]
+            trend_amounts = [daily_amounts[d][0] for d in sorted_days]
         else:
-            # 默认：近12个月
-            monthly_amounts = {}
-            for r in records:
-                dt = to_local_datetime(r["created_at"])
-                month_key = dt.strftime("%Y-%m")
-                amount = float(r.get("amount", 0))
-                monthly_amounts[month_key] = monthly_amounts.get(month_key, 0) + amount
-            sorted_months = sorted(monthly_amounts.keys())[-12:]
+            # 按月统计（全年 / 默认近12个月）
+            monthly_amounts = store.aggregate(range_start, range_end, "month")
+            sorted_months = sorted(monthly_amounts.keys())
+            if not year:
+                sorted_months = sorted_months[-12:]
             trend_labels = sorted_months
-            trend_amounts = [monthly_amounts[m] for m in sorted_months]
+            trend_amounts = [monthly_amounts[m][0] for m in sorted_months]
         
         return {
             "success": True,
@@ -3425,15 +5620,11 @@ async def admin_stats(
 async def admin_categories(payload: dict = Depends(verify_admin_token)):
     """分类列表（含记录中的分类 + 手动添加的预设，预设无记录时 count/amount 为 0）"""
     try:
-        records = get_records()
-        category_stats = {}
-        for r in records:
-            cat = r.get("category", "其他")
-            amount = float(r.get("amount", 0))
-            if cat not in category_stats:
-                category_stats[cat] = {"count": 0, "amount": 0}
-            category_stats[cat]["count"] += 1
-            category_stats[cat]["amount"] += amount
+        store = await get_records_cached_async()
+        category_stats = {
+            cat: {"count": count, "amount": amount}
+            for cat, (amount, count) in store.aggregate(group_by="category").items()
+        }
         for p in get_category_presets():
             if p and p not in category_stats:
                 category_stats[p] = {"count": 0, "amount": 0}
@@ -3736,23 +5927,32 @@ async def admin_batch_set_category(request: Request, payload: dict = Depends(ver
             return {"success": False, "error": "请选择记录并指定分类"}
         supabase = get_supabase_client()
         updated = 0
+        updated_rows = []
         for rid in ids:
             try:
                 r = supabase.table("records").select("amount,description").eq("id", rid).execute()
                 if not r.data or len(r.data) == 0:
                     continue
                 row = r.data[0]
-                supabase.table("records").update({"category": category}).eq("id", rid).execute()
+                result = supabase.table("records").update({"category": category}).eq("id", rid).execute()
+                updated_rows.extend(result.data or [])
                 updated += 1
             except Exception:
                 pass
-        invalidate_records_cache()
+        apply_records_to_cache(updated_rows)
         return {"success": True, "updated": updated}
     except Exception as e:
         print(f"批量改分类错误: {str(e)[:100]}")
         return {"success": False, "error": str(e)}
 
 
+@app.get("/api/admin/metrics")
+async def admin_metrics(payload: dict = Depends(verify_admin_token)):
+    """运行指标（连接池等，用于监控）"""
+    return {"success": True, "supabase_pool": get_supabase_pool_stats(), "webhook": get_webhook_stats(),
+            "dedup": get_dedup_stats()}
+
+
 @app.get("/api/admin/settings")
 async def admin_get_settings(payload: dict = Depends(verify_admin_token)):
     """获取所有设置"""
@@ -3802,8 +6002,8 @@ async def admin_monthly_stats(
         force_refresh = params.get("fresh") == "1"
         now = datetime.now(LOCAL_TZ)
         year = now.year
-        all_records = get_records_cached(force_refresh=force_refresh)
-        print(f"月度统计: 获取到 {len(all_records)} 条记录")
+        store = await get_records_cached_async(force_refresh=force_refresh)
+        print(f"月度统计: 获取到 {len(store)} 条记录")
         
         monthly_stats = {}
         for month in range(1, 13):
@@ -3813,9 +6013,7 @@ async def admin_monthly_stats(
             else:
                 month_end = datetime(year, month + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             
-            month_records = filter_records_by_local_range(all_records, month_start, month_end)
-            month_amount = sum(float(r["amount"]) for r in month_records)
-            month_count = len(month_records)
+            month_amount, month_count = store.totals(month_start, month_end)
             
             monthly_stats[f"{year}-{month:02d}"] = {
                 "month": month,
@@ -3827,7 +6025,7 @@ async def admin_monthly_stats(
             "success": True,
             "year": year,
             "months": monthly_stats,
-            "total_records": len(all_records)
+            "total_records": len(store)
         }
     except Exception as e:
         import traceback
@@ -3852,14 +6050,14 @@ async def admin_daily_stats(
             month_end = datetime(year + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
         else:
             month_end = datetime(year, month + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-        all_records = get_records_cached(force_refresh=force_refresh)
-        month_records = filter_records_by_local_range(all_records, month_start, month_end)
+        store = await get_records_cached_async(force_refresh=force_refresh)
+        month_records = store.select(month_start, month_end)
         
         daily_stats = {}
-        for r in month_records:
-            dt = to_local_datetime(r["created_at"])
+        for i in month_records:
+            dt = store.local_datetime(i)
             day_key = dt.strftime("%Y-%m-%d")
-            amount = float(r["amount"])
+            amount = store.amounts[i]
             if day_key not in daily_stats:
                 daily_stats[day_key] = {"amount": 0, "count": 0}
             daily_stats[day_key]["amount"] += amount
@@ -3906,18 +6104,18 @@ async def admin_date_records(
         date_start = date_obj
         date_end = date_obj + timedelta(days=1)
         
-        all_records = get_records_cached()
-        date_records = filter_records_by_local_range(all_records, date_start, date_end)
+        store = await get_records_cached_async()
+        date_records = store.select(date_start, date_end)
         
         formatted = []
-        for r in date_records:
-            dt = to_local_datetime(r["created_at"])
+        for i in date_records:
+            dt = store.local_datetime(i)
             formatted.append({
-                "id": r["id"],
+                "id": store.ids[i],
                 "time": dt.strftime("%H:%M"),
-                "description": r.get("description", ""),
-                "amount": float(r.get("amount", 0)),
-                "category": r.get("category", "")
+                "description": store.descriptions[i],
+                "amount": store.amounts[i],
+                "category": store.category(i)
             })
         
         # 按时间排序
@@ -3951,27 +6149,19 @@ async def admin_month_category_stats(
         else:
             month_end = datetime(year, month + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
         
-        all_records = get_records_cached()
-        month_records = filter_records_by_local_range(all_records, month_start, month_end)
+        store = await get_records_cached_async()
         
         # 按分类统计
-        category_stats = {}
-        for r in month_records:
-            category = r.get("category", "未分类")
-            amount = float(r.get("amount", 0))
-            if category not in category_stats:
-                category_stats[category] = {"amount": 0, "count": 0}
-            category_stats[category]["amount"] += amount
-            category_stats[category]["count"] += 1
+        category_stats = store.aggregate(month_start, month_end, "category")
         
         # 转换为列表并按金额排序
         category_list = [
             {
                 "category": cat,
-                "amount": stats["amount"],
-                "count": stats["count"]
+                "amount": amount,
+                "count": count
             }
-            for cat, stats in category_stats.items()
+            for cat, (amount, count) in category_stats.items()
         ]
         category_list.sort(key=lambda x: x["amount"], reverse=True)
         
@@ -4004,27 +6194,19 @@ async def admin_year_category_stats(
         year_start = datetime(year, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
         year_end = datetime(year + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
         
-        all_records = get_records_cached()
-        year_records = filter_records_by_local_range(all_records, year_start, year_end)
+        store = await get_records_cached_async()
         
         # 按分类统计
-        category_stats = {}
-        for r in year_records:
-            category = r.get("category", "未分类")
-            amount = float(r.get("amount", 0))
-            if category not in category_stats:
-                category_stats[category] = {"amount": 0, "count": 0}
-            category_stats[category]["amount"] += amount
-            category_stats[category]["count"] += 1
+        category_stats = store.aggregate(year_start, year_end, "category")
         
         # 转换为列表并按金额排序
         category_list = [
             {
                 "category": cat,
-                "amount": stats["amount"],
-                "count": stats["count"]
+                "amount": amount,
+                "count": count
             }
-            for cat, stats in category_stats.items()
+            for cat, (amount, count) in category_stats.items()
         ]
         category_list.sort(key=lambda x: x["amount"], reverse=True)
         
@@ -4056,27 +6238,19 @@ async def admin_date_category_stats(
         date_start = date_obj
         date_end = date_obj + timedelta(days=1)
         
-        all_records = get_records_cached()
-        date_records = filter_records_by_local_range(all_records, date_start, date_end)
+        store = await get_records_cached_async()
         
         # 按分类统计
-        category_stats = {}
-        for r in date_records:
-            category = r.get("category", "未分类")
-            amount = float(r.get("amount", 0))
-            if category not in category_stats:
-                category_stats[category] = {"amount": 0, "count": 0}
-            category_stats[category]["amount"] += amount
-            category_stats[category]["count"] += 1
+        category_stats = store.aggregate(date_start, date_end, "category")
         
         # 转换为列表并按金额排序
         category_list = [
             {
                 "category": cat,
-                "amount": stats["amount"],
-                "count": stats["count"]
+                "amount": amount,
+                "count": count
             }
-            for cat, stats in category_stats.items()
+            for cat, (amount, count) in category_stats.items()
         ]
         category_list.sort(key=lambda x: x["amount"], reverse=True)
         
@@ -4107,15 +6281,15 @@ async def admin_category_records(
         if not category:
             return {"success": False, "error": "缺少分类参数"}
         
-        all_records = get_records_cached()
+        store = await get_records_cached_async()
         
-        # 根据时间范围筛选
+        # 根据时间范围筛选（下标）
         if date:
             # 单日
             date_obj = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ)
             date_start = date_obj
             date_end = date_obj + timedelta(days=1)
-            filtered = filter_records_by_local_range(all_records, date_start, date_end)
+            filtered = store.select(date_start, date_end)
         elif year and month:
             # 单月
             year_int = int(year)
@@ -4125,30 +6299,31 @@ async def admin_category_records(
                 month_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             else:
                 month_end = datetime(year_int, month_int + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            filtered = filter_records_by_local_range(all_records, month_start, month_end)
+            filtered = store.select(month_start, month_end)
         elif year:
             # 全年
             year_int = int(year)
             year_start = datetime(year_int, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             year_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            filtered = filter_records_by_local_range(all_records, year_start, year_end)
+            filtered = store.select(year_start, year_end)
         else:
-            filtered = all_records
+            filtered = store.select()
         
-        # 按分类筛选
-        category_records = [r for r in filtered if r.get("category", "") == category]
+        # 按分类筛选（比较分类 id，不存在的分类直接为空）
+        category_id = store.category_index.get(category)
+        category_records = [i for i in filtered if store.category_ids[i] == category_id]
         
         # 格式化
         formatted = []
-        for r in category_records:
-            dt = to_local_datetime(r["created_at"])
+        for i in category_records:
+            dt = store.local_datetime(i)
             formatted.append({
-                "id": r["id"],
+                "id": store.ids[i],
                 "date": dt.strftime("%Y-%m-%d"),
                 "time": dt.strftime("%H:%M"),
-                "description": r.get("description", ""),
-                "amount": float(r.get("amount", 0)),
-                "category": r.get("category", "")
+                "description": store.descriptions[i],
+                "amount": store.amounts[i],
+                "category": category
             })
         
         # 按日期和时间排序
@@ -4179,11 +6354,8 @@ async def admin_batch_delete_records(
         if not record_ids:
             return {"success": False, "error": "请选择要删除的记录"}
         
-        deleted_count = 0
-        for record_id in record_ids:
-            result = delete_record(record_id)
-            if result.get("success"):
-                deleted_count += 1
+        result = delete_records([int(record_id) for record_id in record_ids])
+        deleted_count = len(result.data or [])
         
         return {
             "success": True,
@@ -4234,12 +6406,15 @@ async def admin_export(
         month = params.get("month", "")
         date_from = params.get("date_from", "")
         date_to = params.get("date_to", "")
+        export_format = params.get("format", "xlsx")
+        if export_format not in EXPORT_FORMATS:
+            return {"success": False, "error": "导出格式错误（支持 xlsx、csv、ndjson.gz）"}
         
-        all_records = get_records_cached()
+        store = await get_records_cached_async()
         
-        # 根据period筛选记录
+        # 根据period筛选记录（下标）
         if period == "all":
-            filtered = all_records
+            filtered = store.select()
         elif period == "month" and year and month:
             year_int = int(year)
             month_int = int(month)
@@ -4248,54 +6423,54 @@ async def admin_export(
                 month_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             else:
                 month_end = datetime(year_int, month_int + 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            filtered = filter_records_by_local_range(all_records, month_start, month_end)
+            filtered = store.select(month_start, month_end)
         elif period == "year" and year:
             year_int = int(year)
             year_start = datetime(year_int, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             year_end = datetime(year_int + 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            filtered = filter_records_by_local_range(all_records, year_start, year_end)
+            filtered = store.select(year_start, year_end)
         elif period == "custom" and date_from and date_to:
             start_date = datetime.strptime(date_from, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ)
             end_date = datetime.strptime(date_to, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ) + timedelta(days=1)
-            filtered = filter_records_by_local_range(all_records, start_date, end_date)
+            filtered = store.select(start_date, end_date)
         else:
-            filtered = all_records
+            filtered = store.select()
 
         # 按分类筛选（可选）
         categories_param = params.get("categories", "")
         if categories_param:
             cat_list = [c.strip() for c in categories_param.split(",") if c.strip()]
             if cat_list:
-                filtered = [r for r in filtered if r.get("category", "").strip() in cat_list]
+                filtered = [i for i in filtered if store.category(i).strip() in cat_list]
         
         # 导出用时间范围（用于 Excel 表头）
         if filtered:
-            from_dates = [to_local_datetime(r["created_at"]) for r in filtered]
-            export_start = min(from_dates).replace(hour=0, minute=0, second=0, microsecond=0)
-            export_end = max(from_dates) + timedelta(days=1)
+            timestamps = [store.local_ts[i] for i in filtered]
+            export_start = from_local_ts(min(timestamps)).replace(hour=0, minute=0, second=0, microsecond=0)
+            export_end = from_local_ts(max(timestamps)) + timedelta(days=1)
         else:
             export_start = datetime.now(LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
             export_end = export_start + timedelta(days=1)
         
-        # 生成Excel
-        excel_bytes = build_export_excel_bytes(filtered, export_start, export_end, limit=10000)
-        
         # 生成文件名
         now = datetime.now(LOCAL_TZ)
+        extension = EXPORT_FORMATS[export_format][0]
         if period == "month" and year and month:
-            filename = f"records_{year}{month:02d}_export.xlsx"
+            filename = f"records_{year}{int(month):02d}_export.{extension}"
         elif period == "year" and year:
-            filename = f"records_{year}_export.xlsx"
+            filename = f"records_{year}_export.{extension}"
         elif period == "custom":
-            filename = f"records_{date_from}_to_{date_to}_export.xlsx"
+            filename = f"records_{date_from}_to_{date_to}_export.{extension}"
         else:
-            filename = f"records_all_{now.strftime('%Y%m%d_%H%M%S')}_export.xlsx"
+            filename = f"records_all_{now.strftime('%Y%m%d_%H%M%S')}_export.{extension}"
         
-        return Response(
-            content=excel_bytes,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+        # 生成导出文件（只在任务线程里物化明细行；相同筛选和数据版本复用已生成的文件）
+        key = {"kind": "admin", "start": export_start.strftime("%Y-%m-%d"), "end": export_end.strftime("%Y-%m-%d"),
+               "categories": sorted(cat_list) if categories_param else [], "count": len(filtered),
+               "format": export_format, "version": store.version}
+        job = submit_export_job(key, filename, export_format, lambda path: write_export_file(
+            store.rows(filtered), export_format, export_start, export_end, 10000, path))
+        return await respond_export_job(job)
     except Exception as e:
         print(f"导出错误: {str(e)[:100]}")
         return {"success": False, "error": str(e)}
@@ -4308,17 +6483,22 @@ async def admin_backup(
 ):
     """数据备份（导出所有数据）"""
     try:
-        all_records = get_records_cached()
-        excel_bytes = build_export_excel_bytes(all_records)
-        
+        export_format = request.query_params.get("format", "xlsx")
+        if export_format not in EXPORT_FORMATS:
+            return {"success": False, "error": "导出格式错误（支持 xlsx、csv、ndjson.gz）"}
+        store = await get_records_cached_async()
         now = datetime.now(LOCAL_TZ)
-        filename = f"backup_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
-        
-        return Response(
-            content=excel_bytes,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+        filename = f"backup_{now.strftime('%Y%m%d_%H%M%S')}.{EXPORT_FORMATS[export_format][0]}"
+        if len(store):
+            backup_start = from_local_ts(store.local_ts[-1]).replace(hour=0, minute=0, second=0, microsecond=0)
+            backup_end = from_local_ts(store.local_ts[0]) + timedelta(days=1)
+        else:
+            backup_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            backup_end = backup_start + timedelta(days=1)
+        key = {"kind": "backup", "format": export_format, "version": store.version}
+        job = submit_export_job(key, filename, export_format, lambda path: write_export_file(
+            store.rows(), export_format, backup_start, backup_end, len(store), path))
+        return await respond_export_job(job)
     except Exception as e:
         print(f"备份错误: {str(e)[:100]}")
         return {"success": False, "error": str(e)}
@@ -4335,7 +6515,7 @@ async def admin_comparison(
         type = params.get("type", "month")  # month, year
         
         now = datetime.now(LOCAL_TZ)
-        all_records = get_records_cached()
+        store = await get_records_cached_async()
         
         if type == "month":
             # 本月 vs 上月
@@ -4347,11 +6527,8 @@ async def admin_comparison(
                 last_month_start = datetime(now.year, now.month - 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
                 last_month_end = current_month_start
             
-            current_records = filter_records_by_local_range(all_records, current_month_start, now + timedelta(days=1))
-            last_records = filter_records_by_local_range(all_records, last_month_start, last_month_end)
-            
-            current_amount = sum(float(r["amount"]) for r in current_records)
-            last_amount = sum(float(r["amount"]) for r in last_records)
+            current_amount, current_count = store.totals(current_month_start, now + timedelta(days=1))
+            last_amount, last_count = store.totals(last_month_start, last_month_end)
             
             return {
                 "success": True,
@@ -4359,12 +6536,12 @@ async def admin_comparison(
                 "current": {
                     "period": f"{now.year}年{now.month}月",
                     "amount": current_amount,
-                    "count": len(current_records)
+                    "count": current_count
                 },
                 "last": {
                     "period": f"{last_month_start.year}年{last_month_start.month}月",
                     "amount": last_amount,
-                    "count": len(last_records)
+                    "count": last_count
                 },
                 "change": current_amount - last_amount,
                 "change_percent": ((current_amount - last_amount) / last_amount * 100) if last_amount > 0 else 0
@@ -4375,11 +6552,8 @@ async def admin_comparison(
             last_year_start = datetime(now.year - 1, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             last_year_end = current_year_start
             
-            current_records = filter_records_by_local_range(all_records, current_year_start, now + timedelta(days=1))
-            last_records = filter_records_by_local_range(all_records, last_year_start, last_year_end)
-            
-            current_amount = sum(float(r["amount"]) for r in current_records)
-            last_amount = sum(float(r["amount"]) for r in last_records)
+            current_amount, current_count = store.totals(current_year_start, now + timedelta(days=1))
+            last_amount, last_count = store.totals(last_year_start, last_year_end)
             
             return {
                 "success": True,
@@ -4387,12 +6561,12 @@ async def admin_comparison(
                 "current": {
                     "period": f"{now.year}年",
                     "amount": current_amount,
-                    "count": len(current_records)
+                    "count": current_count
                 },
                 "last": {
                     "period": f"{now.year - 1}年",
                     "amount": last_amount,
-                    "count": len(last_records)
+                    "count": last_count
                 },
                 "change": current_amount - last_amount,
                 "change_percent": ((current_amount - last_amount) / last_amount * 100) if last_amount > 0 else 0
@@ -4414,15 +6588,15 @@ async def admin_weekly_stats(payload: dict = Depends(verify_admin_token)):
         week_start = (now - timedelta(days=days_since_monday)).replace(hour=0, minute=0, second=0, microsecond=0)
         week_end = now + timedelta(days=1)
         
-        all_records = get_records_cached()
-        week_records = filter_records_by_local_range(all_records, week_start, week_end)
+        store = await get_records_cached_async()
+        week_records = store.select(week_start, week_end)
         
         # 按天统计
         daily_stats = {}
-        for r in week_records:
-            dt = to_local_datetime(r["created_at"])
+        for i in week_records:
+            dt = store.local_datetime(i)
             day_key = dt.strftime("%Y-%m-%d")
-            amount = float(r["amount"])
+            amount = store.amounts[i]
             if day_key not in daily_stats:
                 daily_stats[day_key] = {"amount": 0, "count": 0, "date": day_key}
             daily_stats[day_key]["amount"] += amount
@@ -4442,7 +6616,7 @@ async def admin_weekly_stats(payload: dict = Depends(verify_admin_token)):
             })
             current += timedelta(days=1)
         
-        total_amount = sum(float(r["amount"]) for r in week_records)
+        total_amount = store.total(week_records)
         avg_daily = total_amount / 7 if len(days) > 0 else 0
         
         return {
@@ -4469,6 +6643,7 @@ async def admin_quarterly_stats(
         params = dict(request.query_params)
         year = int(params.get("year", datetime.now(LOCAL_TZ).year))
         
+        store = await get_records_cached_async()
         quarters = []
         for q in range(1, 5):
             month_start = (q - 1) * 3 + 1
@@ -4478,14 +6653,13 @@ async def admin_quarterly_stats(
             else:
                 quarter_end = datetime(year, month_start + 3, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
             
-            all_records = get_records_cached()
-            quarter_records = filter_records_by_local_range(all_records, quarter_start, quarter_end)
+            quarter_amount, quarter_count = store.totals(quarter_start, quarter_end)
             
             quarters.append({
                 "quarter": q,
                 "period": f"Q{q}",
-                "amount": sum(float(r["amount"]) for r in quarter_records),
-                "count": len(quarter_records)
+                "amount": quarter_amount,
+                "count": quarter_count
             })
         
         return {
@@ -4510,19 +6684,19 @@ async def admin_avg_daily(
         period = params.get("period", "month")  # month, year, all
         
         now = datetime.now(LOCAL_TZ)
-        all_records = get_records_cached()
+        store = await get_records_cached_async()
         
         if period == "month":
             month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            filtered = filter_records_by_local_range(all_records, month_start, now + timedelta(days=1))
+            total_amount, _ = store.totals(month_start, now + timedelta(days=1))
             days = (now - month_start).days + 1
         elif period == "year":
             year_start = datetime(now.year, 1, 1, 0, 0, 0, tzinfo=LOCAL_TZ)
-            filtered = filter_records_by_local_range(all_records, year_start, now + timedelta(days=1))
+            total_amount, _ = store.totals(year_start, now + timedelta(days=1))
             days = (now - year_start).days + 1
         else:
             # all
-            if not all_records:
+            if not len(store):
                 return {
                     "success": True,
                     "period": "all",
@@ -4530,12 +6704,11 @@ async def admin_avg_daily(
                     "total_amount": 0,
                     "days": 0
                 }
-            first_record = min(all_records, key=lambda r: to_local_datetime(r["created_at"]))
-            first_date = to_local_datetime(first_record["created_at"]).replace(hour=0, minute=0, second=0, microsecond=0)
-            filtered = all_records
+            rollup = store.daily_rollup()
+            first_date = from_local_ts(rollup.days[0] * SECONDS_PER_DAY)
+            total_amount = rollup.cum_amounts[-1]
             days = (now - first_date).days + 1
         
-        total_amount = sum(float(r["amount"]) for r in filtered)
         avg_daily = total_amount / days if days > 0 else 0
         
         return {
@@ -0,0 +1,203 @@
+"""Excel 导出基准：用合成记录调用导出函数，输出耗时、峰值内存（RSS）与文件大小。
+
+用法：python scripts/bench_export.py [--records 10000] [--mode baseline|bytes|file]
+  baseline: 改为只写模式前的导出（普通工作簿，全部单元格留在内存中，写完后再逐格设置样式，wb.save 到 BytesIO），作为对照
+  bytes: build_export_excel_bytes，整个文件留在内存中返回
+  file:  write_export_file，写入导出缓存文件后由接口分块流式返回
+每次测量在独立子进程中进行，峰值内存互不影响。不连接数据库。
+"""
+import argparse
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+sys.path.insert(0, API_DIR)
+
+CATEGORIES = ["餐饮|早餐", "餐饮|午餐", "餐饮|晚餐", "交通|打车", "交通|地铁", "购物|衣服", "居家", "娱乐", "其他"]
+DESCRIPTIONS = ["早餐", "午饭", "咖啡", "打车", "地铁", "买菜", "奶茶", "水果", "电影票", "理发", "超市", "外卖"]
+
+
+def build_records(count: int, seed: int = 7) -> list:
+    """生成按时间倒序的合成记录（近两年内）"""
+    rng = random.Random(seed)
+    now = datetime(2025, 3, 15, 12, 0)
+    records = []
+    for i in range(count):
+        created_at = now - timedelta(minutes=i * 60 * 24 * 730 // max(count, 1) + rng.randint(0, 30))
+        records.append({
+            "id": count - i,
+            "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            "description": rng.choice(DESCRIPTIONS),
+            "amount": round(rng.uniform(1, 300), 2),
+            "category": rng.choice(CATEGORIES),
+        })
+    return records
+
+
+def build_baseline_excel_bytes(wechat, records: list, start_date: datetime, end_date: datetime, limit: int) -> bytes:
+    """改为只写模式前的 build_export_excel_bytes（原样保留，仅供对照）"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "汇总"
+
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill("solid", fgColor="4F81BD")
+    center_align = Alignment(horizontal="center", vertical="center")
+    border = Border(
+        left=Side(style="thin", color="D9D9D9"),
+        right=Side(style="thin", color="D9D9D9"),
+        top=Side(style="thin", color="D9D9D9"),
+        bottom=Side(style="thin", color="D9D9D9")
+    )
+
+    total_amount = sum(float(r["amount"]) for r in records[:limit])
+    ws.append(["统计区间", f"{start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}"])
+    ws.append(["记录数", len(records[:limit])])
+    ws.append(["总支出", round(total_amount, 2)])
+    ws.append([])
+
+    category_totals = {}
+    daily_totals = {}
+    for r in records[:limit]:
+        dt = wechat.to_local_datetime(r["created_at"])
+        day_key = f"{dt.month}.{dt.day}"
+        category = r["category"]
+        amount = float(r["amount"])
+        category_totals[category] = category_totals.get(category, 0) + amount
+        daily_totals[day_key] = daily_totals.get(day_key, 0) + amount
+
+    ws.append(["类目统计"])
+    ws.append(["类目", "金额", "占比"])
+    for cell in ws[ws.max_row]:
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = center_align
+        cell.border = border
+    for cat, amount in sorted(category_totals.items(), key=lambda x: -x[1]):
+        percent = (amount / total_amount * 100) if total_amount else 0
+        ws.append([cat, round(amount, 2), f"{percent:.1f}%"])
+
+    ws.append([])
+    ws.append(["每日合计"])
+    ws.append(["日期", "金额"])
+    for cell in ws[ws.max_row]:
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = center_align
+        cell.border = border
+    for day, amount in sorted(daily_totals.items()):
+        ws.append([day, round(amount, 2)])
+
+    ws.freeze_panes = "A5"
+    ws.column_dimensions["A"].width = 16
+    ws.column_dimensions["B"].width = 16
+    ws.column_dimensions["C"].width = 12
+
+    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=3):
+        for cell in row:
+            if cell.value is None:
+                continue
+            if cell.row in [1, 2, 3]:
+                cell.font = Font(bold=True)
+            if cell.row > 4:
+                cell.border = border
+            if cell.column in [2] and isinstance(cell.value, (int, float)):
+                cell.number_format = "0.00"
+
+    ws_detail = wb.create_sheet("明细")
+    ws_detail.append(["ID", "日期", "时间", "描述", "金额", "分类"])
+    for cell in ws_detail[ws_detail.max_row]:
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = center_align
+        cell.border = border
+
+    for r in records[:limit]:
+        dt = wechat.to_local_datetime(r["created_at"])
+        ws_detail.append([
+            r["id"],
+            dt.strftime("%Y-%m-%d"),
+            dt.strftime("%H:%M"),
+            r["description"],
+            float(r["amount"]),
+            r["category"]
+        ])
+
+    ws_detail.freeze_panes = "A2"
+    ws_detail.column_dimensions["A"].width = 10
+    ws_detail.column_dimensions["B"].width = 14
+    ws_detail.column_dimensions["C"].width = 10
+    ws_detail.column_dimensions["D"].width = 30
+    ws_detail.column_dimensions["E"].width = 12
+    ws_detail.column_dimensions["F"].width = 12
+
+    for row in ws_detail.iter_rows(min_row=2, max_row=ws_detail.max_row, min_col=1, max_col=6):
+        for cell in row:
+            if cell.value is None:
+                continue
+            cell.border = border
+            if cell.column == 5 and isinstance(cell.value, (int, float)):
+                cell.number_format = "0.00"
+
+    bio = io.BytesIO()
+    wb.save(bio)
+    bio.seek(0)
+    return bio.read()
+
+
+def measure(count: int, mode: str) -> None:
+    """子进程内执行一次导出并打印结果"""
+    import wechat
+
+    records = build_records(count)
+    start_date = datetime(2023, 3, 15, tzinfo=wechat.LOCAL_TZ)
+    end_date = datetime(2025, 3, 16, tzinfo=wechat.LOCAL_TZ)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if mode == "file":
+        fd, path = tempfile.mkstemp(suffix=".xlsx")
+        os.close(fd)
+        wechat.write_export_file(records, "xlsx", start_date, end_date, count, path)
+        size = os.path.getsize(path)
+        os.remove(path)
+    elif mode == "baseline":
+        size = len(build_baseline_excel_bytes(wechat, records, start_date, end_date, count))
+    else:
+        size = len(wechat.build_export_excel_bytes(records, start_date, end_date, limit=count))
+    elapsed = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{mode:8s} {count:>7,} 条：耗时 {elapsed:.2f} s，峰值 RSS 增加 {(peak_kb - baseline_kb) / 1024:.1f} MB"
+          f"（总计 {peak_kb / 1024:.1f} MB），文件 {size / 1024:.0f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Excel 导出基准")
+    parser.add_argument("--records", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--mode", choices=["baseline", "bytes", "file"], nargs="+",
+                        default=["baseline", "bytes", "file"])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.records[0], args.mode[0])
+        return
+    for count in args.records:
+        for mode in args.mode:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", "--records", str(count), "--mode", mode],
+                check=False
+            )
+
+
+if __name__ == "__main__":
+    main()
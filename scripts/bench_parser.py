@@ -0,0 +1,226 @@
+"""消息解析基准 + 回归语料：对几千条典型消息反复调用解析函数，输出每秒处理条数与 p99 延迟，
+并与 parser_golden.json 中的期望结果逐条比对，防止优化改变解析语义。
+
+用法：
+  python scripts/bench_parser.py                 # 校验 + 基准
+  python scripts/bench_parser.py --rounds 50     # 更多轮次
+  python scripts/bench_parser.py --update        # 解析规则有意变更后，重新生成期望结果
+
+不连接数据库：分类列表缓存会被预先填充，当前时间固定为 FROZEN_NOW。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import wechat  # noqa: E402
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_golden.json")
+FROZEN_NOW = datetime(2025, 3, 15, 10, 30, tzinfo=wechat.LOCAL_TZ)
+
+CATEGORIES = ["餐饮", "餐饮|早餐", "餐饮|午餐", "餐饮|晚餐", "交通", "交通|打车", "购物", "购物|衣服", "居家", "娱乐", "其他"]
+DESCRIPTIONS = ["早餐", "午饭", "咖啡", "打车", "地铁", "买菜", "奶茶", "水果", "电影票", "理发", "超市", "外卖"]
+NAMES = ["小王", "老李", "张三", "阿强"]
+UNITS = ["", "块", "元", "块钱", "rmb"]
+DATE_TOKENS = [
+    "今天", "今日", "昨天", "昨日", "本周", "本月", "3-14", "03-15", "3-16", "12-31", "1-1", "2-29", "2-30",
+    "13-01", "3-", "-3", "a-b", "3—14", "明天", "", "0-0",
+]
+MONTH_TOKENS = [
+    "1月", "01月", "3月", "4月", "12月", "2025年1月", "2024年12月", "2025-01", "2025/02", "2024-13",
+    "0月", "13月", "2025", "1 月", "2025 年 3 月", "三月", "", "本月", "2025年", "99月",
+]
+COMMANDS = [
+    "今日", "今天", "昨天", "本周", "这周", "本月", "这个月", "七天", "近七天", "半个月", "一个月", "30天",
+    "明细", "详情", "明细 昨天", "明细 01-21", "明细 本周", "帮助", "help", "?", "网页", "管理后台", "面板",
+    "统计面板", "上次", "最近", "撤销", "撤销上一条", "回收站", "恢复 2", "恢复 12", "恢复 x",
+    "导出", "导出 本月", "导出 1月", "导出excel", "导出excel 本月", "导出Excel 2025年1月", "导出表格 上月",
+    "统计", "统计 今天", "统计 本月", "统计 3月", "统计 2024-12", "统计 餐饮", "2025年1月统计", "3月统计", "餐饮统计",
+    "分类 餐饮", "分类 交通|打车", "分类列表", "所有分类", "查看分类", "周报", "月报", "订阅周报", "订阅月报",
+    "取消周报", "取消月报", "查询外债", "确认删", "确认删除", "取消删", "取消删除",
+    "删 1", "删除 2", "删 1,3,5", "删 1，3，5", "删 1-3", "删 1 - 4", "删 1~4", "删 2至5", "删 昨天 1-3",
+    "删 本周 2", "删 03-14 1,2", "删 5-2", "删 abc", "删除", "纠错 咖啡 餐饮", "纠错 咖啡", "重命名分类 早饭 早餐",
+    "重命名分类 早饭", "欠 小王 200", "欠 小王 200 饭钱", "欠 小王 20.5 打车 钱", "还 小王 100", "还 小王 abc",
+    "+早餐 8", "+ 15 咖啡", "+咖啡", "记一笔 早餐", "记一笔 打车 22", "记一笔 买菜 30 西红柿", "记一笔",
+    "补记 昨天 早餐 8", "补记 3-14 打车 22", "补记 昨天 早餐", "改 1 早餐 9", "修改 2 打车 30", "改 1 早餐",
+]
+EDGE_RECORDS = [
+    "早餐8", "早餐8块", "15咖啡", "15元咖啡", "咖啡 15", "15 咖啡", "打车 22.5", "买菜 30 西红柿", "买菜 30块 西红柿",
+    "餐饮 早餐 8", "交通|打车 机场 120", "可乐*2 3", "可乐x3 3.5", "可乐 2 3", "8", "8 8", "8块", "早餐",
+    "早餐 八块", "  早餐   8  ", "早餐8块钱", "rmb 8", "8rmb", "8RMB 咖啡", "3.14.15", "早餐 8.", "早餐 .5",
+    "100元红包", "2025年1月", "2024", "午饭 12 和 同事 一起", "١٢ 咖啡", "咖啡 ١٢",
+]
+
+
+def build_batch(rng: random.Random) -> str:
+    """批量记账：多行或分号分隔，偶尔夹带「批量」前缀、空行和无法解析的行"""
+    lines = [f"{rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}{rng.choice(UNITS)}" for _ in range(rng.randint(2, 6))]
+    if rng.random() < 0.3:
+        lines.insert(rng.randrange(len(lines)), rng.choice(["无金额", "", "  "]))
+    sep = rng.choice(["\n", "；", ";", "\n\n"])
+    text = sep.join(lines)
+    return ("批量\n" + text) if rng.random() < 0.5 else text
+
+
+def build_corpus(size: int, seed: int = 7) -> list:
+    """按真实消息比例生成语料：大部分是记账，其余是各类命令；固定用例放在最前面"""
+    rng = random.Random(seed)
+    shapes = [
+        lambda: f"{rng.choice(DESCRIPTIONS)} {rng.randint(1, 200)}",
+        lambda: f"{rng.choice(DESCRIPTIONS)}{rng.randint(1, 99)}{rng.choice(UNITS)}",
+        lambda: f"{rng.randint(1, 99)}{rng.choice(UNITS)}{rng.choice(DESCRIPTIONS)}",
+        lambda: f"{rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}.5 {rng.choice(DESCRIPTIONS)}",
+        lambda: f"{rng.choice(CATEGORIES)} {rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}",
+        lambda: f"记一笔 {rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}",
+        lambda: f"补记 {rng.choice(DATE_TOKENS[:6] + ['3-1', '2-28'])} {rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}",
+        lambda: f"改 {rng.randint(1, 9)} {rng.choice(DESCRIPTIONS)} {rng.randint(1, 99)}",
+        lambda: f"删 {rng.choice(['', '昨天 ', '本周 ', '3-14 '])}{rng.randint(1, 5)}-{rng.randint(1, 9)}",
+        lambda: f"删 {','.join(str(rng.randint(1, 9)) for _ in range(rng.randint(1, 4)))}",
+        lambda: f"欠 {rng.choice(NAMES)} {rng.randint(10, 500)} 饭钱",
+        lambda: f"还 {rng.choice(NAMES)} {rng.randint(10, 500)}",
+        lambda: f"导出 {rng.choice(MONTH_TOKENS[:8])}",
+        lambda: build_batch(rng),
+        lambda: rng.choice(CATEGORIES),
+        lambda: rng.choice(COMMANDS),
+    ]
+    weights = [26, 10, 6, 5, 5, 5, 3, 3, 3, 2, 2, 2, 2, 6, 4, 16]
+    corpus = COMMANDS + EDGE_RECORDS
+    corpus += [rng.choices(shapes, weights)[0]() for _ in range(max(size - len(corpus), 0))]
+    return corpus
+
+
+def is_batch(message: str) -> bool:
+    """与 handle_message 相同的批量记账判断"""
+    if "批量" in message or "\n" in message or "；" in message or ";" in message:
+        return len(wechat.split_batch_lines(message)) >= 2
+    return False
+
+
+def evaluate(message: str):
+    """按 handle_message 的路径解析一条消息，并把日期/编号等后续解析一并展开"""
+    if is_batch(message):
+        return {"batch": [wechat.parse_record_text(line) for line in wechat.split_batch_lines(message)]}
+    parsed = wechat.parse_message(message)
+    if parsed["type"] == "record_delete":
+        period_token, indices = wechat.parse_delete_target(parsed["raw"])
+        parsed = dict(parsed, period_token=period_token, indices=indices)
+    elif parsed["type"] == "record_backfill":
+        parsed = dict(parsed, date=wechat.parse_date_token(parsed["date_token"]))
+    return parsed
+
+
+def to_jsonable(value):
+    """datetime 转成 ISO 字符串，元组转成列表，便于与 JSON 中的期望结果比较"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    return value
+
+
+def collect_outputs(corpus: list) -> dict:
+    """计算语料与日期/月份标记的全部解析结果"""
+    return {
+        "messages": {message: to_jsonable(evaluate(message)) for message in corpus},
+        "date_tokens": {token: to_jsonable(wechat.parse_date_token(token)) for token in DATE_TOKENS},
+        "month_tokens": {token: to_jsonable(wechat.parse_month_token(token)) for token in MONTH_TOKENS},
+    }
+
+
+def check_outputs(outputs: dict) -> int:
+    """与期望结果比对，打印前几处差异，返回差异条数"""
+    with open(GOLDEN_PATH, encoding="utf-8") as f:
+        golden = json.load(f)
+    mismatches = []
+    for section, expected in golden.items():
+        actual = outputs.get(section, {})
+        for key, value in expected.items():
+            if key not in actual:
+                mismatches.append((section, key, value, "<语料中缺失>"))
+            elif actual[key] != value:
+                mismatches.append((section, key, value, actual[key]))
+    for section, key, expected, actual in mismatches[:10]:
+        print(f"❌ [{section}] {key!r}\n   期望: {expected}\n   实际: {actual}")
+    return len(mismatches)
+
+
+def write_golden(outputs: dict):
+    """写入期望结果：每条消息一行，便于在 diff 中查看语义变化"""
+    sections = []
+    for section in sorted(outputs):
+        items = [
+            f"  {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False, sort_keys=True)}"
+            for key, value in sorted(outputs[section].items())
+        ]
+        sections.append(f"{json.dumps(section)}: {{\n" + ",\n".join(items) + "\n}")
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as f:
+        f.write("{\n" + ",\n".join(sections) + "\n}\n")
+
+
+def freeze_time():
+    """固定 wechat 模块内的当前时间，保证日期相关的解析结果可复现"""
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return FROZEN_NOW.astimezone(tz) if tz else FROZEN_NOW.replace(tzinfo=None)
+
+    wechat.datetime = FrozenDatetime
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parse_message 基准与回归校验")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--size", type=int, default=3000)
+    parser.add_argument("--update", action="store_true", help="重新生成 parser_golden.json")
+    args = parser.parse_args()
+
+    freeze_time()
+    wechat.CATEGORY_LIST_CACHE["value"] = sorted(CATEGORIES)
+    wechat.CATEGORY_LIST_CACHE["expires_at"] = 2 ** 62
+    corpus = build_corpus(args.size)
+
+    outputs = collect_outputs(corpus)
+    if args.update:
+        write_golden(outputs)
+        print(f"已写入 {GOLDEN_PATH}：{len(outputs['messages'])} 条消息")
+    else:
+        mismatches = check_outputs(outputs)
+        if mismatches:
+            print(f"解析结果与期望不一致：{mismatches} 处")
+            sys.exit(1)
+        print(f"✅ 解析结果一致：{len(outputs['messages'])} 条消息，"
+              f"{len(DATE_TOKENS)} 个日期标记，{len(MONTH_TOKENS)} 个月份标记")
+
+    # 整轮吞吐取最快一轮；单条延迟取所有轮次的分布
+    best = None
+    latencies = []
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        for message in corpus:
+            evaluate(message)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    for _ in range(max(args.rounds // 4, 1)):
+        for message in corpus:
+            started = time.perf_counter_ns()
+            evaluate(message)
+            latencies.append(time.perf_counter_ns() - started)
+    latencies.sort()
+    print(f"{len(corpus)} 条 x {args.rounds} 轮，最快一轮 {best * 1000:.1f} ms，"
+          f"{len(corpus) / best:,.0f} 条/秒，平均 {best / len(corpus) * 1e6:.2f} µs/条，"
+          f"p50 {percentile(latencies, 0.50) / 1000:.2f} µs，p99 {percentile(latencies, 0.99) / 1000:.2f} µs")
+
+
+if __name__ == "__main__":
+    main()